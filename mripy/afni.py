@@ -1,17 +1,33 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
-import sys, os, re, shlex, shutil, glob, subprocess, collections
+import sys, os, re, shlex, shutil, glob, subprocess, collections, itertools, functools
 from os import path
 from datetime import datetime
 import numpy as np
-from scipy import interpolate
-import matplotlib as mpl
 from . import six
 
 
 # Test afni installation
-has_afni = bool(re.search('version', subprocess.check_output(['afni', '-ver']).decode('utf-8'), re.IGNORECASE))
+# This is deferred until `has_afni` is first accessed (and memoized), so that importing mripy
+# stays fast and doesn't fail on nodes without afni on PATH.
+@functools.lru_cache(maxsize=None)
+def get_afni_version():
+    '''
+    Return the output of `afni -ver`, or None if afni is not available.
+    '''
+    try:
+        return subprocess.check_output(['afni', '-ver'], stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def __getattr__(name): # Lazy module attribute (PEP 562)
+    if name == 'has_afni':
+        version = get_afni_version()
+        return version is not None and bool(re.search('version', version, re.IGNORECASE))
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
 # # Find afni path
 # config_dir = path.expanduser('~/.mripy')
 # if not path.exists(config_dir):
@@ -257,6 +273,164 @@ def infer_surf_dset_variants(fname, hemis=SPEC_HEMIS):
     return fname
 
 
+# Dataset header reader
+# Geometry queries are answered in-process from the dataset header (instead of
+# spawning 3dAttribute/3dinfo), and parsed headers are cached by path and mtime.
+_header_cache = {} # realpath -> (mtime_ns, size, attributes)
+
+def _resolve_header_file(fname):
+    '''
+    Return the *.HEAD or *.nii(.gz) file of a dataset, or None if the dataset
+    cannot be read directly (e.g., with sub-brick selectors like "dset+orig[0..10]").
+    '''
+    if re.search(r"[\[\]<>{}'\"]", fname):
+        return None
+    match = re.match(r'(.+\+(?:orig|tlrc|acpc))(?:\.|\.HEAD|\.BRIK|\.BRIK\.gz)?$', fname)
+    if match:
+        fname = match.group(1) + '.HEAD'
+    elif not re.search(r'\.nii(\.gz)?$', fname):
+        return None
+    return fname if path.isfile(fname) else None
+
+
+def read_head(fname):
+    '''
+    Read all attributes from an AFNI *.HEAD file.
+
+    Returns
+    -------
+    attributes : OrderedDict
+        Integer and float attributes are returned as arrays, and string attributes
+        are returned as is (i.e., sub-strings separated and ended by "~", like 3dAttribute).
+
+    References
+    ----------
+    [1] https://afni.nimh.nih.gov/pub/dist/doc/program_help/README.attributes.html
+    '''
+    with open(fname, 'r', errors='replace') as fi:
+        text = fi.read()
+    attributes = collections.OrderedDict()
+    pattern = re.compile(r'type\s*=\s*(\S+)\s+name\s*=\s*(\S+)\s+count\s*=\s*(\d+)\s*')
+    pos = 0
+    while True:
+        match = pattern.search(text, pos)
+        if match is None:
+            break
+        type, name, count = match.group(1), match.group(2), int(match.group(3))
+        pos = match.end()
+        if type == 'string-attribute':
+            # The string starts with a single quote, followed by exactly `count` characters
+            start = text.index("'", pos) + 1
+            attributes[name] = text[start:start+count]
+            pos = start + count
+        else:
+            end = text.find('type', pos)
+            values = text[pos:end if end >= 0 else None].split()[:count]
+            attributes[name] = np.array(values, dtype=int if type == 'integer-attribute' else float)
+    return attributes
+
+
+def write_head(fname, attributes):
+    '''
+    Write attributes (as returned by `read_head`) into an AFNI *.HEAD file.
+    String attributes are written as is, so they should be terminated by "~".
+    '''
+    with open(fname, 'w') as fo:
+        for name, value in attributes.items():
+            if isinstance(value, six.string_types):
+                fo.write(f"\ntype = string-attribute\nname = {name}\ncount = {len(value)}\n'{value}\n")
+            else:
+                value = np.atleast_1d(value)
+                if np.issubdtype(value.dtype, np.integer):
+                    type, values = 'integer', [f"{v:d}" for v in value]
+                else:
+                    type, values = 'float', [f"{v:.9g}" for v in value]
+                fo.write(f"\ntype = {type}-attribute\nname = {name}\ncount = {len(values)}\n")
+                for k in range(0, len(values), 5):
+                    fo.write(' ' + ' '.join(values[k:k+5]) + '\n')
+
+
+def affine2attributes(MAT):
+    '''
+    Convert a 3x4 affine (RAI, as returned by `get_affine`) into AFNI's
+    ORIENT_SPECIFIC, ORIGIN and DELTA attributes (obliquity is ignored).
+    '''
+    MAT = np.asarray(MAT)
+    axes = np.argmax(np.abs(MAT[:,:3]), axis=0) # The (closest) world axis for each voxel axis
+    DELTA = np.linalg.norm(MAT[:,:3], axis=0) * np.sign(MAT[axes,[0,1,2]])
+    # Positive delta means R2L (0), A2P (3), or I2S (4) along that world axis
+    ORIENT = np.where(DELTA > 0, np.array([0, 3, 4])[axes], np.array([1, 2, 5])[axes])
+    ORIGIN = MAT[axes,3]
+    return ORIENT, ORIGIN, DELTA
+
+
+def _nifti2attributes(fname):
+    '''
+    Synthesize AFNI geometry attributes from a NIfTI header, as AFNI would see them.
+    '''
+    import nibabel
+    img = nibabel.load(fname) # Only the header is read
+    shape = img.shape + (1,)*(3-len(img.shape))
+    # RAS+ (nifti) -> RAI (dicom/afni)
+    ORIENT, ORIGIN, DELTA = affine2attributes(np.diag([-1,-1, 1]) @ img.affine[:3])
+    attributes = collections.OrderedDict()
+    attributes['DATASET_DIMENSIONS'] = np.r_[shape[:3], 0, 0]
+    attributes['DATASET_RANK'] = np.r_[3, int(np.prod(shape[3:])), np.zeros(6, dtype=int)]
+    attributes['ORIENT_SPECIFIC'] = ORIENT
+    attributes['ORIGIN'] = ORIGIN
+    attributes['DELTA'] = DELTA
+    if len(shape) > 3 and shape[3] > 1:
+        TR = float(img.header.get_zooms()[3])
+        if img.header.get_xyzt_units()[1] == 'msec':
+            TR /= 1000
+        attributes['TAXIS_NUMS'] = np.r_[shape[3], 0, 77002] # UNITS_SEC_TYPE
+        attributes['TAXIS_FLOATS'] = np.r_[0, TR, 0, 0, 0]
+    # AFNI extension (ecode=4) may contain the original AFNI attributes (e.g., BRICK_LABS)
+    for ext in img.header.extensions:
+        if ext.get_code() == 4:
+            match = re.search(r'atr_name="BRICK_LABS"[^>]*>\s*"(.*?)"\s*<', ext.get_content().decode('utf-8', 'replace'), re.DOTALL)
+            if match:
+                attributes['BRICK_LABS'] = match.group(1)
+    return attributes
+
+
+def read_header(fname):
+    '''
+    Read (cached) AFNI attributes of a dataset, either from *.HEAD or synthesized from *.nii(.gz).
+
+    The cache is process-wide and keyed by the real path, mtime and size of the header file,
+    so repeated geometry queries cost microseconds, and modified datasets are re-read.
+
+    Returns
+    -------
+    attributes : dict or None
+        None if the dataset cannot be read directly (the caller should then fall back to AFNI).
+    '''
+    header_file = _resolve_header_file(fname)
+    if header_file is None:
+        return None
+    key = path.realpath(header_file)
+    st = os.stat(key)
+    cached = _header_cache.get(key)
+    if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    attributes = read_head(header_file) if header_file.endswith('.HEAD') else _nifti2attributes(header_file)
+    _header_cache[key] = (st.st_mtime_ns, st.st_size, attributes)
+    return attributes
+
+
+def clear_header_cache():
+    _header_cache.clear()
+
+
+def _get_cached_attribute(fname, name):
+    attributes = read_header(fname)
+    if attributes is not None and name in attributes:
+        value = attributes[name]
+        return value.copy() if isinstance(value, np.ndarray) else value # Protect the cache
+    return None
+
+
 def get_ORIENT(fname, format='str'):
     '''
     Parameters
@@ -280,8 +454,10 @@ def get_ORIENT(fname, format='str'):
         On the other hand, NIFTI images have an affine relating the voxel coordinates 
         to world coordinates in RAS+ space, or LPI in AFNI's term.
     '''
-    res = check_output(['3dAttribute', 'ORIENT_SPECIFIC', fname])[-2]
-    ORIENT = np.fromiter(map(int, res.split()), int)
+    ORIENT = _get_cached_attribute(fname, 'ORIENT_SPECIFIC')
+    if ORIENT is None:
+        res = check_output(['3dAttribute', 'ORIENT_SPECIFIC', fname])[-2]
+        ORIENT = np.fromiter(map(int, res.split()), int)
     code2str = np.array(['R', 'L', 'P', 'A', 'I', 'S'])
     code2mat = np.array([[ 1, 0, 0],
                          [-1, 0, 0],
@@ -304,20 +480,26 @@ def get_DIMENSION(fname):
     '''
     [x, y, z, t, 0]
     '''
-    res = check_output(['3dAttribute', 'DATASET_DIMENSIONS', fname])[-2]
-    DIMENSION = np.fromiter(map(int, res.split()), int)
+    DIMENSION = _get_cached_attribute(fname, 'DATASET_DIMENSIONS')
+    if DIMENSION is None:
+        res = check_output(['3dAttribute', 'DATASET_DIMENSIONS', fname])[-2]
+        DIMENSION = np.fromiter(map(int, res.split()), int)
     return DIMENSION
 
 
 def get_ORIGIN(fname):
-    res = check_output(['3dAttribute', 'ORIGIN', fname])[-2]
-    ORIGIN = np.fromiter(map(float, res.split()), float)
+    ORIGIN = _get_cached_attribute(fname, 'ORIGIN')
+    if ORIGIN is None:
+        res = check_output(['3dAttribute', 'ORIGIN', fname])[-2]
+        ORIGIN = np.fromiter(map(float, res.split()), float)
     return ORIGIN
 
 
 def get_DELTA(fname):
-    res = check_output(['3dAttribute', 'DELTA', fname])[-2]
-    DELTA = np.fromiter(map(float, res.split()), float)
+    DELTA = _get_cached_attribute(fname, 'DELTA')
+    if DELTA is None:
+        res = check_output(['3dAttribute', 'DELTA', fname])[-2]
+        DELTA = np.fromiter(map(float, res.split()), float)
     return DELTA
 
 
@@ -339,6 +521,9 @@ def get_dims(fname):
     Dimensions (number of voxels) of the data matrix.
     See also: get_head_dims
     '''
+    attributes = read_header(fname)
+    if attributes is not None:
+        return np.r_[attributes['DATASET_DIMENSIONS'][:3], attributes['DATASET_RANK'][1]]
     # res = check_output(['@GetAfniDims', fname])[-2] # There can be leading warnings for oblique datasets
     res = check_output(['3dinfo', '-n4', fname])[-2] # `@GetAfniDims` may not work for things like `dset.nii'[0..10]'`
     return np.int_(res.split()) # np.fromiter(map(int, res.split()), int)
@@ -349,10 +534,13 @@ def get_head_dims(fname):
     Dimensions (number of voxels) along R-L, A-P, I-S axes.
     See also: get_dims
     '''
-    res = check_output(['3dinfo', '-orient', '-n4', fname])[-2]
-    res = res.split()
-    orient = res[0]
-    dims = np.int_(res[1:])
+    if read_header(fname) is not None:
+        orient, dims = get_ORIENT(fname), get_dims(fname)
+    else:
+        res = check_output(['3dinfo', '-orient', '-n4', fname])[-2]
+        res = res.split()
+        orient = res[0]
+        dims = np.int_(res[1:])
     ori2ax = {'R': 0, 'L': 0, 'A': 1, 'P': 1, 'I': 2, 'S': 2}
     axes = [ori2ax[ori] for ori in orient]
     return np.r_[dims[np.argsort(axes)], dims[3]]
@@ -362,10 +550,13 @@ def get_head_delta(fname):
     '''
     Resolution (voxel size) along R-L, A-P, I-S axes.
     '''
-    res = check_output(['3dinfo', '-orient', '-d3', fname])[-2]
-    res = res.split()
-    orient = res[0]
-    delta = np.abs(np.float_(res[1:]))
+    if read_header(fname) is not None:
+        orient, delta = get_ORIENT(fname), np.abs(get_DELTA(fname))
+    else:
+        res = check_output(['3dinfo', '-orient', '-d3', fname])[-2]
+        res = res.split()
+        orient = res[0]
+        delta = np.abs(np.float_(res[1:]))
     ori2ax = {'R': 0, 'L': 0, 'A': 1, 'P': 1, 'I': 2, 'S': 2}
     axes = [ori2ax[ori] for ori in orient]
     return delta[np.argsort(axes)]
@@ -375,12 +566,20 @@ def get_head_extents(fname):
     '''
     Spatial extent along R, L, A, P, I and S.
     '''
+    if read_header(fname) is not None:
+        # Bounding box of the voxel centers (in RAI coordinates)
+        MAT = get_affine(fname)
+        corners = np.array(list(itertools.product(*[[0, n-1] for n in get_DIMENSION(fname)[:3]]))).T
+        xyz = MAT[:,:3] @ corners + MAT[:,3:]
+        return np.c_[xyz.min(axis=1), xyz.max(axis=1)].ravel()
     res = check_output(['3dinfo', '-extent', fname])[-2]
     return np.float_(res.split())
 
 
 def get_brick_labels(fname, label2index=False):
-    res = check_output(['3dAttribute', 'BRICK_LABS', fname])[-2]
+    res = _get_cached_attribute(fname, 'BRICK_LABS')
+    if res is None:
+        res = check_output(['3dAttribute', 'BRICK_LABS', fname])[-2]
     labels = res.split('~')[:-1] # Each label ends with "~"
     if label2index:
         return {label: k for k, label in enumerate(labels)}
@@ -393,10 +592,29 @@ def set_brick_labels(fname, labels):
 
 
 def get_TR(fname):
+    '''
+    TR (in seconds), or 0 if the dataset has no time axis.
+    '''
+    attributes = read_header(fname)
+    if attributes is not None:
+        if 'TAXIS_FLOATS' not in attributes:
+            return 0.0
+        TR = float(attributes['TAXIS_FLOATS'][1])
+        return TR/1000 if attributes['TAXIS_NUMS'][2] == 77001 else TR # UNITS_MSEC_TYPE
     return float(check_output(['3dinfo', '-TR', fname])[-2])
 
 
 def get_attribute(fname, name, type=None):
+    header_file = _resolve_header_file(fname)
+    if header_file is not None and header_file.endswith('.HEAD'): # All attributes are available in *.HEAD
+        value = read_header(header_file).get(name)
+        if value is not None:
+            if type == 'int':
+                return np.int_(value)
+            elif type == 'float':
+                return np.float_(value)
+            else:
+                return value[:-1] if isinstance(value, six.string_types) else ' '.join(str(v) for v in value)
     res = check_output(['3dAttribute', name, fname])[-2]
     if type == 'int':
         return np.int_(res[:-1].split())
@@ -515,6 +733,7 @@ def add_colormap(cmap, name=None, cyclic=False, index=None, categorical=False):
     '''
     cmap : list of RGB colors | matplotlib.colors.LinearSegmentedColormap
     '''
+    import matplotlib as mpl # Imported on demand (slow to import)
     if name is None:
         if isinstance(cmap, mpl.colors.LinearSegmentedColormap):
             name = cmap.name
@@ -560,6 +779,8 @@ def write_colorscale_file(fname, pal_name, colors, locations=None, interp=None):
     For details, see https://afni.nimh.nih.gov/pub/dist/doc/OLD/afni_colorscale.html
     But in fact, if you fill the colorscale file with a lot of colors, only the first 256 colors will be used.
     '''
+    import matplotlib as mpl # Imported on demand (slow to import)
+    from scipy import interpolate
     if locations is None:
         locations = np.linspace(0, 1, len(colors))
     if interp is None:
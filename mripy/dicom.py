@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
-import glob, re, itertools, inspect
-import gzip
+import os, glob, re, itertools, inspect, multiprocessing
+import gzip, zlib, mmap, struct, sqlite3, pickle, json
 from datetime import datetime
 from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent import futures
 from os import path
 import numpy as np
 import six
@@ -22,6 +24,7 @@ vr_parsers = {
 
     'PN': lambda x: str.strip(x.decode(encoding)), # Person Name
     'AS': lambda x: str.strip(x.decode(encoding)), # Age String ??? e.g., 039Y
+    'UI': lambda x: x.decode(encoding).strip('\x00 '), # Unique Identifier (padded with NULL)
 
     'DA': lambda x: datetime.strptime(x.decode(encoding), '%Y%m%d').date(), # Date
     'TM': lambda x: datetime.strptime(x.decode(encoding).strip(), '%H%M%S.%f').time(), # Time
@@ -87,7 +90,9 @@ tag_parsers = {
     '0010,0040': ('PatientSex', vr_parsers['CS']),
     '0010,1010': ('PatientAge', vr_parsers['AS']),
     '0010,1030': ('PatientWeight', vr_parsers['DS']),
+    '0002,0010': ('TransferSyntaxUID', vr_parsers['UI']),
     '0002,0013': ('ImplementationVersionName', vr_parsers['SH']),
+    '0008,0008': ('ImageType', vr_parsers['CS']), # e.g., ORIGINAL\PRIMARY\M\MOSAIC
     '0008,0022': ('AcquisitionDate', vr_parsers['DA']),
     '0008,0032': ('AcquisitionTime', vr_parsers['TM']),
     '0008,103E': ('SeriesDescription', vr_parsers['LO']),
@@ -100,7 +105,7 @@ tag_parsers = {
     '0018,0081': ('EchoTime', vr_parsers['DS']),
     '0018,0082': ('InversionTime', vr_parsers['DS']),
     '0018,0084': ('ImagingFrequency', vr_parsers['DS']),
-    # '0018,0086': ('EchoNumber', vr_parsers['IS']), # The echo number used in generating this image. In the case of segmented k-space, it is the effective Echo Number. (However, could be 1 for MB GE EPI)
+    '0018,0086': ('EchoNumber', vr_parsers['IS']), # The echo number used in generating this image. In the case of segmented k-space, it is the effective Echo Number. (However, could be 1 for MB GE EPI)
     '0018,0087': ('MagneticFieldStrength', vr_parsers['DS']),
     '0018,0088': ('SpacingBetweenSlices', vr_parsers['DS']), # Thickness plus gap
     # '0018,0091': ('EchoTrainLength', vr_parsers['IS']), # Number of lines in k-space acquired per excitation per image. (However, could be 1 for MB GE EPI)
@@ -126,8 +131,17 @@ tag_parsers = {
     '0020,0011': ('SeriesNumber', vr_parsers['IS']),
     '0020,0012': ('AcquisitionNumber', vr_parsers['IS']),
     '0020,0013': ('InstanceNumber', vr_parsers['IS']),
+    '0020,0032': ('ImagePositionPatient', vr_parsers['DS']), # x, y, z of the center of the first transmitted voxel (LPS, mm)
+    '0020,0037': ('ImageOrientationPatient', vr_parsers['DS']), # Direction cosines of the first row and the first column (LPS)
     '0020,4000': ('ImageComments', vr_parsers['LT']),
-    '0028,0030': ('PixelSpacing', vr_parsers['DS']),
+    '0028,0010': ('Rows', vr_parsers['US']),
+    '0028,0011': ('Columns', vr_parsers['US']),
+    '0028,0030': ('PixelSpacing', vr_parsers['DS']), # Adjacent row spacing\adjacent column spacing
+    '0028,0100': ('BitsAllocated', vr_parsers['US']),
+    '0028,0101': ('BitsStored', vr_parsers['US']),
+    '0028,0103': ('PixelRepresentation', vr_parsers['US']), # 0 for unsigned, 1 for signed (2's complement)
+    '0028,1052': ('RescaleIntercept', vr_parsers['DS']),
+    '0028,1053': ('RescaleSlope', vr_parsers['DS']),
     '0029,1010': ('CSA', parse_Siemens_CSA), # Siemens private element
     '0029,1020': ('CSA2', parse_Siemens_CSA2), # Siemens private element
 }
@@ -156,41 +170,153 @@ custom_parsers = {
 }
 
 
-def parse_SQ_data_element(fi):
+# Siemens private elements are always parsed (merged only once at import)
+tag_parsers.update(Siemens_parsers)
+
+# VR of the parsed tags, which is required to decode Implicit VR Data Elements (PS3.6 Section 6)
+implicit_VRs = {
+    '0002,0010': 'UI', '0002,0013': 'SH',
+    '0008,0008': 'CS', '0008,0022': 'DA', '0008,0032': 'TM', '0008,103E': 'LO',
+    '0010,0010': 'PN', '0010,0030': 'DA', '0010,0040': 'CS', '0010,1010': 'AS', '0010,1030': 'DS',
+    '0018,0020': 'CS', '0018,0021': 'CS', '0018,0023': 'CS', '0018,0024': 'SH',
+    '0018,0050': 'DS', '0018,0080': 'DS', '0018,0081': 'DS', '0018,0082': 'DS', '0018,0084': 'DS',
+    '0018,0086': 'IS', '0018,0087': 'DS', '0018,0088': 'DS', '0018,0091': 'IS', '0018,0095': 'DS',
+    '0018,1020': 'LO', '0018,1030': 'LO', '0018,1251': 'SH', '0018,1310': 'US', '0018,1312': 'CS',
+    '0018,1314': 'DS', '0018,1316': 'DS',
+    '0019,100A': 'US', '0019,1029': 'FD', # Siemens private elements
+    '0020,0010': 'SH', '0020,0011': 'IS', '0020,0012': 'IS', '0020,0013': 'IS', '0020,0032': 'DS', '0020,0037': 'DS', 
+    '0020,4000': 'LT', '0028,0010': 'US', '0028,0011': 'US', '0028,0030': 'DS', '0028,0100': 'US', '0028,0101': 'US', 
+    '0028,0103': 'US', '0028,1052': 'DS', '0028,1053': 'DS',
+    '0029,1010': 'OB', '0029,1020': 'OB', # Siemens private elements
+    '0051,100E': 'SH', '0051,1011': 'SH', '0051,1016': 'SH', # Siemens private elements
+    '7FE0,0010': 'OW',
+}
+
+# Transfer Syntax UID -> (explicit VR, byte order) of the Data Set (PS3.5 Section 10 and Annex A)
+# Other transfer syntaxes (e.g., JPEG) only compress the pixel data, and use Explicit VR Little Endian.
+transfer_syntaxes = {
+    '1.2.840.10008.1.2': (False, '<'), # Implicit VR Little Endian
+    '1.2.840.10008.1.2.1': (True, '<'), # Explicit VR Little Endian
+    '1.2.840.10008.1.2.1.99': (True, '<'), # Deflated Explicit VR Little Endian
+    '1.2.840.10008.1.2.2': (True, '>'), # Explicit VR Big Endian (retired)
+}
+DEFLATED = '1.2.840.10008.1.2.1.99'
+
+# Explicit VRs with 2 reserved bytes followed by a 4-byte length
+LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+# Binary VRs whose values have to be byte-swapped for Big Endian
+BINARY_VR_SIZES = {b'AT': 2, b'OD': 8, b'OF': 4, b'OL': 4, b'OW': 2, b'FD': 8, b'FL': 4, 
+    b'SL': 4, b'SS': 2, b'SV': 8, b'UL': 4, b'US': 2, b'UV': 8}
+UNDEFINED_LENGTH = 0xFFFFFFFF
+ITEM = 0xFFFEE000 # Item (Mark the start of an item)
+ITEM_DELIMITATION = 0xFFFEE00D # Item Delimitation Item (Mark the end of an item with undefined length)
+SEQUENCE_DELIMITATION = 0xFFFEE0DD # Sequence Delimitation Item (Mark the end of an SQ with undefined length)
+PIXEL_DATA = 0x7FE00010
+
+
+_tag_strs = {} # Memoized (group << 16 | element) -> "GGGG,EEEE"
+
+def _tag2str(tag):
+    try:
+        return _tag_strs[tag]
+    except KeyError:
+        return _tag_strs.setdefault(tag, '{0:04X},{1:04X}'.format(tag >> 16, tag & 0xFFFF))
+
+
+def _element_header_reader(explicit=True, endian='<'):
+    '''
+    Create a decoder for Data Element headers with Explicit or Implicit VR 
+    (PS3.5 Table 7.1-1, 7.1-2, and 7.1-3), in either Little or Big Endian.
+
+    The decoder returns (tag, VR, length, pos), where tag is (group << 16 | element),
+    VR is bytes (or None if unknown), and pos is the position of the value field.
     '''
-    We only support Data Element with Explicit VR at present (Table 7.1-2).
-    We don't support nested Item at present (2018-09-26).
+    tag_VR = struct.Struct(endian + 'HH2s')
+    tag_length = struct.Struct(endian + 'HHI')
+    long_length = struct.Struct(endian + 'I')
+    short_length = struct.Struct(endian + 'H')
+    if explicit:
+        def read_element_header(buf, pos):
+            group, element, VR = tag_VR.unpack_from(buf, pos)
+            tag = group << 16 | element
+            if group == 0xFFFE: # Item, Item Delimitation Item, and Sequence Delimitation Item have no VR
+                return tag, None, long_length.unpack_from(buf, pos+4)[0], pos+8
+            elif VR in LONG_VRS:
+                return tag, VR, long_length.unpack_from(buf, pos+8)[0], pos+12
+            else:
+                return tag, VR, short_length.unpack_from(buf, pos+6)[0], pos+8
+    else:
+        def read_element_header(buf, pos):
+            group, element, length = tag_length.unpack_from(buf, pos)
+            tag = group << 16 | element
+            VR = implicit_VRs.get(_tag2str(tag)) if group != 0xFFFE else None
+            return tag, (VR.encode() if VR is not None else None), length, pos+8
+    return read_element_header
+
+element_header_readers = {(explicit, endian): _element_header_reader(explicit, endian) 
+    for explicit in [True, False] for endian in ['<', '>']}
+_read_element_header = element_header_readers[(True, '<')]
+_read_implicit_element_header = element_header_readers[(False, '<')]
+
+
+def _swap_bytes(value, VR):
+    n = BINARY_VR_SIZES.get(VR)
+    return np.frombuffer(value, dtype=f"u{n}").byteswap().tobytes() if n and n > 1 else value
+
+
+def parse_SQ_data_element(buf, pos, read_element_header=None):
+    '''
+    Skip over the items of a Sequence of Items with undefined length (Section 7.5).
+    Items (and nested sequences) with undefined length are walked through element
+    by element, so that the payload is allowed to contain nested undefined length items.
+
+    Returns
+    -------
+    pos : int
+        Position right after the Sequence Delimitation Item.
 
     References
     ----------
     [1] http://dicom.nema.org/Dicom/2013/output/chtml/part05/chapter_7.html
     '''
+    if read_element_header is None:
+        read_element_header = _read_element_header
     while True:
-        # Parse an item
-        item_tag = '{0:04X},{1:04X}'.format(*np.frombuffer(fi.read(4), dtype=np.uint16, count=2))
-        if item_tag == 'FFFE,E000': # Item (Mark the start of an item)
-            item_length = int.from_bytes(fi.read(4), byteorder='little', signed=False)
-            if item_length == 4294967295: # 0xFFFFFFFF: Undefined Length
-                # Bruteforce scan the byte stream until we hit "FFFE,E00D"
-                # Bug: However, this may fail if the payload also contains item with undefined length!
-                while True:
-                    # Until we hit "FFFE,E00D"
-                    if fi.read(2) == b'\xfe\xff':
-                        if fi.read(2) == b'\x0d\xe0':
-                            if fi.read(4) == b'\x00\x00\x00\x00':
-                                break
+        tag, VR, length, pos = read_element_header(buf, pos)
+        if tag == ITEM:
+            if length == UNDEFINED_LENGTH:
+                pos = _skip_undefined_length_item(buf, pos, read_element_header)
             else:
-                fi.seek(item_length, 1)
-        elif item_tag == 'FFFE,E00D': # Item Delimitation Item (Mark the end of an item with undefined length)
-            item_length = int.from_bytes(fi.read(4), byteorder='little', signed=False)
-            assert(item_length == 0)
-        elif item_tag == 'FFFE,E0DD': # Sequence Delimitation Item (Mark the end of an SQ with undefined length)
-            item_length = int.from_bytes(fi.read(4), byteorder='little', signed=False)
-            assert(item_length == 0)
-            break
+                pos += length
+        elif tag == SEQUENCE_DELIMITATION:
+            return pos
+
 
+def _skip_undefined_length_item(buf, pos, read_element_header):
+    while True:
+        tag, VR, length, pos = read_element_header(buf, pos)
+        if tag == ITEM_DELIMITATION:
+            return pos
+        elif length == UNDEFINED_LENGTH:
+            # UN with undefined length is encoded as Implicit VR Little Endian (PS3.5 Section 6.2.2)
+            pos = parse_SQ_data_element(buf, pos, _read_implicit_element_header if VR == b'UN' else read_element_header)
+        else:
+            pos += length
 
-def parse_dicom_header(fname, search_for_tags=None, **kwargs):
+
+def _read_dicom_buffer(fname):
+    '''
+    Return a read-only buffer of the whole file (memory-mapped unless compressed).
+    '''
+    if fname.endswith('.gz'):
+        with gzip.open(fname, 'rb') as fi:
+            return fi.read()
+    else:
+        with open(fname, 'rb') as fi:
+            return mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) # The mapping outlives the file object
+
+
+def parse_dicom_header(fname, search_for_tags=None, _pixel_handler=None, **kwargs):
     '''
     Parameters
     ----------
@@ -199,6 +325,9 @@ def parse_dicom_header(fname, search_for_tags=None, **kwargs):
         Search for specific dicom tags, and stop file scanning early if all tags of interest are seen.
         e.g., search_for_tags={'0020,0011', '0020,0013'} will search for SeriesNumber and InstanceNumber.
         This will save you some time, esp. when the remote file is accessed via slow data link.
+    _pixel_handler : callable
+        Called as `_pixel_handler(header, buf, pos, length, endian)` when the Pixel Data element 
+        is reached (before the file is closed). See `read_dicom_pixels`.
     **kwargs : 
         This is only for backward compatibility.
 
@@ -208,56 +337,71 @@ def parse_dicom_header(fname, search_for_tags=None, **kwargs):
     (see Section 7.5). Whether a Data Set uses Explicit or Implicit VR, among other characteristics, 
     is determined by the negotiated Transfer Syntax (see Section 10 and Annex A)." [1]
 
+    The File Meta Information (group 0002) is always Explicit VR Little Endian, 
+    and its Transfer Syntax UID (0002,0010) determines how the following Data Set is decoded.
+    Implicit VR, Explicit VR Big Endian, and Deflated Explicit VR are all supported.
+    Files without the preamble and meta information (e.g., old ACR-NEMA style export) 
+    are assumed to be Little Endian, with Explicit or Implicit VR guessed from the first element.
+
+    The file is memory-mapped and decoded in place, and the scanning always stops 
+    at the Pixel Data element (7FE0,0010), so that the pixel data is never read.
+
     References
     ----------
     [1] http://dicom.nema.org/Dicom/2013/output/chtml/part05/chapter_7.html
     [2] https://stackoverflow.com/questions/119684/parse-dicom-files-in-native-python
     '''
-    elements = []
     header = OrderedDict()
-    n_tags_seen = 0
-    tag_parsers.update(Siemens_parsers)
-    if fname.endswith('.gz'):
-        opener = gzip.open
-    else:
-        opener = open
-    with opener(fname, 'rb') as fi:
+    remaining = None if search_for_tags is None else set(search_for_tags)
+    mapped = buf = _read_dicom_buffer(fname)
+    try:
         # The preamble
-        fi.seek(128) # The first 128 bytes are 0x00
-        assert(fi.read(4).decode(encoding) == 'DICM') # The next 4 bytes are "DICM"
+        # The first 128 bytes are 0x00, and the next 4 bytes are "DICM"
+        if buf[128:132] == b'DICM':
+            pos = 132
+            in_meta = True # File Meta Information is always Explicit VR Little Endian
+            read_element_header, endian = _read_element_header, '<'
+        else: # No preamble: the Data Set starts from the very beginning
+            pos = 0
+            in_meta = False
+            read_element_header, endian = element_header_readers[(buf[4:6].isalpha() and buf[4:6].isupper(), '<')], '<'
         # Data Elements
-        while True:
-            element = {}
-            group = fi.read(2)
-            if not group:
+        n_bytes = len(buf)
+        while pos + 8 <= n_bytes:
+            if in_meta and buf[pos:pos+2] != b'\x02\x00': # The end of File Meta Information
+                in_meta = False
+                syntax = header.get('TransferSyntaxUID')
+                explicit, endian = transfer_syntaxes.get(syntax, (True, '<'))
+                read_element_header = element_header_readers[(explicit, endian)]
+                if syntax == DEFLATED: # The remaining Data Set is compressed with raw deflate (RFC 1951)
+                    buf = zlib.decompress(buf[pos:], -zlib.MAX_WBITS)
+                    pos, n_bytes = 0, len(buf)
+                    continue
+            tag, VR, length, pos = read_element_header(buf, pos)
+            if tag == PIXEL_DATA:
+                if _pixel_handler is not None:
+                    _pixel_handler(header, buf, pos, length, endian)
                 break
-            element['group'] = '{0:04X}'.format(int.from_bytes(group, byteorder='little', signed=False))
-            element['element'] = '{0:04X}'.format(int.from_bytes(fi.read(2), byteorder='little', signed=False))
-            tag = ','.join((element['group'], element['element']))
-            # print(tag, end='')
-            element['VR'] = fi.read(2).decode(encoding)
-            # print(':', element['VR'])
-            if element['VR'] in ['OB', 'OW', 'OF', 'SQ', 'UT', 'UN']:
-                fi.seek(2, 1)
-                element['length'] = int.from_bytes(fi.read(4), byteorder='little', signed=False)
-            else:
-                element['length'] = int.from_bytes(fi.read(2), byteorder='little', signed=False)
-            if element['length'] == 4294967295: # 0xFFFFFFFF: Undefined Length
-                if element['VR'] == 'SQ':
-                    parse_SQ_data_element(fi)
+            tag = _tag2str(tag)
+            if length == UNDEFINED_LENGTH:
+                if VR in [b'SQ', b'UN', None]: # Implicit VR with undefined length can only be SQ
+                    pos = parse_SQ_data_element(buf, pos, _read_implicit_element_header if VR == b'UN' else read_element_header)
                 else:
-                    # print(element['VR'])
                     raise NotImplementedError('** Undefined Length')
-            elif tag in tag_parsers:
-                header[tag_parsers[tag][0]] = tag_parsers[tag][1](fi.read(element['length']))
             else:
-                fi.seek(element['length'], 1)
-            elements.append(element)
-            if search_for_tags is not None and tag in search_for_tags:
-                n_tags_seen += 1
-                if n_tags_seen == len(search_for_tags):
+                if tag in tag_parsers:
+                    value = buf[pos:pos+length]
+                    if endian == '>':
+                        value = _swap_bytes(value, VR)
+                    header[tag_parsers[tag][0]] = tag_parsers[tag][1](value)
+                pos += length
+            if remaining is not None:
+                remaining.discard(tag)
+                if not remaining:
                     break
-    # elements = pd.DataFrame(elements, columns=['group', 'element', 'VR', 'length'])
+    finally:
+        if isinstance(mapped, mmap.mmap):
+            mapped.close()
     # Custom header fields
     for field, parser in custom_parsers.items():
         try:
@@ -268,12 +412,231 @@ def parse_dicom_header(fname, search_for_tags=None, **kwargs):
     return header
 
 
-def sort_dicom_series(folder):
+DICOM_INDEX_FILE = '.dicom_index.sqlite'
+
+class DicomIndex(object):
+    '''
+    Persistent on-disk index of parsed dicom headers.
+
+    Each entry is keyed by the real path of a dicom file and the qualified name 
+    of the parser, and validated by its size and mtime, so that repeated runs 
+    only need to parse new or changed files.
+    The parsed header (including derived `custom_parsers` fields) is pickled into
+    a local SQLite database, which can also answer series queries without 
+    opening any dicom file at all.
+
+    >>> with DicomIndex.for_folder('raw_fmri') as index:
+    >>>     studies = sort_dicom_series('raw_fmri', index=index)
+    >>>     headers = index.query(SeriesNumber=5)
+    '''
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.conn = sqlite3.connect(index_file)
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(headers)')]
+        if columns and 'parser' not in columns: # Index files without parser names are simply rebuilt
+            self.conn.execute('DROP TABLE headers')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS headers 
+            (path TEXT, parser TEXT, size INTEGER, mtime INTEGER, tags TEXT, header BLOB, PRIMARY KEY (path, parser))''')
+        self.conn.commit()
+
+    @classmethod
+    def for_folder(cls, folder):
+        '''Open (or create) the default index file within a dicom folder.'''
+        return cls(path.join(folder, DICOM_INDEX_FILE))
+
+    def __repr__(self):
+        return f'<DicomIndex | {len(self)} headers, index_file="{self.index_file}">'
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM headers').fetchone()[0]
+
+    @staticmethod
+    def _parser_name(parser):
+        '''Headers parsed by different parsers may have different schemas, so they are indexed separately.'''
+        if parser is None:
+            parser = parse_dicom_header
+        return f"{getattr(parser, '__module__', None)}.{getattr(parser, '__qualname__', repr(parser))}"
+
+    @staticmethod
+    def _encode_tags(tags):
+        return '*' if tags is None else ';'.join(sorted(tags)) # "*" means fully parsed header
+
+    @staticmethod
+    def _decode_tags(s):
+        return None if s == '*' else set(s.split(';')) if s else set()
+
+    def parse(self, files, search_for_tags=None, parser=None, n_jobs=1, chunk_size=None):
+        '''
+        Return headers for a list of dicom files, only parsing files that are 
+        not indexed yet, have been changed since, or were indexed with fewer tags.
+
+        Parameters
+        ----------
+        files : list
+        search_for_tags : set
+            Passed to `parser`. None means the full header is required.
+        parser : callable
+            Default is `parse_dicom_header`.
+        n_jobs, chunk_size : 
+            See `parse_dicom_headers`.
+        '''
+        if parser is None:
+            parser = parse_dicom_header
+        parser_name = self._parser_name(parser)
+        files = [path.realpath(f) for f in files]
+        entries = {row[0]: row[1:] for row in self.conn.execute('SELECT path, size, mtime, tags FROM headers WHERE parser=?', (parser_name,))}
+        headers = [None] * len(files)
+        hits, misses = [], []
+        for k, f in enumerate(files):
+            st = os.stat(f)
+            entry = entries.get(f)
+            if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                indexed = self._decode_tags(entry[2])
+                if indexed is None or (search_for_tags is not None and indexed.issuperset(search_for_tags)):
+                    hits.append(k)
+                    continue
+                # Accumulate previously indexed tags, so that entries only grow over time
+                tags = None if search_for_tags is None else indexed.union(search_for_tags)
+            else:
+                tags = search_for_tags
+            misses.append((k, st, tags))
+        for k in hits:
+            headers[k] = pickle.loads(self.conn.execute('SELECT header FROM headers WHERE path=? AND parser=?', 
+                (files[k], parser_name)).fetchone()[0])
+        parsed = _parse_dicom_files([files[k] for k, st, tags in misses], [tags for k, st, tags in misses], 
+            parser, n_jobs=n_jobs, chunk_size=chunk_size)
+        updates = []
+        for (k, st, tags), header in zip(misses, parsed):
+            headers[k] = header
+            updates.append((files[k], parser_name, st.st_size, st.st_mtime_ns, self._encode_tags(tags), pickle.dumps(header)))
+        self.update(updates)
+        return headers
+
+    def update(self, entries):
+        '''
+        Parameters
+        ----------
+        entries : list of tuples
+            [(path, parser_name, size, mtime_ns, encoded_tags, pickled_header), ...]
+        '''
+        if entries:
+            self.conn.executemany('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?)', entries)
+            self.conn.commit()
+
+    def query(self, parser=None, **criteria):
+        '''
+        Return indexed headers (sorted by filename) whose fields match all criteria,
+        without opening any dicom file, e.g., index.query(StudyID=1, SeriesNumber=5).
+        Only headers parsed by `parser` (default is `parse_dicom_header`) are considered.
+        '''
+        headers = []
+        for (blob,) in self.conn.execute('SELECT header FROM headers WHERE parser=? ORDER BY path', (self._parser_name(parser),)):
+            header = pickle.loads(blob)
+            if all(k in header and header[k] == v for k, v in criteria.items()):
+                headers.append(header)
+        return headers
+
+    def prune(self):
+        '''Remove entries whose dicom files no longer exist.'''
+        stale = [(f,) for (f,) in self.conn.execute('SELECT path FROM headers') if not path.exists(f)]
+        self.conn.executemany('DELETE FROM headers WHERE path=?', stale)
+        self.conn.commit()
+        return len(stale)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+@contextmanager
+def open_index(index, folder):
+    '''
+    Resolve `index` as accepted by `sort_dicom_series` etc. (a DicomIndex, its filename,
+    True for the default index file within `folder`, or None).
+    An index opened here is closed on exit, whereas a provided DicomIndex is left open.
+    '''
+    if index is True:
+        index = DicomIndex.for_folder(folder)
+    elif isinstance(index, six.string_types):
+        index = DicomIndex(index)
+    else: # Can be None or an existing DicomIndex
+        yield index
+        return
+    with index:
+        yield index
+
+
+def _parse_dicom_chunk(files, tags, parser):
+    # Custom parsers are not required to accept `search_for_tags` (unless it is used)
+    return [parser(f) if t is None else parser(f, search_for_tags=t) for f, t in zip(files, tags)]
+
+
+def _parse_dicom_files(files, tags, parser, n_jobs=1, chunk_size=None):
+    '''
+    Parse dicom files (each with its own `search_for_tags`) serially, or in 
+    parallel by sharding the file list into contiguous chunks across a pool of processes.
+    The results are always returned in the same order as `files`.
+    '''
+    if n_jobs is None:
+        n_jobs = max(multiprocessing.cpu_count() * 3 // 4, 1)
+    n_jobs = min(n_jobs, len(files), multiprocessing.cpu_count()) # More processes than cores only add overhead
+    if n_jobs <= 1:
+        return _parse_dicom_chunk(files, tags, parser)
+    if chunk_size is None: # One contiguous chunk per worker
+        chunk_size = -(-len(files) // n_jobs)
+    starts = range(0, len(files), chunk_size)
+    # Executor.map hands chunks to idle workers as soon as they are free (without polling),
+    # and yields results in order
+    with futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        chunks = executor.map(_parse_dicom_chunk, [files[k:k+chunk_size] for k in starts], 
+            [tags[k:k+chunk_size] for k in starts], itertools.repeat(parser, len(starts)))
+        return list(itertools.chain.from_iterable(chunks))
+
+
+def parse_dicom_headers(files, search_for_tags=None, parser=None, index=None, n_jobs=1, chunk_size=None):
+    '''
+    Parse headers for a list of dicom files.
+
+    Parameters
+    ----------
+    files : list
+    search_for_tags : set
+        See `parse_dicom_header`.
+    parser : callable
+        Default is `parse_dicom_header`.
+    index : DicomIndex
+        If provided, only new or changed files are actually parsed.
+    n_jobs : int
+        Number of worker processes. Default is 1 (serial parsing within current process).
+        If None, use 3/4 of the available cores (as in `paraproc.PooledCaller`).
+        With n_jobs > 1, `parser` must be picklable (e.g., a module level function).
+    chunk_size : int
+        Number of files parsed by each job. Default is one contiguous chunk per worker.
+    '''
+    if parser is None:
+        parser = parse_dicom_header
+    if index is not None:
+        return index.parse(files, search_for_tags=search_for_tags, parser=parser, n_jobs=n_jobs, chunk_size=chunk_size)
+    else:
+        return _parse_dicom_files(files, [search_for_tags]*len(files), parser, n_jobs=n_jobs, chunk_size=chunk_size)
+
+
+def sort_dicom_series(folder, index=None, n_jobs=1, chunk_size=None):
     '''
     Parameters
     ----------
     folder : string
         Path to the folder containing all the dicom files.
+    index : DicomIndex, str, or bool
+        Persistent header index (or its filename) to avoid re-parsing unchanged files.
+        If True, the default index file within `folder` is used.
+    n_jobs, chunk_size : 
+        Parse headers in parallel. See `parse_dicom_headers`.
 
     Returns
     -------
@@ -282,7 +645,9 @@ def sort_dicom_series(folder):
     '''
     exts = ['.IMA', '.dcm', '.dcm.gz']
     files = sorted(itertools.chain.from_iterable(glob.glob(path.join(folder, '*'+ext)) for ext in exts))
-    headers = [parse_dicom_header(f, search_for_tags={'0020,0010', '0020,0011', '0020,0013'}) for f in files]
+    with open_index(index, folder) as index:
+        headers = parse_dicom_headers(files, search_for_tags={'0020,0010', '0020,0011', '0020,0013'}, 
+            index=index, n_jobs=n_jobs, chunk_size=chunk_size)
     studies = []
     for study_id in np.unique([header['StudyID'] for header in headers]):
         study = OrderedDict()
@@ -294,7 +659,7 @@ def sort_dicom_series(folder):
     return studies
 
 
-def parse_series_info(dicom_files, dicom_ext=None, parser=None, return_headers=False):
+def parse_series_info(dicom_files, dicom_ext=None, parser=None, return_headers=False, index=None, n_jobs=1, chunk_size=None):
     '''
     Parameters
     ----------
@@ -302,6 +667,11 @@ def parse_series_info(dicom_files, dicom_ext=None, parser=None, return_headers=F
         A list of dicom files (e.g., as provided by sort_dicom_series), or
         a folder that contains a single series (e.g., "../raw_fmri/func01"), or 
         a single dicom file.
+    index : DicomIndex, str, or bool
+        Persistent header index (or its filename) to avoid re-parsing unchanged files.
+        If True, the default index file within the folder of the dicom files is used.
+    n_jobs, chunk_size : 
+        Parse headers in parallel. See `parse_dicom_headers`.
     '''
     if dicom_ext is None:
         dicom_ext = '.IMA'
@@ -314,7 +684,8 @@ def parse_series_info(dicom_files, dicom_ext=None, parser=None, return_headers=F
         else:
             dicom_files = [dicom_files]
     # Parse dicom headers
-    headers = [parser(f) for f in dicom_files]
+    with open_index(index, path.dirname(dicom_files[0])) as index:
+        headers = parse_dicom_headers(dicom_files, parser=parser, index=index, n_jobs=n_jobs, chunk_size=chunk_size)
     info = OrderedDict(headers[0])
     assert(np.all(np.array([header['StudyID'] for header in headers])==info['StudyID']))
     assert(np.all(np.array([header['SeriesNumber'] for header in headers])==info['SeriesNumber']))
@@ -345,6 +716,178 @@ def parse_series_info(dicom_files, dicom_ext=None, parser=None, return_headers=F
 
 
 
+def read_dicom_pixels(fname, out=None):
+    '''
+    Read the header and the (uncompressed) pixel data of a single-frame dicom file.
+
+    Parameters
+    ----------
+    fname : str
+    out : ndarray, shape (Rows, Columns)
+        If provided, the pixels are decoded directly into `out` (e.g., a view of 
+        a preallocated volume), with dtype conversion if necessary.
+
+    Returns
+    -------
+    header : OrderedDict
+    pixels : ndarray, shape (Rows, Columns)
+    '''
+    res = {}
+    def decode(header, buf, pos, length, endian):
+        if length == UNDEFINED_LENGTH:
+            raise NotImplementedError('** Encapsulated (compressed) pixel data is not supported.')
+        dtype = np.dtype(f"{endian}{'i' if header.get('PixelRepresentation', 0) else 'u'}{header['BitsAllocated']//8}")
+        shape = (header['Rows'], header['Columns'])
+        pixels = np.frombuffer(buf, dtype=dtype, count=shape[0]*shape[1], offset=pos).reshape(shape)
+        if out is None:
+            res['pixels'] = pixels.astype(dtype.newbyteorder('='))
+        else:
+            out[...] = pixels
+            res['pixels'] = out
+    header = parse_dicom_header(fname, _pixel_handler=decode)
+    if 'pixels' not in res:
+        raise ValueError(f'** No pixel data is found in "{fname}"')
+    return header, res['pixels']
+
+
+def _series_geometry(headers):
+    '''
+    Work out the volume shape, the affine (RAS+, as in NIfTI), and the location 
+    (slice and volume index) of each file within the volume, for a single series.
+    Both Siemens mosaic (one volume per file) and one-slice-per-file series are supported.
+    '''
+    h0 = headers[0]
+    row_cos, col_cos = np.reshape(h0['ImageOrientationPatient'], (2,3))
+    normal = np.cross(row_cos, col_cos)
+    row_spacing, col_spacing = h0['PixelSpacing']
+    instances = np.array([header['InstanceNumber'] for header in headers])
+    geometry = {'mosaic': 'MOSAIC' in h0.get('ImageType', '')}
+    if geometry['mosaic']:
+        nz = int(h0['n_slices'])
+        geometry['n_tiles'] = n_tiles = int(np.ceil(np.sqrt(nz)))
+        ny, nx = h0['Rows']//n_tiles, h0['Columns']//n_tiles
+        # ImagePositionPatient of a mosaic refers to the top left corner of the whole mosaic image
+        origin = h0['ImagePositionPatient'] + col_cos*row_spacing*(h0['Rows']-ny)/2 \
+            + row_cos*col_spacing*(h0['Columns']-nx)/2
+        slice_vec = normal * h0.get('SpacingBetweenSlices', h0['SliceThickness'])
+        z = np.zeros(len(headers), dtype=int)
+        t = np.argsort(np.argsort(instances)) # Each file is a volume
+        nt = len(headers)
+        slice_times = np.atleast_1d(h0['MosaicRefAcqTimes'])/1000 if 'MosaicRefAcqTimes' in h0 else None
+    else:
+        ny, nx = h0['Rows'], h0['Columns']
+        d = np.round([np.dot(header['ImagePositionPatient'], normal) for header in headers], 4)
+        positions = np.unique(d) # Sorted along the slice normal
+        nz = len(positions)
+        z = np.searchsorted(positions, d)
+        counts = np.bincount(z, minlength=nz)
+        if not np.all(counts == counts[0]):
+            raise ValueError('** Different number of files are found for different slices. Is this a single series?')
+        nt = counts[0]
+        order = np.lexsort((instances, z)) # Sort by slice, then by instance
+        t = np.zeros(len(headers), dtype=int)
+        t[order] = np.tile(np.arange(nt), nz)
+        first = order[::nt] # The first volume, ordered by slice
+        origin = headers[first[0]]['ImagePositionPatient']
+        if nz > 1:
+            slice_vec = (headers[first[-1]]['ImagePositionPatient'] - origin) / (nz-1)
+        else:
+            slice_vec = normal * h0['SliceThickness']
+        if nt > 1 and nz > 1:
+            timestamps = np.array([headers[k]['timestamp'] for k in first])
+            slice_times = np.round(timestamps - timestamps.min(), 6) # Acquisition time has a precision of 1 us
+        else:
+            slice_times = None
+    affine = np.eye(4)
+    affine[:3,0] = row_cos * col_spacing
+    affine[:3,1] = col_cos * row_spacing
+    affine[:3,2] = slice_vec
+    affine[:3,3] = origin
+    geometry['affine'] = np.diag([-1, -1, 1, 1]) @ affine # LPS (dicom) -> RAS (nifti)
+    geometry['shape'] = (nx, ny, nz, nt)
+    geometry['z'], geometry['t'] = z, t
+    geometry['TR'] = h0['RepetitionTime']/1000 # s
+    geometry['slice_times'] = slice_times
+    return geometry
+
+
+def convert_dicom_series(dicom_files, out_file, index=None, n_jobs=1, chunk_size=None, sidecar=True):
+    '''
+    Convert a single dicom series into NIfTI natively (no Dimon/to3d, no temp copies).
+
+    Geometry is worked out from ImagePositionPatient and ImageOrientationPatient, 
+    and uncompressed pixel data is decoded file by file into a preallocated volume, 
+    which is memory-mapped onto the output file for *.nii (see `io.nifti_volume`).
+
+    Parameters
+    ----------
+    dicom_files : list
+        Files of a single series (either Siemens mosaic, or one slice per file).
+    out_file : str
+        *.nii or *.nii.gz
+    index, n_jobs, chunk_size : 
+        Parse headers in parallel and/or with a persistent index. See `parse_dicom_headers`.
+    sidecar : bool
+        If True, also write a *.json file with the slice timing and MultiBand factor
+        (with BIDS field names), which cannot be represented in the NIfTI header.
+
+    Returns
+    -------
+    info : OrderedDict
+        Geometry and timing of the converted volume.
+    '''
+    import nibabel
+    from .io import nifti_volume # mripy.io imports this module
+    dicom_files = sorted(dicom_files)
+    with open_index(index, path.dirname(dicom_files[0])) as index:
+        headers = parse_dicom_headers(dicom_files, index=index, n_jobs=n_jobs, chunk_size=chunk_size)
+    geometry = _series_geometry(headers)
+    h0 = headers[0]
+    # Pixels are stored as is (e.g., 12-bit unsigned data are kept as int16, like to3d does)
+    dtype = np.dtype(f"{'i' if h0.get('PixelRepresentation', 0) else 'u'}{h0['BitsAllocated']//8}")
+    if dtype == np.uint16 and h0.get('BitsStored', 16) < 16:
+        dtype = np.dtype(np.int16)
+    shape = geometry['shape']
+    header = nibabel.Nifti1Header()
+    header.set_data_shape(shape if shape[3] > 1 else shape[:3])
+    header.set_data_dtype(dtype)
+    header.set_qform(geometry['affine'], code=1) # Scanner-based anatomical coordinates
+    header.set_sform(geometry['affine'], code=1)
+    header.set_xyzt_units('mm', 'sec')
+    header.set_dim_info(slice=2)
+    if shape[3] > 1:
+        header.set_zooms(header.get_zooms()[:3] + (geometry['TR'],))
+    if h0.get('RescaleSlope', 1) != 1 or h0.get('RescaleIntercept', 0) != 0:
+        header.set_slope_inter(h0.get('RescaleSlope', 1), h0.get('RescaleIntercept', 0))
+    header['descrip'] = h0.get('ProtocolName', '')[:79].encode(encoding)
+    with nifti_volume(out_file, header) as vol:
+        vol = vol.reshape(shape, order='F') # Always 4D (a view)
+        if geometry['mosaic']:
+            n_tiles = geometry['n_tiles']
+            nx, ny, nz = shape[:3]
+            mosaic = np.empty((h0['Rows'], h0['Columns']), dtype=dtype) # Reused for each file
+            for f, t in zip(dicom_files, geometry['t']):
+                read_dicom_pixels(f, out=mosaic)
+                tiles = mosaic[:n_tiles*ny,:n_tiles*nx].reshape(n_tiles, ny, n_tiles, nx).transpose(0, 2, 3, 1).reshape(-1, nx, ny)
+                vol[...,t] = tiles[:nz].transpose(1, 2, 0)
+        else:
+            for f, z, t in zip(dicom_files, geometry['z'], geometry['t']):
+                read_dicom_pixels(f, out=vol[:,:,z,t].T)
+    info = OrderedDict([('out_file', out_file), ('shape', shape), ('affine', geometry['affine']), 
+        ('TR', geometry['TR']), ('slice_times', geometry['slice_times']), ('MultiBand', h0.get('MultiBand'))])
+    if sidecar:
+        sidecar_file = re.sub(r'\.nii(\.gz)?$', '.json', out_file)
+        fields = OrderedDict([('ProtocolName', h0.get('ProtocolName')), ('SeriesNumber', int(h0['SeriesNumber'])), 
+            ('RepetitionTime', geometry['TR'])])
+        if geometry['slice_times'] is not None:
+            fields['SliceTiming'] = [float(x) for x in geometry['slice_times']]
+        if h0.get('MultiBand') is not None:
+            fields['MultibandAccelerationFactor'] = h0['MultiBand']
+        with open(sidecar_file, 'w') as fo:
+            json.dump(fields, fo, indent=4)
+    return info
+
+
 if __name__ == '__main__':
     print(parse_dicom_header('20180626_S18_EP2DBR_S07.MR.S18_APPROVED.0010.0001.2018.06.26.12.47.59.31250.120791562.IMA'))
     print(parse_dicom_header('20180918_S18_FACEID_VIS_S01.MR.S18_APPROVED.0007.0001.2018.09.18.15.52.59.828125.140479.IMA'))
@@ -75,12 +75,12 @@ def report_parameters(dicom_folder, preset=None, return_preset=False, return_inf
     return res if len(res) > 1 else res[0]
 
 
-def inspect_mp2rage(data_dir, subdir_pattern='T1??'):
+def inspect_mp2rage(data_dir, subdir_pattern='T1??', n_jobs=1):
     sess_dirs = sorted([f for f in glob.glob(f"{data_dir}/*") if path.isdir(f)])
     df = []
     for sess_dir in sess_dirs:
         T1_folders = glob.glob(f"{sess_dir}/{subdir_pattern}")
-        info = dicom.parse_series_info(T1_folders[0])
+        info = dicom.parse_series_info(T1_folders[0], n_jobs=n_jobs)
         df.append(OrderedDict(session=path.basename(sess_dir), resolution='x'.join(f'{d:g}' for d in info['resolution']), 
             ref_amp=info['ReferenceAmplitude'], coil=info['TransmittingCoil'], n_images=len(T1_folders)))
     return pd.DataFrame(df)
@@ -3,17 +3,21 @@
 from __future__ import print_function, division, absolute_import, unicode_literals
 import sys, os, subprocess
 import re, glob, shlex, shutil, tempfile, warnings
-import collections, itertools, copy
+import collections, itertools, copy, hashlib, json, gzip
+from contextlib import contextmanager
 import random, string
 from os import path
 from datetime import datetime
 import numpy as np
-from scipy import ndimage
-from .. import six, utils, afni, math, paraproc
+from .. import six, utils, afni, math, paraproc, dicom
+from . import freesurfer, niml
+
+ndimage = utils.lazy_import('scipy.ndimage') # Imported on demand (slow to import)
+spatial = utils.lazy_import('scipy.spatial')
 # For accessing NIFTI files
-try:
-    import nibabel
-except ImportError:
+if utils.has_module('nibabel'):
+    nibabel = utils.lazy_import('nibabel') # Imported on demand (slow to import)
+else:
     print('You may need to install "nibabel" to read/write NIFTI (*.nii) files.')
 try:
     from lxml import etree
@@ -227,7 +231,90 @@ def extract_physio(physio_file, dicom_file, TR=None, dummy=0, channels=['resp',
 
 
 # DICOM
-def parse_dicom_header(fname, fields=None):
+DICOM_ENGINES = ['dicom_hdr', 'native']
+DEFAULT_DICOM_ENGINE = 'dicom_hdr'
+
+# Dicom tags required by the native engine to fill in the same fields as `dicom_hdr`
+# (the scanning of each file stops early as soon as all these tags are seen)
+NATIVE_DICOM_TAGS = {
+    '0008,0022', '0008,0032', '0018,0020', '0018,0021', '0018,0023', '0018,0050', '0018,0080', '0018,0081', 
+    '0018,0084', '0018,0086', '0018,0087', '0018,0095', '0018,1030', '0018,1314', '0018,1316', '0019,100A', 
+    '0020,0010', '0020,0011', '0020,0012', '0020,0013', '0028,0030', '0051,1011',
+}
+
+def _check_dicom_engine(engine):
+    if engine is None:
+        engine = DEFAULT_DICOM_ENGINE
+    if engine not in DICOM_ENGINES:
+        raise ValueError(f"** Unknown dicom engine '{engine}'. Choose from {DICOM_ENGINES}.")
+    return engine
+
+
+def _from_native_dicom_header(native):
+    '''
+    Convert a header parsed by `mripy.dicom.parse_dicom_header` into the same 
+    schema (field names, types, and order) as returned by `dicom_hdr`.
+    '''
+    header = collections.OrderedDict()
+    header['AcquisitionDate'] = native['AcquisitionDate'].strftime('%Y%m%d')
+    header['AcquisitionTime'] = native['AcquisitionTime'].strftime('%H%M%S.%f') # This marks the start of a volume
+    header['timestamp'] = hms2dt(header['AcquisitionTime'], date=header['AcquisitionDate'], timestamp=True)
+    header['sequence_type'] = ' '.join((native['MRAcquisitionType'], native['SequenceVariant'], native['ScanningSequence']))
+    header['resolution'] = [float(x) for x in np.atleast_1d(native['PixelSpacing'])] + [float(native['SliceThickness'])]
+    header['RepetitionTime'] = float(native['RepetitionTime']) # ms
+    header['TE'] = float(native['EchoTime']) # ms
+    header['Larmor'] = float(native['ImagingFrequency']) # MHz
+    header['EchoNumber'] = int(native['EchoNumber']) # For multi-echo images
+    header['B0'] = float(native['MagneticFieldStrength']) # Tesla
+    header['BW'] = float(native['PixelBandwidth']) # Hz/pixel
+    header['ProtocolName'] = native['ProtocolName']
+    header['FlipAngle'] = float(native['FlipAngle'])
+    header['SAR'] = float(native['SAR'])
+    if 'n_slices' in native: # This field is optional
+        header['n_slices'] = int(native['n_slices'])
+    header['StudyID'] = int(native['StudyID']) # Study index
+    header['SeriesNumber'] = int(native['SeriesNumber']) # Series index
+    header['AcquisitionNumber'] = int(native['AcquisitionNumber']) # Volume index
+    header['InstanceNumber'] = int(native['InstanceNumber']) # File index
+    if 'acceleration_factor' in native: # This field is optional
+        header['iPAT'] = native['acceleration_factor'].split()[0]
+    header['gamma'] = 2*np.pi*header['Larmor']/header['B0']
+    return header
+
+
+def parse_dicom_headers(files, fields=None, engine=None, n_jobs=1, chunk_size=None, index=None):
+    '''
+    Parse a batch of dicom headers, returning the same schema as `parse_dicom_header`.
+
+    With the native engine, all headers are parsed by `mripy.dicom` within current process 
+    (or a pool of worker processes), without spawning a `dicom_hdr` process for each file.
+
+    Parameters
+    ----------
+    files : list
+    fields : dict
+        Additional fields to be parsed (only supported by the `dicom_hdr` engine).
+    engine : {'native', 'dicom_hdr'}
+        Default is DEFAULT_DICOM_ENGINE ('dicom_hdr').
+    n_jobs, chunk_size, index : 
+        Parse headers in parallel and/or with a persistent index (only for the native engine). 
+        See `mripy.dicom.parse_dicom_headers`.
+    '''
+    engine = _check_dicom_engine(engine)
+    if engine == 'native':
+        if fields is not None:
+            raise NotImplementedError('** `fields` is only supported by the "dicom_hdr" engine.')
+        if len(files) == 0:
+            return []
+        with dicom.open_index(index, path.dirname(files[0])) as index:
+            natives = dicom.parse_dicom_headers(files, search_for_tags=NATIVE_DICOM_TAGS, 
+                index=index, n_jobs=n_jobs, chunk_size=chunk_size)
+        return [_from_native_dicom_header(native) for native in natives]
+    else:
+        return [parse_dicom_header(f, fields=fields, engine=engine) for f in files]
+
+
+def parse_dicom_header(fname, fields=None, engine=None):
     '''
     Execute afni command `dicom_hdr` to readout most useful info from dicom header.
 
@@ -239,7 +326,13 @@ def parse_dicom_header(fname, fields=None):
         - field : e.g., 'ImageTime'
         - matcher : e.g. r'ID Image Time//(\S+)'
         - extracter : e.g., lambda match: io.hms2dt(match.group(1), date='20170706', timestamp=True)
+    engine : {'dicom_hdr', 'native'}
+        Default is DEFAULT_DICOM_ENGINE ('dicom_hdr').
+        The 'native' engine parses the header in-process with `mripy.dicom` (no AFNI required), 
+        and returns the same fields. `fields` is not supported in this case.
     '''
+    if _check_dicom_engine(engine) == 'native':
+        return parse_dicom_headers([fname], fields=fields, engine='native')[0]
     # print(fname)
     header = collections.OrderedDict()
     lines = subprocess.check_output(['dicom_hdr', fname]).decode('utf-8').split('\n')
@@ -428,18 +521,27 @@ def _sort_multi_series(files):
     return series, timestamps
 
 
-def sort_dicom_series(folder, series_pattern=SERIES_PATTERN):
+def sort_dicom_series(folder, series_pattern=SERIES_PATTERN, engine=None, n_jobs=1, chunk_size=None, index=None):
     '''
     Parameters
     ----------
     folder : string
         Path to the folder containing all the *.IMA files.
+    engine : {'dicom_hdr', 'native'}
+        With the default engine, files are sorted according to their filenames only.
+        With the 'native' engine, files are sorted according to StudyID, SeriesNumber, 
+        and InstanceNumber in their headers, which are parsed in batch by `mripy.dicom`.
+    n_jobs, chunk_size, index : 
+        See `parse_dicom_headers` (only for the native engine).
 
     Returns
     -------
     studies : list of dicts
         [{'0001': [file0, file1, ...], '0002': [files], ...}, {study1}, ...]
     '''
+    if _check_dicom_engine(engine) == 'native':
+        studies = dicom.sort_dicom_series(folder, index=index, n_jobs=n_jobs, chunk_size=chunk_size)
+        return studies if studies else None # Same as below when there is no dicom file
     # Sort files into series
     files = sorted(glob.glob(path.join(folder, '*.IMA')))
     series = collections.OrderedDict()
@@ -502,9 +604,28 @@ def filter_dicom_files(files, series_numbers=None, instance_numbers=None, series
     return filtered
 
 
-def parse_slice_order(dicom_files):
+def parse_slice_order(dicom_files, engine=None):
+    '''
+    Parameters
+    ----------
+    engine : {'dicom_hdr', 'native'}
+        With the default engine, the first two files are copied into a temp folder 
+        and converted by Dimon to read out the slice timing. 
+        With the 'native' engine, the slice timing is worked out from the headers directly
+        (MosaicRefAcqTimes for mosaic, or AcquisitionTime for one slice per file).
+
+    Returns
+    -------
+    order : str
+        'ascending', 'descending', or 'interleaved'
+    t : array
+        Slice timing (s).
+    '''
     t = None
-    if len(dicom_files) > 1:
+    if _check_dicom_engine(engine) == 'native':
+        headers = dicom.parse_dicom_headers(sorted(dicom_files))
+        t = dicom._series_geometry(headers)['slice_times']
+    elif len(dicom_files) > 1:
         temp_dir = 'temp_pares_slice_order'
         os.makedirs(temp_dir)
         for k, f in enumerate(dicom_files[:2]):
@@ -530,9 +651,18 @@ def parse_slice_order(dicom_files):
     return order, t
 
 
-def parse_series_info(fname, timestamp=False, shift_time=None, series_pattern=SERIES_PATTERN, fields=None, parser=None):
+def parse_series_info(fname, timestamp=False, shift_time=None, series_pattern=SERIES_PATTERN, fields=None, parser=None, 
+    engine=None, n_jobs=1, chunk_size=None, index=None):
     '''
     Potential bug: `dicom.parse_dicom_header` doesn't support `fields` as kwargs 
+
+    Parameters
+    ----------
+    engine : {'dicom_hdr', 'native'}
+        Used when `parser` is None. With the 'native' engine, all required headers 
+        are parsed in one batch by `mripy.dicom` (see `parse_dicom_headers`).
+    n_jobs, chunk_size, index : 
+        See `parse_dicom_headers` (only for the native engine).
     '''
     if isinstance(fname, six.string_types): # A single file or a folder
         if path.isdir(fname):
@@ -547,17 +677,20 @@ def parse_series_info(fname, timestamp=False, shift_time=None, series_pattern=SE
         files = fname
         findex = 0
     if parser is None:
-        parser = parse_dicom_header
+        parse_headers = lambda files: parse_dicom_headers(files, fields=fields, engine=engine, 
+            n_jobs=n_jobs, chunk_size=chunk_size, index=index)
+    else:
+        parse_headers = lambda files: [parser(f, fields=fields) for f in files]
     info = collections.OrderedDict()
     if timestamp:
         parse_list = range(len(files))
     else:
         parse_list = [0, -1]
-    headers = [parser(files[k], fields=fields) for k in parse_list]
+    headers = parse_headers([files[k] for k in parse_list])
     if headers[0]['StudyID'] != headers[-1]['StudyID']:
         # There are more than one series (from different studies) sharing the same series number
         if parse_list == [0, -1]:
-            headers = [headers[0]] + [parser(f) for f in files[1:-1]] + [headers[-1]]
+            headers = [headers[0]] + parse_headers(files[1:-1]) + [headers[-1]]
         if findex is None:
             findex = files.index(fname)
         selected = [k for k, header in enumerate(headers) if header['StudyID']==headers[findex]['StudyID']]
@@ -572,7 +705,7 @@ def parse_series_info(fname, timestamp=False, shift_time=None, series_pattern=SE
     if shift_time == 'CMRR':
         shift_time = 0
         if info['TR'] is not None and 'n_slices' in info and np.mod(info['n_slices'], 2)==0:
-            slice_order = parse_slice_order(files)[0]
+            slice_order = parse_slice_order(files, engine=engine)[0]
             if slice_order == 'interleaved':
                 shift_time = -info['TR']/2
     elif shift_time is None:
@@ -588,7 +721,17 @@ def parse_series_info(fname, timestamp=False, shift_time=None, series_pattern=SE
     return info
 
 
-def convert_dicom(dicom_dir, out_file=None, dicom_ext=None, interactive=False):
+def convert_dicom(dicom_dir, out_file=None, dicom_ext=None, interactive=False, engine=None, n_jobs=1):
+    '''
+    Parameters
+    ----------
+    engine : {'dicom_hdr', 'native'}
+        With the default engine, the dicom files are converted by AFNI's Dimon/to3d.
+        With the 'native' engine, the dicom files are converted in-process by 
+        `mripy.dicom.convert_dicom_series` (NIfTI output only, no AFNI required).
+    n_jobs : int
+        Number of processes to parse headers (only for the native engine).
+    '''
     if dicom_ext is None:
         dicom_ext = '.IMA'
     if out_file is None:
@@ -598,7 +741,12 @@ def convert_dicom(dicom_dir, out_file=None, dicom_ext=None, interactive=False):
     if not path.exists(out_dir):
         os.makedirs(out_dir)
     if prefix == '*': # Take the dicom folder name by default
-        prefix = path.split(dicom_dir)[1]
+        prefix = path.split(path.normpath(dicom_dir))[1]
+    if _check_dicom_engine(engine) == 'native':
+        if ext not in ['.nii', '.nii.gz']:
+            raise NotImplementedError('** The native engine only supports *.nii or *.nii.gz output.')
+        files = sorted(glob.glob(path.join(dicom_dir, '*'+dicom_ext)))
+        return dicom.convert_dicom_series(files, path.join(out_dir, prefix+ext), n_jobs=n_jobs)
     old_path = os.getcwd()
     try:
         os.chdir(dicom_dir)
@@ -612,7 +760,7 @@ def convert_dicom(dicom_dir, out_file=None, dicom_ext=None, interactive=False):
         os.chdir(old_path)
 
 
-def convert_dicoms(dicom_dirs, out_dir=None, prefix=None, out_type='.nii', dicom_ext='.IMA', **kwargs):
+def convert_dicoms(dicom_dirs, out_dir=None, prefix=None, out_type='.nii', dicom_ext='.IMA', engine=None, n_jobs=1, **kwargs):
     '''
     Parameters
     ----------
@@ -625,6 +773,11 @@ def convert_dicoms(dicom_dirs, out_dir=None, prefix=None, out_type='.nii', dicom
         Output directory for converted datasets, default is current directory.
         The output would look like:
             out_dir/anat.nii, out_dir/func01.nii, out_dir/func02.nii, etc.
+    engine : {'dicom_hdr', 'native'}
+        See `convert_dicom`.
+    n_jobs : int
+        Number of series converted concurrently (only for the native engine).
+        Each process converts one series at a time within bounded memory.
     '''
     original_dicom_dirs = dicom_dirs
     if isinstance(dicom_dirs, six.string_types):
@@ -636,11 +789,14 @@ def convert_dicoms(dicom_dirs, out_dir=None, prefix=None, out_type='.nii', dicom
         warnings.warn(f"\n>> Cannot find any dicom file to convert. Is the following path correct?\n{original_dicom_dirs}")
     if out_dir is None:
         out_dir = '.'
-    idx = 0
+    jobs = []
     for f in dicom_dirs:
         if path.isdir(f) and len(glob.glob(path.join(f, '*'+dicom_ext))) > 0:
-            idx += 1
-            convert_dicom(f, path.join(out_dir, '*'+out_type if prefix is None else '{0}{1:02d}{2}'.format(prefix, idx, out_type)), dicom_ext=dicom_ext, **kwargs)
+            jobs.append((f, path.join(out_dir, '*'+out_type if prefix is None else '{0}{1:02d}{2}'.format(prefix, len(jobs)+1, out_type))))
+    if _check_dicom_engine(engine) == 'native' and n_jobs != 1:
+        pc = paraproc.PooledCaller(pool_size=n_jobs)
+        return pc(pc.run(convert_dicom, f, out_file, dicom_ext=dicom_ext, engine=engine, **kwargs) for f, out_file in jobs)
+    return [convert_dicom(f, out_file, dicom_ext=dicom_ext, engine=engine, **kwargs) for f, out_file in jobs]
 
 
 # ========== Generic read/write ==========
@@ -664,6 +820,9 @@ def read_surf_mesh(fname, return_img=False, **kwargs):
         img = None
     elif fname.endswith('.gii'):
         verts, faces, img = read_gii(fname, return_img=True)
+    else: # FreeSurfer binary surface, e.g., lh.smoothwm
+        verts, faces = freesurfer.read_fs_surf(fname)
+        img = None
     return (verts, faces, img) if return_img else (verts, faces)
 
 
@@ -672,6 +831,8 @@ def write_surf_mesh(fname, verts, faces, **kwargs):
         write_asc(fname, verts, faces, **kwargs)
     elif fname.endswith('.gii'):
         write_gii(fname, verts, faces, **kwargs)
+    else: # FreeSurfer binary surface, e.g., lh.smoothwm
+        freesurfer.write_fs_surf(fname, verts, faces, **kwargs)
 
 
 def read_surf_data(fname):
@@ -759,6 +920,36 @@ def write_nii(fname, vol, base_img=None, space=None, dim=None):
     nibabel.save(img, fname)
 
 
+@contextmanager
+def nifti_volume(out_file, header):
+    '''
+    Provide a preallocated (Fortran ordered) data array for a NIfTI file.
+
+    For uncompressed *.nii, the header is written first and the data array is 
+    memory-mapped onto the file, so that the volume never needs to fit in memory.
+    For *.nii.gz, the volume is kept in memory and compressed when done.
+    Either way, the data are written as is (i.e., scl_slope/scl_inter in the header are kept).
+    '''
+    shape, dtype = header.get_data_shape(), header.get_data_dtype()
+    offset = 352 # 348 bytes of header + 4 bytes of (empty) extension flag
+    header['vox_offset'] = offset
+    if out_file.endswith('.nii'):
+        with open(out_file, 'wb') as fo:
+            header.write_to(fo)
+            fo.truncate(offset + int(np.prod(shape))*dtype.itemsize)
+        vol = np.memmap(out_file, dtype=dtype, mode='r+', offset=offset, shape=shape, order='F')
+        try:
+            yield vol
+        finally:
+            vol.flush()
+            del vol
+    else:
+        vol = np.zeros(shape, dtype=dtype, order='F')
+        yield vol
+        with gzip.open(out_file, 'wb') as fo:
+            header.write_to(fo)
+            fo.write(vol.tobytes(order='F'))
+
 SPACE_CODE = {
     'unknown': 0,
     'scanner': 1, 'orig': 1, 'ORIG': 1,
@@ -878,9 +1069,57 @@ def write_afni(prefix, vol, base_img=None):
 
 
 
+# ========== Mesh cache ==========
+# Parsed surface meshes can be cached as *.npy files, which are later opened as (copy-on-write)
+# memmaps instead of parsing text/xml again. The cache is validated by the real path, 
+# mtime and size of the source file. It is disabled unless a cache root is given,
+# see `utils.set_cache_dir()`.
+def _cached_mesh(fname, reader, kind='mesh'):
+    '''
+    Return the arrays (tuple) parsed by reader(fname), from the mesh cache if possible.
+    '''
+    cache_dir = utils.get_cache_dir('mesh')
+    if not cache_dir:
+        return reader(fname)
+    fname = path.realpath(fname)
+    st = os.stat(fname)
+    prefix = path.join(cache_dir, hashlib.md5(f"{fname}:{kind}".encode('utf-8')).hexdigest())
+    try:
+        with open(prefix+'.json', 'r') as fi:
+            meta = json.load(fi)
+        if meta['source'] == fname and meta['mtime_ns'] == st.st_mtime_ns and meta['size'] == st.st_size:
+            return tuple(np.load(f"{prefix}.{k}.npy", mmap_mode='c') for k in range(meta['n_arrays']))
+    except (OSError, ValueError, KeyError):
+        pass
+    arrays = reader(fname)
+    try: # The cache is best effort (e.g., read-only folder)
+        for k, x in enumerate(arrays):
+            def save(temp_file):
+                with open(temp_file, 'wb') as fo:
+                    np.save(fo, x)
+            utils.atomic_save(f"{prefix}.{k}.npy", save)
+        meta = dict(source=fname, mtime_ns=st.st_mtime_ns, size=st.st_size, n_arrays=len(arrays))
+        def save(temp_file):
+            with open(temp_file, 'w') as fo:
+                json.dump(meta, fo)
+        utils.atomic_save(prefix+'.json', save) # Meta data go last, so an incomplete cache is never used
+    except OSError:
+        pass
+    return arrays
+
+
+def clear_mesh_cache():
+    utils.clear_cache('mesh')
+
+
 # ========== AFNI ASC ==========
 def read_asc(fname, dtype=None):
-    '''Read FreeSurfer/SUMA surface (vertices and faces) in *.asc format.'''
+    '''Read FreeSurfer/SUMA surface (vertices and faces) in *.asc format (cached if enabled, see `_cached_mesh`).'''
+    verts, faces = _cached_mesh(fname, _read_asc, kind='asc')
+    return (verts if dtype is None else verts.astype(dtype, copy=False)), faces
+
+
+def _read_asc(fname, dtype=None):
     if dtype is None:
         dtype = float
     with open(fname, 'r') as fin:
@@ -897,20 +1136,36 @@ def read_asc(fname, dtype=None):
 
 def read_patch_asc(fname, dtype=None, index_type='multimap'):
     '''
-    Read FreeSurfer/SUMA patch (noncontiguous vertices and faces) in *.asc format.
-    
+    Read FreeSurfer/SUMA patch (noncontiguous vertices and faces) in *.asc format (cached if enabled, see `_cached_mesh`).
+
     index_type : str
         - "raw" or "array"
         - "map" or "dict"
         - "multimap" or "func"
     '''
+    verts, faces, vidx, fidx = _cached_mesh(fname, _read_patch_asc, kind='patch_asc')
+    if dtype is not None:
+        verts = verts.astype(dtype)
+    n_verts, n_faces = len(verts), len(faces)
+    vmap = {vidx[k]: k for k in range(n_verts)}
+    fmap = {fidx[k]: k for k in range(n_faces)}
+    if index_type in ['raw', 'array']:
+        pass
+    if index_type in ['map', 'dict']:
+        vidx = vmap
+        fidx = fmap
+    elif index_type in ['multimap', 'func']:
+        vidx = lambda K: vmap[K] if np.isscalar(K) else [vmap[k] for k in K]
+        fidx = lambda K: fmap[K] if np.isscalar(K) else [fmap[k] for k in K]
+    return verts, faces, vidx, fidx
+
+
+def _read_patch_asc(fname, dtype=None):
     if dtype is None:
         dtype = float
     with open(fname, 'r') as fin:
         lines = fin.readlines()
     n_verts, n_faces = np.int_(lines[1].split())
-    # verts = np.vstack(map(lambda line: np.float_(line.split()), lines[2:2+n_verts])) # As slow as np.loadtxt()
-    # verts = np.float_(''.join(lines[2:2+n_verts]).split()).reshape(-1,4) # Much faster
     verts = np.fromiter(itertools.chain.from_iterable(
         map(lambda line: line.split()[:3], lines[2+1:2+n_verts*2:2])), dtype=dtype).reshape(-1,3)
     faces = np.fromiter(itertools.chain.from_iterable(
@@ -919,29 +1174,33 @@ def read_patch_asc(fname, dtype=None, index_type='multimap'):
         map(lambda line: line.split('=')[-1:], lines[2:2+n_verts*2:2])), dtype=int)
     fidx = np.fromiter(itertools.chain.from_iterable(
         map(lambda line: line.split('=')[-1:], lines[2+n_verts*2:2+n_verts*2+n_faces*2:2])), dtype=int)
-    vmap = {vidx[k]: k for k in range(n_verts)}
-    fmap = {fidx[k]: k for k in range(n_faces)}
-    if index_type in ['raw', 'array']:
-        pass
-    if index_type in ['map', 'dict']:
-        vidx = vmap
-        fidx = fmap
-    elif index_type in ['multimap', 'func']:
-        vidx = lambda K: vmap[K] if np.isscalar(K) else [vmap[k] for k in K]
-        fidx = lambda K: fmap[K] if np.isscalar(K) else [fmap[k] for k in K]
     return verts, faces, vidx, fidx
 
 
-def write_asc(fname, verts, faces):
+def write_asc(fname, verts, faces, block_size=100000):
+    '''
+    Write FreeSurfer/SUMA surface (vertices and faces) in *.asc format.
+
+    The text is formatted in blocks of `block_size` rows with a single (C-level)
+    string formatting per block, which is several times faster than np.savetxt.
+    See also: freesurfer.write_fs_surf (binary format, much faster and smaller)
+    '''
+    def write_rows(fout, x, row_fmt):
+        for k in range(0, len(x), block_size):
+            block = x[k:k+block_size]
+            fout.write((row_fmt * len(block)) % tuple(block.ravel().tolist()))
     with open(fname, 'wb') as fout: # Binary mode is more compatible with older Python...
         fout.write('#!ascii version of surface mesh saved by mripy\n'.encode('ascii'))
-        np.savetxt(fout, [[len(verts), len(faces)]], fmt='%d')
-        np.savetxt(fout, np.c_[verts, np.zeros(len(verts))], fmt=['%.6f', '%.6f', '%.6f', '%d'])
-        np.savetxt(fout, np.c_[faces, np.zeros(len(faces))], fmt='%d')    
+        fout.write(b'%d %d\n' % (len(verts), len(faces)))
+        write_rows(fout, np.asarray(verts), b'%.6f %.6f %.6f 0\n')
+        write_rows(fout, np.asarray(faces), b'%d %d %d 0\n')
 
 
 # ========== GIFTI ==========
 def read_gii(fname, return_img=False):
+    '''Read GIFTI surface (cached if enabled, see `_cached_mesh`, unless return_img=True).'''
+    if not return_img:
+        return _cached_mesh(fname, lambda fname: read_gii(fname, return_img=True)[:2], kind='gii')
     img = nibabel.load(fname)
     # verts, faces = img.darrays[0].data, img.darrays[1].data
     verts = img.get_arrays_from_intent(nibabel.nifti1.intent_codes['NIFTI_INTENT_POINTSET'])[0].data
@@ -969,7 +1228,20 @@ def read_label(fname):
 # ========== NIML ascii ==========
 NIML_DSET_CORE_TAGS = ['INDEX_LIST', 'SPARSE_DATA']
 
-def read_niml_dset(fname, tags=None, as_asc=True, return_type='list'):
+def read_niml_dset(fname, tags=None, as_asc=False, return_type='list'):
+    '''
+    Read data elements (e.g., INDEX_LIST and SPARSE_DATA) from niml dataset.
+
+    Parameters
+    ----------
+    tags : list
+    as_asc : bool
+        If False (default), the dataset is parsed natively, whatever its ni_form
+        (binary.lsbfirst, binary.msbfirst, base64, or text).
+        If True, the dataset is converted to ascii first via `ConvertDset` (slow).
+    return_type : str
+        'list', 'dict', or 'tree' (xml.etree.Element with data as text)
+    '''
     if tags is None:
         tags = NIML_DSET_CORE_TAGS
     if as_asc:
@@ -982,6 +1254,18 @@ def read_niml_dset(fname, tags=None, as_asc=True, return_type='list'):
             element = root.find(tag)
             return np.fromiter(element.text.split(), dtype=element.get('ni_type'))
         data = {tag: get_data(tag) for tag in tags}
+    elif return_type == 'tree':
+        et, values = niml.parse_niml(fname)
+        root = et.getroot()
+        for element in root.iter():
+            if element.text in values:
+                element.text = niml.format_text_data(values[element.text])
+    else:
+        data = {}
+        for tag, attrs, value in niml.iter_niml(fname, tags=tags):
+            if tag in tags and tag not in data: # Only the first one counts
+                data[tag] = value
+        data = {tag: data.get(tag) for tag in tags}
     if return_type == 'list':
         return [data[tag] for tag in tags]
     elif return_type == 'dict':
@@ -1019,30 +1303,18 @@ def read_niml_dset(fname, tags=None, as_asc=True, return_type='list'):
 def read_niml_bin_nodes(fname):
     '''
     Read "Node Bucket" (node indices and values) from niml (binary) dataset.
+
+    The file is memory-mapped, and the values are returned as a read-only np.memmap,
+    so column subsets (e.g., values[:,:10]) can be read lazily from multi-GB datasets.
     '''
-    with open(fname, 'rb') as fin:
-        s = fin.read()
-        data = []
-        for tag in NIML_DSET_CORE_TAGS:
-            pattern = '<{0}(.*?)>(.*?)</{0}>'.format(tag)
-            match = re.search(bytes(pattern, encoding='utf-8'), s, re.DOTALL)
-            if match is not None:
-                attrs = shlex.split(match.group(1).decode('utf-8')) # Don't split quoted string
-                attrs = dict(attr.split('=') for attr in attrs)
-                if '*' in attrs['ni_type']: # Multi-colume dataset
-                    n, t = attrs['ni_type'].split('*')
-                    attrs['n_columes'] = int(n)
-                    attrs['dtype'] = t+'32'
-                else:
-                    attrs['n_columes'] = int(1)
-                    attrs['dtype'] = attrs['ni_type']+'32'
-                x = np.frombuffer(match.group(2), dtype=attrs['dtype'])
-                data.append(x.reshape(np.int_([attrs['ni_dimen'], attrs['n_columes']])))
-            else:
-                data.append(None)
-        if data[0] is None: # Non-sparse dataset
-            data[0] = np.arange(data[1].shape[0])
-        return data[0].squeeze(), data[1].squeeze()
+    data = {tag: None for tag in NIML_DSET_CORE_TAGS}
+    for tag, attrs, value in niml.iter_niml(fname, tags=NIML_DSET_CORE_TAGS):
+        if data.get(tag, 0) is None: # Only the first one counts
+            data[tag] = value.reshape(len(value), -1) # Multi-colume dataset has ni_type like "300*float"
+    data = [data[tag] for tag in NIML_DSET_CORE_TAGS]
+    if data[0] is None: # Non-sparse dataset
+        data[0] = np.arange(data[1].shape[0])
+    return data[0].squeeze(), data[1].squeeze()
 
 
 # def write_niml_bin_nodes(fname, idx, val):
@@ -1083,9 +1355,36 @@ def read_niml_bin_nodes(fname):
 #         fout.write(b'</AFNI_dataset>\n')
 
 
+NIML_COLMS_TYPES = {'int': 'Node_Index_Label', 'float': 'Generic_Float'}
+
+def _write_niml_dset_header(fout, idx, colms_range, colms_type, ni_type):
+    '''
+    Write everything of a "Node Bucket" niml (binary) dataset up to the binary data of SPARSE_DATA.
+    '''
+    # AFNI_dataset
+    fout.write('<AFNI_dataset dset_type="Node_Bucket" self_idcode="{0}" \
+        ni_form="ni_group">\n'.format(generate_afni_idcode()).encode('utf-8'))
+    # COLMS_RANGE
+    fout.write('<AFNI_atr ni_type="String" ni_dimen="1" atr_name="COLMS_RANGE">\
+        "{0}"</AFNI_atr>\n'.format(colms_range).encode('utf-8'))
+    # COLMS_TYPE
+    fout.write('<AFNI_atr ni_type="String" ni_dimen="1" atr_name="COLMS_TYPE">\
+        "{0}"</AFNI_atr>\n'.format(colms_type).encode('utf-8'))
+    # INDEX_LIST
+    # Important: There should not be any \n after the opening tag for the binary data!
+    fout.write('<INDEX_LIST ni_form="binary.lsbfirst" ni_type="int" ni_dimen="{0}" \
+        data_type="Node_Bucket_node_indices">'.format(len(idx)).encode('utf-8'))
+    fout.write(idx.astype('<i4').tobytes())
+    fout.write(b'</INDEX_LIST>\n')
+    # SPARSE_DATA
+    fout.write('<SPARSE_DATA ni_form="binary.lsbfirst" ni_type="{0}" ni_dimen="{1}" \
+        data_type="Node_Bucket_data">'.format(ni_type, len(idx)).encode('utf-8'))
+
+
 def write_niml_bin_nodes(fname, idx, val):
     '''
     Write "Node Bucket" (node indices and values) as niml (binary) dataset.
+    See also: NimlDsetWriter (for writing columns incrementally)
 
     References
     ----------
@@ -1100,33 +1399,121 @@ def write_niml_bin_nodes(fname, idx, val):
         val = val.T
     n_columes = val.shape[1]
     with open(fname, 'wb') as fout:
-        # AFNI_dataset
-        fout.write('<AFNI_dataset dset_type="Node_Bucket" self_idcode="{0}" \
-            ni_form="ni_group">\n'.format(generate_afni_idcode()).encode('utf-8'))
-        # COLMS_RANGE
         colms_range = ';'.join(['{0} {1} {2} {3}'.format(np.min(val[:,k]), np.max(val[:,k]), 
             idx[np.argmin(val[:,k])], idx[np.argmax(val[:,k])]) for k in range(n_columes)])
-        fout.write('<AFNI_atr ni_type="String" ni_dimen="1" atr_name="COLMS_RANGE">\
-            "{0}"</AFNI_atr>\n'.format(colms_range).encode('utf-8'))
-        # COLMS_TYPE
-        col_types = {'int': 'Node_Index_Label', 'float': 'Generic_Float'}
-        colms_type = ';'.join(['{0}'.format(col_types[get_ni_type(val[:,k])]) for k in range(n_columes)])
-        fout.write('<AFNI_atr ni_type="String" ni_dimen="1" atr_name="COLMS_TYPE">\
-            "{0}"</AFNI_atr>\n'.format(colms_type).encode('utf-8'))
-        # INDEX_LIST
-        # Important: There should not be any \n after the opening tag for the binary data!
-        fout.write('<INDEX_LIST ni_form="binary.lsbfirst" ni_type="int" ni_dimen="{0}" \
-            data_type="Node_Bucket_node_indices">'.format(len(idx)).encode('utf-8'))
-        fout.write(idx.astype('int32').tobytes())
-        fout.write(b'</INDEX_LIST>\n')
-        # SPARSE_DATA
-        fout.write('<SPARSE_DATA ni_form="binary.lsbfirst" ni_type="{0}" ni_dimen="{1}" \
-            data_type="Node_Bucket_data">'.format(get_ni_type(val), len(val)).encode('utf-8'))
+        colms_type = ';'.join(['{0}'.format(NIML_COLMS_TYPES[get_ni_type(val[:,k])]) for k in range(n_columes)])
+        _write_niml_dset_header(fout, idx, colms_range, colms_type, get_ni_type(val))
         fout.write(val.astype(get_ni_type(val[:,0])+'32').tobytes())
         fout.write(b'</SPARSE_DATA>\n')
         fout.write(b'</AFNI_dataset>\n')
 
 
+class NimlDsetWriter(object):
+    '''
+    Write "Node Bucket" niml (binary) dataset incrementally, one block of columns
+    (e.g., a chunk of TRs) at a time, so that surface time series of unbounded
+    length can be written with constant memory.
+
+    SPARSE_DATA is stored node by node (i.e., all columns of a node are contiguous),
+    so appended columns are spooled to a temp file first. On close, the header
+    is written with the final ni_type (number of columns), COLMS_RANGE and COLMS_TYPE,
+    followed by the data transposed block by block.
+
+    >>> with io.NimlDsetWriter('lh.data.niml.dset', nodes) as writer:
+    >>>     for chunk in chunks: # n_nodes x n_TRs_in_chunk
+    >>>         writer.write(chunk)
+    '''
+    def __init__(self, fname, idx, block_size=2**24):
+        self.fname = fname
+        self.idx = np.atleast_1d(np.asarray(idx).squeeze())
+        self.block_size = block_size # Number of data elements to transpose at a time
+        self.ni_type = 'float' # Determined by the first block (int or float), and promoted to float if needed
+        self.dtype = None
+        self.n_columes = 0
+        self.colms_range = []
+        self.colms_type = []
+        self.temp_file = '{0}.{1}.tmp'.format(fname, next(tempfile._get_candidate_names()))
+        self._fo = open(self.temp_file, 'wb')
+
+    def write(self, val):
+        '''
+        Parameters
+        ----------
+        val : array, n_nodes or n_nodes x n_columes
+        '''
+        val = np.asarray(val)
+        if val.ndim == 1:
+            val = val[:,np.newaxis]
+        assert(val.shape[0]==len(self.idx))
+        ni_type = get_ni_type(val[:,0])
+        if self.dtype is None:
+            self.ni_type = ni_type
+            self.dtype = np.dtype(self.ni_type+'32').newbyteorder('<')
+        elif np.result_type(self.dtype, val.dtype).kind != self.dtype.kind: # E.g., float block after int blocks
+            self._promote('float')
+        for k in range(val.shape[1]):
+            self.colms_range.append('{0} {1} {2} {3}'.format(np.min(val[:,k]), np.max(val[:,k]), 
+                self.idx[np.argmin(val[:,k])], self.idx[np.argmax(val[:,k])]))
+            self.colms_type.append(NIML_COLMS_TYPES[self.ni_type])
+        self._fo.write(np.ascontiguousarray(val.T, dtype=self.dtype).tobytes()) # Column by column
+        self.n_columes += val.shape[1]
+
+    def _promote(self, ni_type):
+        '''
+        Convert the columns spooled so far (e.g., int after a float block arrives) in place.
+        int and float have the same itemsize, so the temp file is rewritten block by block.
+        '''
+        dtype = np.dtype(ni_type+'32').newbyteorder('<')
+        self._fo.flush()
+        n = self.n_columes * len(self.idx)
+        if n > 0:
+            spooled = np.memmap(self.temp_file, dtype=self.dtype, mode='r+', shape=(n,))
+            promoted = spooled.view(dtype)
+            for k in range(0, n, self.block_size):
+                promoted[k:k+self.block_size] = spooled[k:k+self.block_size].astype(dtype)
+            promoted.flush()
+            del spooled, promoted
+        self.ni_type, self.dtype = ni_type, dtype
+        self.colms_type = [NIML_COLMS_TYPES[ni_type]] * len(self.colms_type)
+
+    def close(self):
+        if self._fo is None:
+            return
+        self._fo.close()
+        self._fo = None
+        try:
+            n_nodes, n_columes = len(self.idx), self.n_columes
+            ni_type = '{0}*{1}'.format(n_columes, self.ni_type) if n_columes > 1 else self.ni_type
+            with open(self.fname, 'wb') as fout:
+                _write_niml_dset_header(fout, self.idx, ';'.join(self.colms_range), ';'.join(self.colms_type), ni_type)
+                offset = fout.tell()
+                fout.truncate(offset + n_nodes*n_columes*self.dtype.itemsize)
+            if n_nodes*n_columes > 0:
+                spooled = np.memmap(self.temp_file, dtype=self.dtype, mode='r', shape=(n_columes, n_nodes))
+                data = np.memmap(self.fname, dtype=self.dtype, mode='r+', offset=offset, shape=(n_nodes, n_columes))
+                block = max(1, self.block_size // n_columes)
+                for k in range(0, n_nodes, block):
+                    data[k:k+block] = spooled[:,k:k+block].T
+                data.flush()
+                del spooled, data
+            with open(self.fname, 'ab') as fout:
+                fout.write(b'</SPARSE_DATA>\n')
+                fout.write(b'</AFNI_dataset>\n')
+        finally:
+            os.remove(self.temp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else: # Discard the incomplete dataset
+            self._fo.close()
+            self._fo = None
+            os.remove(self.temp_file)
+
+
 def generate_afni_idcode():
     return 'AFN_' + ''.join(random.choice(string.ascii_letters + string.digits) for n in range(22))
 
@@ -1144,7 +1531,7 @@ def write_1D_nodes(fname, idx, val):
         idx = np.arange(len(val))
     formats = dict(int='%d', float='%.6f')
     np.savetxt(fname, np.c_[idx, val], fmt=['%d', formats[get_ni_type(val)]])
-    
+
 
 # ========== Affine matrix (matvec format, or aff12) ==========
 def read_affine(fname, sep=None):
@@ -1194,6 +1581,10 @@ def read_register_dat(fname):
     return mat
 
 
+# Data type -> BRICK_TYPES
+AFNI_BRICK_TYPES = {np.uint8: 0, np.int16: 1, np.float32: 3}
+
+
 class MaskDumper(object):
     def __init__(self, mask_file):
         self.mask_file = mask_file
@@ -1266,15 +1657,38 @@ class Mask(object):
 
     @classmethod
     def from_files(cls, files, combine='union'):
-        mask = cls(files[0])
-        mask.value[:] = 1
-        for k in range(1, len(files)):
-            mask2 = cls(files[k])
-            mask2.value[:] = 2**k
-            if combine == 'union':
-                mask = mask + mask2
-            elif combine == 'intersect':
-                mask = mask * mask2
+        '''
+        The value of the combined mask encodes membership as bit flags,
+        i.e., value & 2**k is nonzero if a voxel is in the k-th mask.
+        '''
+        masks = []
+        for k, f in enumerate(files):
+            mask = cls(f)
+            mask.value = np.full(len(mask.index), 2**k, dtype=np.int64)
+            masks.append(mask)
+        return cls.combine(masks, combine=combine)
+
+    @classmethod
+    def combine(cls, masks, combine='union'):
+        '''
+        Union or intersection of many masks at once, summing their values.
+        This takes one sort for all masks, instead of merging them one by one.
+        '''
+        for m in masks[1:]:
+            assert(masks[0].compatible(m))
+        index = np.concatenate([m.index for m in masks])
+        value = np.concatenate([m._aligned_value() for m in masks])
+        index, inverse, counts = np.unique(index, return_inverse=True, return_counts=True)
+        value = np.bincount(inverse, weights=value, minlength=len(index)).astype(value.dtype)
+        if combine == 'union':
+            selector = slice(None)
+        elif combine == 'intersect':
+            selector = (counts == len(masks))
+        else:
+            raise ValueError(f"** Unknown combine method: '{combine}'")
+        mask = copy.deepcopy(masks[0])
+        mask.index = index[selector]
+        mask.value = value[selector]
         return mask
 
     @classmethod
@@ -1282,11 +1696,12 @@ class Mask(object):
         # Check compatible and disjoint
         for m in masks[1:]:
             assert(masks[0].compatible(m))
-            assert(len(np.intersect1d(masks[0].index, m.index))==0)
-        # Concat index (in that order)
+        index = np.concatenate([m.index for m in masks])
+        assert(len(np.unique(index))==len(index))
+        # Concat index (in that order, so the result is not necessarily sorted)
         mask = copy.deepcopy(masks[0])
-        mask.index = np.concatenate([m.index for m in masks])
-        mask.value = np.concatenate([m.value for m in masks])
+        mask.index = index
+        mask.value = np.concatenate([m._aligned_value() for m in masks])
         return mask
 
     def compatible(self, other):
@@ -1295,26 +1710,55 @@ class Mask(object):
     def __repr__(self):
         return 'Mask ({0} voxels)'.format(len(self.index))
 
+    def _aligned_value(self):
+        '''Value of each voxel in self.index (defaults to 1 if not available)'''
+        if self.value is not None and len(self.value) == len(self.index):
+            return np.asarray(self.value)
+        return np.ones(len(self.index), dtype=int)
+
+    def _is_sorted(self):
+        '''Whether self.index is sorted (memoized for the current index array)'''
+        cached = self.__dict__.get('_sorted_cache')
+        if cached is None or cached[0] is not self.index:
+            index = np.asarray(self.index)
+            cached = (self.index, bool(np.all(index[1:] > index[:-1])))
+            self._sorted_cache = cached
+        return cached[1]
+
+    def _sorted_index(self):
+        return self.index if self._is_sorted() else np.sort(self.index)
+
+    def _isin(self, other):
+        '''
+        Whether each voxel in self.index is also in other.index, via binary search
+        in the sorted index of the other mask (usually already sorted).
+        '''
+        sorted_index = other._sorted_index()
+        if len(sorted_index) == 0:
+            return np.zeros(len(self.index), dtype=bool)
+        pos = np.minimum(np.searchsorted(sorted_index, self.index), len(sorted_index)-1)
+        return sorted_index[pos] == self.index
+
+    def _select(self, selector, inplace=False):
+        '''
+        Select a subset of voxels, keeping value aligned with index.
+        The (shallow) copy shares the geometry, so selecting a few voxels is cheap.
+        '''
+        mask = self if inplace else copy.copy(self)
+        if mask.value is not None and len(mask.value) == len(mask.index):
+            mask.value = mask.value[selector]
+        mask.index = mask.index[selector]
+        return mask
+
     def __add__(self, other):
         '''Mask union. Both masks are assumed to share the same grid.'''
         assert(self.compatible(other))
-        mask = copy.deepcopy(self)
-        mask.index = np.union1d(self.index, other.index)
-        value_dict = {idx: val for idx, val in zip(self.index, self.value)}
-        for idx, val in zip(other.index, other.value):
-            if idx in value_dict:
-                value_dict[idx] += val
-            else:
-                value_dict[idx] = val
-        mask.value = np.array([value_dict[idx] for idx in mask.index])
-        return mask
+        return self.combine([self, other], combine='union')
 
     def __mul__(self, other):
         '''Mask intersection. Both masks are assumed to share the same grid.'''
         assert(self.compatible(other))
-        mask = copy.deepcopy(self)
-        mask.index = np.intersect1d(self.index, other.index)
-        return mask
+        return self._select(self._isin(other))
 
     def __sub__(self, other):
         '''
@@ -1322,36 +1766,80 @@ class Mask(object):
         Both masks are assumed to share the same grid.
         '''
         assert(self.compatible(other))
-        mask = copy.deepcopy(self)
-        mask.index = mask.index[~np.in1d(self.index, other.index, assume_unique=True)]
-        return mask
+        return self._select(~self._isin(other))
 
     def __contains__(self, other):
         assert(self.compatible(other))
-        return np.all(np.in1d(other.index, self.index, assume_unique=True))
+        return np.all(other._isin(self))
 
     def pick(self, selector, inplace=False):
-        mask = self if inplace else copy.deepcopy(self)
-        mask.index = mask.index[selector]
-        return mask
+        return self._select(selector, inplace=inplace)
 
-    def constrain(self, func, return_selector=False, inplace=False):
+    def _xyz(self, index):
+        ijk1 = np.c_[np.unravel_index(index, self.IJK, order='F') + (np.ones_like(index),)]
+        return np.dot(self.MAT, ijk1.T).T # Yes, it is xyz here!
+
+    def _locate_box(self, lower, upper):
+        '''
+        Positions in self.index of the voxels within the ijk bounding box of an xyz box.
+
+        The master grid itself serves as a spatial (bucket) index: candidate voxels are
+        enumerated from the box, and looked up in the sorted index via binary search,
+        so the cost is about O(k log N) instead of O(N) for k voxels in the box.
+        When the box holds more grid cells than the mask has voxels (e.g., a slab
+        through a sparse mask), the mask voxels are scanned against the box instead.
+        '''
+        # Clip the box to the extent of the grid (also to handle infinite bounds)
+        grid = self._xyz(np.ravel_multi_index(np.array(list(itertools.product(*[[0, n-1] for n in self.IJK]))).T, self.IJK, order='F'))
+        lower = np.maximum(lower, grid.min(axis=0))
+        upper = np.minimum(upper, grid.max(axis=0))
+        index = np.asarray(self.index)
+        if np.any(lower > upper) or len(index) == 0:
+            return np.array([], dtype=int)
+        corners = np.array(list(itertools.product(*zip(lower, upper))))
+        inv = math.invert_affine(self.MAT)
+        ijk = np.dot(corners, inv[:,:3].T) + inv[:,3]
+        ijk0 = np.maximum(np.floor(ijk.min(axis=0)-1e-6).astype(int), 0)
+        ijk1 = np.minimum(np.ceil(ijk.max(axis=0)+1e-6).astype(int), self.IJK-1)
+        if np.prod(ijk1 - ijk0 + 1) > len(index):
+            ijk = np.c_[np.unravel_index(index, self.IJK, order='F')]
+            return np.nonzero(np.all((ijk0 <= ijk) & (ijk <= ijk1), axis=1))[0]
+        candidates = np.ravel_multi_index(np.meshgrid(*[np.arange(a, b+1) for a, b in zip(ijk0, ijk1)], indexing='ij'),
+            self.IJK, order='F').ravel()
+        order = None if self._is_sorted() else np.argsort(index)
+        sorted_index = index if order is None else index[order]
+        pos = np.minimum(np.searchsorted(sorted_index, candidates), len(sorted_index)-1)
+        pos = pos[sorted_index[pos] == candidates]
+        return np.sort(pos if order is None else order[pos])
+
+    def constrain(self, func, return_selector=False, inplace=False, bounds=None):
         '''
         Parameters
         ----------
         func : callable
             selector = func(x, y, z) is used to select a subset of self.index
+        bounds : (lower, upper), optional
+            xyz bounding box of the selected voxels. If provided, func is only
+            evaluated for voxels within the bounding box (see `_locate_box`).
         '''
-        ijk1 = np.c_[np.unravel_index(self.index, self.IJK, order='F') + (np.ones_like(self.index),)]
-        xyz = np.dot(self.MAT, ijk1.T).T # Yes, it is xyz here!
-        selector = func(xyz[:,0], xyz[:,1], xyz[:,2])
-        mask = self if inplace else copy.deepcopy(self)
-        mask.index = mask.index[selector]
+        if bounds is None:
+            xyz = self._xyz(self.index)
+            selector = func(xyz[:,0], xyz[:,1], xyz[:,2])
+        else:
+            pos = self._locate_box(*bounds)
+            xyz = self._xyz(self.index[pos])
+            pos = pos[func(xyz[:,0], xyz[:,1], xyz[:,2])]
+            if return_selector:
+                selector = np.zeros(len(self.index), dtype=bool)
+                selector[pos] = True
+            else:
+                selector = pos
+        mask = self._select(selector, inplace=inplace)
         return mask if not return_selector else (mask, selector)
 
     def infer_selector(self, smaller):
         assert(smaller in self)
-        selector = np.in1d(self.index, smaller.index, assume_unique=True)
+        selector = self._isin(smaller)
         return selector
 
     def near(self, x, y, z, r, **kwargs):
@@ -1359,18 +1847,63 @@ class Mask(object):
         if np.isscalar(r):
             r = np.ones(3) * r
         func = (lambda X, Y, Z: ((X-x)/r[0])**2 + ((Y-y)/r[1])**2 + ((Z-z)/r[2])**2 < 1)
-        return self.constrain(func, **kwargs)
+        r = np.abs(r)
+        return self.constrain(func, bounds=(np.r_[x, y, z]-r, np.r_[x, y, z]+r), **kwargs)
 
     def ball(self, c, r, **kwargs):
         # return self.near(*c, r, **kwargs) # For python 2.7 compatibility
         return self.near(c[0], c[1], c[2], r, **kwargs)
 
+    def balls(self, centers, r, return_selector=False):
+        '''
+        Batch version of `ball`.
+
+        All centers are answered by a single k-d tree query over the mask voxels
+        (in coordinates scaled by r), instead of one bounding-box lookup per ball.
+
+        Parameters
+        ----------
+        centers : array, n_centers x 3
+        r : scalar or 3-vector (shared by all centers), or n_centers x 3
+
+        Returns
+        -------
+        masks : list
+            One mask per center (or one (mask, selector) pair if return_selector=True).
+        '''
+        centers = np.atleast_2d(np.asarray(centers, dtype=float))
+        r = np.abs(np.broadcast_to(r if np.ndim(r) == 2 else np.ones(3)*r, centers.shape))
+        if np.all(r == r[:1]): # Shared (possibly anisotropic) radius: unit balls in scaled space
+            scale, radius = r[0], np.ones(len(centers))
+        elif np.all(r == r[:,:1]): # Isotropic radius per center
+            scale, radius = np.ones(3), r[:,0]
+        else: # Per-center anisotropic radii cannot share one scaled tree
+            return [self.near(c[0], c[1], c[2], rr, return_selector=return_selector) for c, rr in zip(centers, r)]
+        xyz = self._xyz(self.index) / scale
+        centers = centers / scale
+        hits = spatial.cKDTree(xyz).query_ball_point(centers, radius)
+        masks = []
+        for c, rr, pos in zip(centers, radius, hits):
+            pos = np.sort(np.asarray(pos, dtype=int))
+            pos = pos[np.sum((xyz[pos]-c)**2, axis=1) < rr**2] # Strict inequality as in `near`
+            mask = self._select(pos)
+            if return_selector:
+                selector = np.zeros(len(self.index), dtype=bool)
+                selector[pos] = True
+                masks.append((mask, selector))
+            else:
+                masks.append(mask)
+        return masks
+
     def cylinder(self, c, r, **kwargs):
         '''The elongated axis is represented as nan'''
         if np.isscalar(r):
             r = np.ones(3) * r
         func = (lambda X, Y, Z: np.nansum(np.c_[((X-c[0])/r[0])**2, ((Y-c[1])/r[1])**2, ((Z-c[2])/r[2])**2], axis=1) < 1)
-        return self.constrain(func, **kwargs)
+        c0, r0 = np.asarray(c, dtype=float), np.abs(r)
+        lower = np.where(np.isnan(c0), -np.inf, c0-r0)
+        upper = np.where(np.isnan(c0), np.inf, c0+r0)
+        return self.constrain(func, bounds=(lower, upper), **kwargs)
 
     def slab(self, x1=None, x2=None, y1=None, y2=None, z1=None, z2=None, **kwargs):
         limits = np.dot(self.MAT, np.c_[np.r_[0,0,0,1], np.r_[self.IJK-1,1]])
@@ -1381,10 +1914,30 @@ class Mask(object):
         z1 = np.min(limits[2,:]) if z1 is None else z1
         z2 = np.max(limits[2,:]) if z2 is None else z2
         func = (lambda X, Y, Z: (x1<X)&(X<x2) & (y1<Y)&(Y<y2) & (z1<Z)&(Z<z2))
-        return self.constrain(func, **kwargs)
+        return self.constrain(func, bounds=(np.r_[x1, y1, z1], np.r_[x2, y2, z2]), **kwargs)
 
-    def dump(self, fname, dtype=None):
+    def dump(self, fname, dtype=None, chunk_size=None):
+        '''
+        Parameters
+        ----------
+        fname : str or list
+            Data file(s), wildcards allowed.
+        dtype : dtype, optional
+            Output data type, e.g., np.float32 to halve the memory of the output.
+        chunk_size : int, optional
+            If specified, stream the data in chunks of `chunk_size` volumes (TRs),
+            and gather only the masked voxels into a preallocated (n_voxels, n_TRs) output.
+            Peak memory is then bounded by the mask size rather than the volume size.
+            Uncompressed *.nii and *.BRIK are memory-mapped, other formats are
+            sliced through nibabel's `dataobj`.
+
+        Returns
+        -------
+        x : array, n_voxels or n_voxels x n_TRs
+        '''
         files = glob.glob(fname) if isinstance(fname, six.string_types) else fname
+        if chunk_size is not None:
+            return self._dump_chunked(files, dtype=dtype, chunk_size=chunk_size)
         # return np.vstack(read_afni(f).T.flat[self.index] for f in files).T.squeeze() # Cannot handle 4D...
         data = []
         for f in files:
@@ -1401,8 +1954,73 @@ class Mask(object):
             data.append(vol.transpose(*T).reshape(np.prod(S[:3]),int(np.prod(S[3:])))[self.index,:])
         return np.hstack(data).squeeze()
 
-    def undump(self, prefix, x, method='nibabel', space=None):
-        if method == 'nibabel': # Much faster
+    def _dump_chunked(self, files, dtype=None, chunk_size=100):
+        imgs = []
+        for f in files:
+            if not (f.endswith('.nii') or f.endswith('.nii.gz') or f[-5:] in ['.HEAD', '.BRIK']):
+                f = f + ('HEAD' if f[-1] == '.' else '.HEAD') # Same as read_afni()
+            imgs.append(nibabel.load(f)) # Only the header is read
+        n_TRs = [int(np.prod(img.shape[3:])) for img in imgs]
+        if dtype is None:
+            # Probe a single voxel to get the data type after scaling (as in the non-streaming mode)
+            dtype = np.result_type(*[np.asanyarray(img.dataobj[(slice(0,1),)*len(img.shape)]) for img in imgs])
+        x = np.empty((len(self.index), sum(n_TRs)), dtype=dtype)
+        offset = 0
+        for img, n_TR in zip(imgs, n_TRs):
+            S = img.shape
+            if np.any(S[:3] != np.asarray(self.IJK)):
+                raise ValueError(f"** Data shape {S[:3]} is incompatible with the mask shape {tuple(self.IJK)}")
+            proxy = img.dataobj
+            n_voxels = int(np.prod(S[:3]))
+            file_like = proxy.file_like
+            if isinstance(file_like, six.string_types) and not file_like.endswith('.gz') and len(S) <= 4:
+                # Only the pages that contain masked voxels are touched
+                mm = np.memmap(file_like, dtype=proxy.dtype, mode='r', offset=proxy.offset, shape=(n_voxels, n_TR), order='F')
+                scaling = getattr(proxy, 'scaling', None) # AFNI: one factor per sub-brick
+                slope, inter = (proxy.slope, proxy.inter) if scaling is None else (1.0, 0.0)
+                for t in range(0, n_TR, chunk_size):
+                    chunk = mm[self.index,t:t+chunk_size]
+                    if scaling is not None:
+                        chunk = chunk * scaling[t:t+chunk_size]
+                    elif slope != 1 or inter != 0:
+                        chunk = chunk * slope + inter
+                    x[:,offset+t:offset+t+chunk.shape[1]] = chunk
+                del mm
+            else:
+                # Compressed data have to be decompressed sequentially anyway
+                proxy = proxy.reshape(S[:3] + (n_TR,))
+                for t in range(0, n_TR, chunk_size):
+                    chunk = np.asanyarray(proxy[...,t:t+chunk_size])
+                    x[:,offset+t:offset+t+chunk.shape[-1]] = chunk.reshape(n_voxels, -1, order='F')[self.index,:]
+            offset += n_TR
+        return x.squeeze()
+
+    def undump(self, prefix, x, method='nibabel', space=None, dtype=None, chunk_size=None):
+        '''
+        Parameters
+        ----------
+        prefix : str
+            *.nii, *.nii.gz, or AFNI prefix (e.g., "dset" or "dset+orig").
+        x : array, n_voxels or n_voxels x n_TRs
+        method : str
+            'native' : scatter x into a preallocated volume (memory-mapped onto
+                *.nii or *.BRIK), and write NIfTI or AFNI BRIK/HEAD directly
+                with the mask geometry, without calling afni.
+            'nibabel' : write NIfTI via nibabel (and 3dcopy for AFNI format), 3D only.
+            '3dUndump' : via afni's 3dUndump.
+        space : int
+            sform_code for NIfTI (default 1, i.e., scanner), or view for AFNI
+            ("+tlrc" for 3 and 4, otherwise "+orig").
+        dtype : dtype, optional
+            Output data type for the native method: np.float32 (default), np.int16
+            (scaled per file for NIfTI, or per sub-brick for AFNI, if necessary), or np.uint8
+            (ValueError for negative values).
+        chunk_size : int, optional
+            Number of TRs to scatter at a time for the native method.
+        '''
+        if method == 'native': # Fastest, and works for 4D data
+            self._undump_native(prefix, x, space=space, dtype=dtype, chunk_size=chunk_size)
+        elif method == 'nibabel': # Much faster
             temp_file = 'tmp.%s.nii' % next(tempfile._get_candidate_names())
             vol = np.zeros(self.IJK) # Don't support int64?？
             assert(self.index.size==x.size)
@@ -1433,6 +2051,83 @@ class Mask(object):
                 '-prefix', prefix, '-overwrite', temp_file])
             os.remove(temp_file)
 
+    def _undump_native(self, prefix, x, space=None, dtype=None, chunk_size=None):
+        x = np.asanyarray(x)
+        if x.ndim == 1:
+            x = x[:,np.newaxis]
+        assert(x.shape[0]==len(self.index))
+        n_voxels, n_TRs = int(np.prod(self.IJK)), x.shape[1]
+        dtype = np.dtype(np.float32 if dtype is None else dtype)
+        if dtype.type not in AFNI_BRICK_TYPES:
+            raise ValueError(f"** Unsupported data type: {dtype}")
+        if chunk_size is None:
+            chunk_size = n_TRs
+        if space is None:
+            space = 1
+        # Scale factors to fit x into an integer type (0 means no scaling, as in BRICK_FLOAT_FACS)
+        facs = np.zeros(n_TRs)
+        if np.issubdtype(dtype, np.unsignedinteger) and x.size > 0 and x.min() < 0:
+            # Scaling cannot help here, and the cast would silently wrap around
+            raise ValueError(f"** Negative values (min = {x.min()}) cannot be stored as {dtype}")
+        if np.issubdtype(dtype, np.integer) and x.size > 0:
+            info = np.iinfo(dtype)
+            if not np.issubdtype(x.dtype, np.integer) or x.min() < info.min or x.max() > info.max:
+                facs = np.abs(x).max(axis=0) / info.max
+        is_nifti = prefix.endswith('.nii') or prefix.endswith('.nii.gz')
+        if is_nifti and np.any(facs):
+            facs[:] = np.max(facs) # A single scl_slope for the whole file
+
+        def scatter(vol):
+            vol = vol.reshape(n_voxels, n_TRs, order='F') # A view into the (memory-mapped) volume
+            for t in range(0, n_TRs, chunk_size):
+                chunk, fac = x[:,t:t+chunk_size], facs[t:t+chunk_size]
+                if np.any(fac):
+                    chunk = np.round(chunk / np.where(fac > 0, fac, 1))
+                vol[self.index,t:t+chunk_size] = chunk
+
+        if is_nifti:
+            mat = np.dot(np.diag([-1,-1, 1]), self.MAT) # AFNI uses DICOM's RAI, but NIFTI uses LPI aka RAS+
+            aff = nibabel.affines.from_matvec(mat[:,:3], mat[:,3])
+            header = nibabel.Nifti1Header()
+            header.set_data_shape(tuple(self.IJK) + ((n_TRs,) if n_TRs > 1 else ()))
+            header.set_data_dtype(dtype)
+            header.set_qform(aff, code=space)
+            header.set_sform(aff, code=space)
+            if np.any(facs):
+                header.set_slope_inter(facs[0], 0)
+            with nifti_volume(prefix, header) as vol:
+                scatter(vol)
+        else:
+            match = re.match(r'(.+)\+(orig|acpc|tlrc)\.?(?:HEAD|BRIK)?$', prefix)
+            prefix, view = (match.group(1), match.group(2)) if match else (prefix, 'tlrc' if space in [3, 4] else 'orig')
+            with open(f"{prefix}+{view}.BRIK", 'wb') as fo:
+                fo.truncate(n_voxels*n_TRs*dtype.itemsize)
+            vol = np.memmap(f"{prefix}+{view}.BRIK", dtype=dtype, mode='r+', shape=(n_voxels, n_TRs), order='F')
+            scatter(vol)
+            # Background voxels are zero
+            stats = np.c_[np.minimum(vol.min(axis=0), 0), np.maximum(vol.max(axis=0), 0)] if n_voxels > len(self.index) \
+                else np.c_[vol.min(axis=0), vol.max(axis=0)]
+            stats = stats * np.where(facs > 0, facs, 1)[:,np.newaxis]
+            vol.flush()
+            del vol
+            ORIENT, ORIGIN, DELTA = afni.affine2attributes(self.MAT)
+            attributes = collections.OrderedDict()
+            attributes['TYPESTRING'] = '3DIM_HEAD_FUNC~'
+            attributes['IDCODE_STRING'] = generate_afni_idcode() + '~'
+            attributes['SCENE_DATA'] = np.r_[['orig', 'acpc', 'tlrc'].index(view), 11, 1, -999, -999, -999, -999, -999] # FUNC_BUCK_TYPE
+            attributes['DATASET_RANK'] = np.r_[3, n_TRs, 0, 0, 0, 0, 0, 0]
+            attributes['DATASET_DIMENSIONS'] = np.r_[self.IJK, 0, 0]
+            attributes['ORIENT_SPECIFIC'] = ORIENT
+            attributes['ORIGIN'] = ORIGIN
+            attributes['DELTA'] = DELTA
+            attributes['IJK_TO_DICOM'] = np.ravel(self.MAT)
+            attributes['IJK_TO_DICOM_REAL'] = np.ravel(self.MAT)
+            attributes['BYTEORDER_STRING'] = 'LSB_FIRST~' if sys.byteorder == 'little' else 'MSB_FIRST~'
+            attributes['BRICK_TYPES'] = np.full(n_TRs, AFNI_BRICK_TYPES[dtype.type])
+            attributes['BRICK_FLOAT_FACS'] = facs
+            attributes['BRICK_STATS'] = stats.ravel()
+            afni.write_head(f"{prefix}+{view}.HEAD", attributes)
+
     @property
     def ijk(self):
         return np.c_[np.unravel_index(self.index, self.IJK, order='F')]
@@ -82,6 +82,25 @@ def read_fs_surf(fname):
         return verts, faces
 
 
+def write_fs_surf(fname, verts, faces, comment='created by mripy'):
+    '''
+    Write FreeSurfer surface mesh binary file (big endian, triangle format).
+
+    Parameters
+    ----------
+    verts : Nx3 float array, [x, y, z]
+    faces : Nx3 int array, [v1, v2, v3]
+    '''
+    magic = 16777214 # TRIANGLE_FILE_MAGIC_NUMBER
+    with open(fname, 'wb') as fo:
+        write_fs_uint24(fo, magic)
+        fo.write(f"{comment}\n\n".encode('utf-8'))
+        write_fs_int32(fo, len(verts))
+        write_fs_int32(fo, len(faces))
+        np.asarray(verts).astype('>f4').tofile(fo)
+        np.asarray(faces).astype('>i4').tofile(fo)
+
+
 def read_fs_patch(fname):
     '''
     Read FreeSurfer surface patch binary file (big endian).
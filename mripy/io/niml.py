@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
-import shlex, uuid, io
-from lxml import etree
+import re, shlex, uuid, io, mmap, base64
+from os import path
 import numpy as np
+from .. import six
 
 # Main specification about NIML: https://afni.nimh.nih.gov/pub/dist/src/niml/NIML_base.html
 
@@ -125,7 +126,7 @@ def parse_data_format(attrs):
         flatten = (fmt['form']=='text')
         fmt['dtype'] = parse_ni_type(attrs['ni_type'], flatten=flatten)
         if 'endian' in fmt:
-            fmt['dtype'].newbyteorder(fmt['endian'])
+            fmt['dtype'] = fmt['dtype'].newbyteorder(fmt['endian'])
         if 'ni_dimen' in attrs:
             fmt['shape'] = tuple(np.int_(attrs['ni_dimen'].split(',')))
         else: # Specification: If ni_dimen is not supplied, then ni_dimen=1 is assumed.
@@ -135,6 +136,46 @@ def parse_data_format(attrs):
     return fmt
 
 
+def parse_text_data(value, fmt):
+    '''
+    Parse text data stream into a numpy array in a vectorized way.
+
+    Assumption: data elements are separated by whitespace (typically one element per line), 
+    and String is surrounded by "".
+    '''
+    dtype = fmt['dtype']
+    if dtype.names is None: # Standard or multiple type (e.g., 3*float)
+        if dtype.base == object:
+            x = np.array(re.findall(r'"(.*?)"', value, re.DOTALL), dtype=object)
+        else:
+            x = np.fromstring(value, dtype=dtype.base, sep=' ')
+        n = fmt['n'] * int(np.prod(dtype.shape))
+        return x[:n].reshape(fmt['shape']+dtype.shape)
+    elif all(dtype.fields[name][0] != object for name in dtype.names): # Numerical compound type
+        x = np.fromstring(value, dtype=float, sep=' ').reshape(-1,len(dtype.names))[:fmt['n']]
+        data = np.empty(len(x), dtype=dtype)
+        for k, name in enumerate(dtype.names):
+            data[name] = x[:,k]
+        return data.reshape(fmt['shape'])
+    else: # Compound type with String
+        pattern = r'\s+'.join([(r'"(.*?)"' if dtype.fields[name][0]==object else r'(\S+)') for name in dtype.names])
+        return np.fromregex(io.StringIO(value), pattern, dtype=dtype)[:fmt['n']].reshape(fmt['shape'])
+
+
+def format_text_data(value):
+    '''
+    Format data (as returned by `parse_data`) into NIML text data stream, one element per line.
+    '''
+    if isinstance(value, six.string_types):
+        return f'"{value}"'
+    quote = lambda x: f'"{x}"' if isinstance(x, six.string_types) else str(x)
+    if value.dtype.names is None:
+        rows = value.reshape(len(value), -1).tolist()
+    else:
+        rows = value.ravel().tolist()
+    return '\n' + ''.join(' '.join(map(quote, row)) + '\n' for row in rows)
+
+
 def parse_data(between, fmt):
     '''
     Parse data stream from between-tag content (can be empty).
@@ -152,29 +193,87 @@ def parse_data(between, fmt):
             # Special treatment for a single String: keep it as a Python str
             value = stripped[1:-1] # Strip quotes, can be empty str
         elif 'ni_type' in fmt: # Text data stream
-            # Assumption: data elements are separated by "\n"
-            try: # Simple array
-                value = np.fromstring(value, dtype=fmt['dtype'], count=fmt['n'], sep='\n')
-            except ValueError: # Structured array
-                # Assumption: String is surrounded by "", and fields are separated by whitespace
-                pattern = '\s+'.join([('"(.+)"' if dt==object else '(.+?)') 
-                    for n, (dt, pos) in fmt['dtype'].fields.items()])
-                value = np.fromregex(io.StringIO(value), pattern, dtype=fmt['dtype'])
+            value = parse_text_data(value, fmt)
         else: # Other text data (I don't think NIML allows this though)
             pass # Text data in its original form (without stripping)
-    elif fmt['form'] == 'binary':
-        # Binary data
-        value = np.frombuffer(between, dtype=fmt['dtype'], count=fmt['n'])
+    else:
+        if fmt['form'] == 'binary':
+            # Binary data
+            buffer = between
+        elif fmt['form'] == 'base64':
+            # base64 data (base64 encoded binary which allows binary data to be encoded 
+            # in a pure text format, at the cost of a 33% expansion in size)
+            buffer = base64.b64decode(between) # Whitespace (e.g., line breaks) is discarded
+        value = np.frombuffer(buffer, dtype=fmt['dtype'], count=fmt['n'])
         # For multiple type like 3*int, the shape of the element is combined into the final array.
         # But for compound type like int,int,int, the element is considered a singleton.
         value = value.reshape(fmt['shape']+value.shape[1:])
-    elif fmt['form'] == 'base64':
-        # base64 data (base64 encoded binary which allows binary data to be encoded 
-        # in a pure text format, at the cost of a 33% expansion in size)
-        raise NotImplementedError
     return value
 
 
+def iter_niml(fname, tags=None):
+    '''
+    Iterate over NIML elements in a memory-mapped file, yielding (tag, attrs, value).
+
+    Element headers are located by scanning the file, but binary data streams are
+    skipped over (according to ni_type and ni_dimen) rather than scanned or read.
+    Binary values are returned as read-only np.memmap with the correct dtype, 
+    byte order and shape, so nothing is read from disk until the data are accessed
+    (e.g., `value[:,:10]` only reads the first 10 columns of a multi-column dset).
+    Group elements (ni_form="ni_group") yield value=None, followed by their children.
+
+    Parameters
+    ----------
+    tags : list, optional
+        Only parse data for elements with these tags (other elements get value=None).
+    '''
+    with open(fname, 'rb') as fi:
+        if path.getsize(fname) == 0:
+            return
+        mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = 0
+            while True:
+                start = mm.find(b'<', pos)
+                if start == -1:
+                    break
+                end = mm.find(b'>', start)
+                within = mm[start+1:end].decode(encoding)
+                pos = end + 1
+                empty = within.endswith('/') # Specification: Empty element's header ends with "/>"
+                items = shlex.split(within) if not empty else shlex.split(within[:-1])
+                if items[0].startswith('/'): # Closing tag
+                    continue
+                tag = items[0]
+                attrs = dict([parse_attr(item) for item in items[1:]])
+                if empty:
+                    yield tag, attrs, None
+                    continue
+                fmt = parse_data_format(attrs)
+                if fmt['form'] == 'ni_group': # Children follow
+                    yield tag, attrs, None
+                    continue
+                if fmt['form'] == 'binary' and 'dtype' in fmt:
+                    # Binary data stream may contain b'<', so skip it according to its length
+                    data_end = pos + fmt['length']
+                else:
+                    data_end = mm.find(b'<', pos)
+                    data_end = len(mm) if data_end == -1 else data_end
+                value = None
+                if tags is None or tag in tags:
+                    if fmt['form'] == 'binary' and 'dtype' in fmt:
+                        if fmt['n'] > 0:
+                            value = np.memmap(fname, dtype=fmt['dtype'], mode='r', offset=pos, shape=fmt['shape'])
+                        else:
+                            value = np.zeros(fmt['shape'], dtype=fmt['dtype'])
+                    else:
+                        value = parse_data(mm[pos:data_end], fmt)
+                yield tag, attrs, value
+                pos = data_end
+        finally:
+            mm.close()
+
+
 def parse_niml(fname):
     '''
     Parse NIML file into Python xml.etree.Element using incremental event-driven parsing.
@@ -183,6 +282,7 @@ def parse_niml(fname):
     -------------
     https://afni.nimh.nih.gov/pub/dist/src/niml/NIML_base.html
     '''
+    from lxml import etree # Only the tree interface needs lxml
     batch_size = 1024
     tb = etree.TreeBuilder()
     generate_key = lambda: uuid.uuid4().hex[:8]
@@ -4,11 +4,13 @@ from __future__ import print_function, division, absolute_import, unicode_litera
 from collections import OrderedDict
 import numpy as np
 from numpy.polynomial import polynomial
-from scipy import stats
-import pandas as pd
-from sklearn import linear_model
 from . import six, utils
 
+# Imported on demand (slow to import)
+stats = utils.lazy_import('scipy.stats')
+pd = utils.lazy_import('pandas')
+linear_model = utils.lazy_import('sklearn.linear_model')
+
 
 def nearest(x, parity='odd', round=np.round):
     if parity == 'even':
@@ -9,18 +9,20 @@ import numpy as np
 from numpy.polynomial import polynomial
 from scipy import stats
 from scipy.ndimage import interpolation
-from sklearn import mixture
-try:
-    import pandas as pd
-except ImportError:
+from . import six, afni, io, utils, dicom, dicom_report, math
+
+# Imported on demand (slow to import)
+mixture = utils.lazy_import('sklearn.mixture')
+if utils.has_module('pandas'):
+    pd = utils.lazy_import('pandas')
+else:
     warnings.warn('Cannot import pandas, which is required for some functions.', ImportWarning)
-import matplotlib.pyplot as plt
-try:
-    import seaborn as sns
-except ImportError:
+plt = utils.lazy_import('matplotlib.pyplot')
+if utils.has_module('seaborn'):
+    sns = utils.lazy_import('seaborn')
+else:
     warnings.warn('Cannot import seaborn, which is required for some functions.', ImportWarning)
-import nibabel
-from . import six, afni, io, utils, dicom, dicom_report, math
+nibabel = utils.lazy_import('nibabel')
 
 
 DEFAULT_JOBS = multiprocessing.cpu_count() * 3 // 4
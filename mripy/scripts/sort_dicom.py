@@ -47,6 +47,8 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--select', default=-1, help='select which study to copy, default: last study (-1)')
     parser.add_argument('--pattern', default=io.SERIES_PATTERN, help='regular expression pattern capturing dataset index')
     parser.add_argument('-m', '--method', default='filename', help='method used to sort dicom files: [filename]|header')
+    parser.add_argument('-e', '--engine', default=io.DEFAULT_DICOM_ENGINE, help='engine used to parse dicom headers: [dicom_hdr]|native')
+    parser.add_argument('-j', '--jobs', dest='n_jobs', type=int, default=1, help='number of processes used by the native engine, default: 1')
     args = parser.parse_args()
     # args, unknowns = parser.parse_known_args()
     if args.output_dir is None:
@@ -65,7 +67,7 @@ if __name__ == '__main__':
     # Sort files into studies of series
     if args.method == 'filename':
         studies = io.sort_dicom_series(args.input_dir)
-        dicom_parser = io.parse_dicom_header
+        dicom_parser = None # Parse headers with args.engine
     elif args.method == 'header':
         print('>> Please wait while extracting headers...')
         studies = dicom.sort_dicom_series(args.input_dir)
@@ -80,8 +82,9 @@ if __name__ == '__main__':
         if args.list and len(studies) > 1:
             print('===== study #{0} ====='.format(k+1))
         for sn, files in study.items():
-            if afni.has_afni:
-                info = io.parse_series_info(files, parser=dicom_parser)
+            if afni.has_afni or args.engine == 'native':
+                info = io.parse_series_info(files, parser=dicom_parser, 
+                    engine=args.engine, n_jobs=args.n_jobs)
                 desc = '{0} ({1}): {2}, {3}{4}'.format(sn,
                     info['n_volumes'] if info['n_volumes']>1 else len(files),
                     info['ProtocolName'],
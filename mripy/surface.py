@@ -1,11 +1,10 @@
     #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
-import os, shutil, ctypes, multiprocessing
+import os, re, shutil, ctypes, multiprocessing, hashlib, collections, warnings, json
 from os import path
-import parser
 from itertools import chain
-from scipy import spatial
+from scipy import spatial, sparse
 import numpy as np
 from . import six, afni, io, utils, _with_pylab
 
@@ -29,35 +28,193 @@ def map_sequence(seq1, seq2):
     return mapper
 
 
-def quadruple_mesh(verts, faces, power=1, mask=None, values=[]):
+def quadruple_mesh(verts, faces, power=1, mask=None, values=[], return_parents=False):
     '''
     A face will be divided if any of its three nodes are within the mask.
+
+    Each divided face is split into four faces by the midpoints of its edges.
+    Original vertices keep their indices, and new vertices are appended in the order
+    their edges are first encountered (faces in order, edges (1,2), (2,0), (0,1)).
+
+    Parameters
+    ----------
+    return_parents : bool
+        If True, also return `parents` (n_verts x 2), i.e., the two end points of the edge
+        whose midpoint is each vertex (or itself twice for the original vertices).
+        With power > 1, parents refer to the vertices of the previous subdivision, 
+        which keep their indices in the final mesh (and are always smaller than the child).
     '''
+    verts = np.asarray(verts)
+    faces = np.asarray(faces)
+    parents = np.repeat(np.arange(len(verts))[:,np.newaxis], 2, axis=1)
     if mask is not None:
-        mask = set(mask)
+        mask = np.unique(mask)
     for _ in range(power):
-        nv = [v for v in verts]
-        nv_parent = {}
-        nf = []
-        def get_new_vert(n1, n2):
-            n_idx = nv_parent.setdefault(tuple(sorted([n1, n2])), len(nv))
-            if n_idx == len(nv):
-                nv.append((verts[n1]+verts[n2])/2)
-            return n_idx
-        for f in faces:
-            if mask is not None and set(f).isdisjoint(mask):
-                # Skip dividing this face
-                nf.append(f)
-            else: # Divide this face into four new faces
-                nv0 = get_new_vert(f[1], f[2])
-                nv1 = get_new_vert(f[2], f[0])
-                nv2 = get_new_vert(f[0], f[1])
-                # The triangle should always list the vertices in a counter-clockwise direction 
-                # with respect to an outward pointing surface normal vector [Noah Benson]
-                nf.extend([(f[0], nv2, nv1), (nv2, f[1], nv0), (nv1, nv0, f[2]), (nv0, nv1, nv2)])
-        verts = nv
+        n_verts = len(verts)
+        divide = np.ones(len(faces), dtype=bool) if mask is None else np.isin(faces, mask).any(axis=1)
+        F = faces[divide]
+        # Unique edges (packed sorted vertex pairs), numbered by first appearance
+        edges = F[:,[1,2,2,0,0,1]].reshape(-1,3,2)
+        keys = np.sort(edges, axis=-1).astype(np.int64)
+        keys = (keys[...,0] * n_verts + keys[...,1]).ravel()
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        nv = (n_verts + rank[inverse]).reshape(-1,3) # nv0, nv1, nv2 for each divided face
+        edge_verts = edges.reshape(-1,2)[first[order]]
+        new_verts = (verts[edge_verts[:,0]] + verts[edge_verts[:,1]]) / 2
+        # The triangle should always list the vertices in a counter-clockwise direction 
+        # with respect to an outward pointing surface normal vector [Noah Benson]
+        f0, f1, f2 = F.T
+        nv0, nv1, nv2 = nv.T
+        sub_faces = np.stack([np.c_[f0, nv2, nv1], np.c_[nv2, f1, nv0], np.c_[nv1, nv0, f2], np.c_[nv0, nv1, nv2]], axis=1)
+        # Keep faces in place (undivided faces once, divided faces as four consecutive faces)
+        counts = np.where(divide, 4, 1)
+        starts = np.cumsum(counts) - counts
+        nf = np.empty((counts.sum(), 3), dtype=faces.dtype)
+        nf[starts[~divide]] = faces[~divide]
+        nf[(starts[divide][:,np.newaxis] + np.arange(4)).ravel()] = sub_faces.reshape(-1,3)
+        # Midpoints of integer verts are promoted to float (float verts keep their precision)
+        dtype = verts.dtype if np.issubdtype(verts.dtype, np.floating) else np.result_type(verts.dtype, float)
+        verts = np.concatenate([verts.astype(dtype, copy=False), new_verts.astype(dtype, copy=False)], axis=0)
         faces = nf
-    return np.array(verts), np.array(faces)
+        parents = np.concatenate([parents, edge_verts], axis=0)
+    return (verts, faces, parents) if return_parents else (verts, faces)
+
+
+# Mesh topology
+TOPOLOGY_CACHE_SIZE = 4 # Number of meshes whose topology is kept in memory
+_topology_cache = collections.OrderedDict() # (n_verts, md5 of faces) -> MeshTopology
+_interp_cache = collections.OrderedDict() # (topology, radius, md5 of indices) -> sparse weights
+_smoother_cache = collections.OrderedDict() # (mesh, fwhm, n_steps, nodes) -> HeatKernelSmoother
+
+class MeshTopology(object):
+    '''
+    Sparse (CSR) topology of a triangular mesh, built from `faces` with numpy.
+
+    Attributes
+    ----------
+    adjacency : scipy.sparse.csr_matrix, n_verts x n_verts, int32
+        adjacency[i,j] == 1 if vertices i and j share an edge (zero diagonal).
+        The (sorted) neighbors of vertex i are adjacency.indices[adjacency.indptr[i]:adjacency.indptr[i+1]].
+    incidence : scipy.sparse.csr_matrix, n_verts x n_faces, int32
+        incidence[i,f] == 1 if vertex i is a corner of face f.
+        E.g., `incidence @ face_areas / 3` attributes face areas to vertices,
+        and `adjacency @ data / degrees` averages data over immediate neighbors.
+    '''
+    def __init__(self, faces, n_verts=None):
+        faces = np.asarray(faces)
+        self.n_verts = int(faces.max()) + 1 if n_verts is None else int(n_verts)
+        self.n_faces = faces.shape[0]
+        # Vertex-face incidence
+        rows = faces.ravel()
+        cols = np.repeat(np.arange(self.n_faces), 3)
+        self.incidence = self._binary_csr(rows, cols, (self.n_verts, self.n_faces))
+        # Vertex adjacency (each edge in both directions)
+        edges = faces[:,[0,1,1,2,2,0]].reshape(-1,2)
+        rows = np.r_[edges[:,0], edges[:,1]]
+        cols = np.r_[edges[:,1], edges[:,0]]
+        keep = (rows != cols) # Degenerate faces
+        self.adjacency = self._binary_csr(rows[keep], cols[keep], (self.n_verts, self.n_verts))
+
+    @staticmethod
+    def _binary_csr(rows, cols, shape):
+        mat = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=shape)
+        mat.sum_duplicates() # Also sort indices
+        mat.data[:] = 1
+        return mat
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} | {self.n_verts} verts, {self.n_faces} faces, {self.adjacency.nnz//2} edges>"
+
+    @property
+    def degrees(self):
+        '''
+        Number of immediate neighbors of each vertex.
+        '''
+        return np.diff(self.adjacency.indptr)
+
+    def neighbors(self, idx):
+        return self.adjacency.indices[self.adjacency.indptr[idx]:self.adjacency.indptr[idx+1]]
+
+    def k_ring(self, k, include_self=True):
+        '''
+        Vertices within k edges of each vertex, as a boolean CSR matrix (n_verts x n_verts),
+        computed by k sparse products (i.e., a breadth-first search from all vertices at once).
+        '''
+        step = (self.adjacency + sparse.identity(self.n_verts, dtype=np.int32, format='csr')).astype(bool)
+        ring = sparse.identity(self.n_verts, dtype=bool, format='csr')
+        for _ in range(k):
+            ring = ring @ step
+        if not include_self:
+            ring.setdiag(False)
+            ring.eliminate_zeros()
+        ring.sort_indices()
+        return ring
+
+    def to_sets(self):
+        '''
+        Neighbors as a list of sets: [set([n00, n01, ...]), set([n10, n11, ...]), ...]
+        '''
+        indptr, indices = self.adjacency.indptr, self.adjacency.indices.tolist()
+        return [set(indices[indptr[k]:indptr[k+1]]) for k in range(self.n_verts)]
+
+    def to_shared_array(self):
+        '''
+        Neighbors as a multiprocessing.Array (lock=False), which is viewed as
+            [[n_nb0+1, n00, n01, ..., 0, 0], [n_nb1+1, n10, n11, ..., 0, 0], ...]
+        '''
+        n_nb = self.degrees
+        shared_arr = multiprocessing.Array(ctypes.c_int32, self.n_verts*(int(n_nb.max())+1), lock=False)
+        arr = np.frombuffer(shared_arr, dtype=np.int32).reshape(self.n_verts,-1)
+        arr[:,0] = n_nb + 1
+        # Column of each neighbor within its row
+        rows = np.repeat(np.arange(self.n_verts), n_nb)
+        cols = np.arange(len(rows)) - self.adjacency.indptr[rows] + 1
+        arr[rows,cols] = self.adjacency.indices
+        return shared_arr
+
+
+def mesh_topology(faces, n_verts=None):
+    '''
+    Return the (cached) MeshTopology of a mesh.
+
+    The cache is keyed by the content of `faces`, so meshes sharing the same
+    triangulation (e.g., white, pial and intermediate surfaces) share the same topology.
+
+    Parameters
+    ----------
+    faces : array, n_faces x 3
+    n_verts : int
+        Default is faces.max()+1.
+    '''
+    faces = np.ascontiguousarray(faces)
+    if n_verts is None:
+        n_verts = int(faces.max()) + 1
+    key = (int(n_verts), _array_key(faces))
+    return _lru_get(_topology_cache, key, lambda: MeshTopology(faces, n_verts=n_verts))
+
+
+def clear_topology_cache():
+    _topology_cache.clear()
+    _interp_cache.clear()
+    _smoother_cache.clear()
+
+
+def _array_key(x):
+    x = np.ascontiguousarray(x)
+    return (x.shape, x.dtype.str, hashlib.md5(x.data).hexdigest())
+
+
+def _lru_get(cache, key, factory, maxsize=TOPOLOGY_CACHE_SIZE):
+    if key in cache:
+        cache.move_to_end(key)
+    else:
+        cache[key] = factory()
+        while len(cache) > maxsize:
+            cache.popitem(last=False)
+    return cache[key]
 
 
 def immediate_neighbors(verts, faces, return_array=False):
@@ -67,39 +224,72 @@ def immediate_neighbors(verts, faces, return_array=False):
     If return_array=True, a numpy array with a special schema is returned
     to facilitate inter-process memory sharing in multiprocessing:
         [[n_nb0+1, n00, n01, ..., 0, 0], [n_nb1+1, n10, n11, ..., 0, 0], ...] 
+
+    See also `mesh_topology()` for the underlying sparse representation,
+    which is more suitable for vectorized computation.
     '''
-    # neighbors = [np.unique(np.r_[faces[faces[:,0]==idx,1:].ravel(), 
-    #     faces[faces[:,1]==idx,::2].ravel(), 
-    #     faces[faces[:,2]==idx,:2].ravel()]) for idx in range(verts.shape[0])]
-    # The above code is unreasonably slow...
-    n_verts = verts.shape[0]
-    neighbors = [set() for _ in range(n_verts)] # Don't use [set()]*n_verts
-    for face in faces:
-        neighbors[face[0]].update(face[1:])
-        neighbors[face[1]].update(face[::2])
-        neighbors[face[2]].update(face[:2])
+    topo = mesh_topology(faces, n_verts=verts.shape[0])
     if return_array: # For shared memory parallelism
-        n_nb = [len(nbhd) for nbhd in neighbors]
-        shared_arr = multiprocessing.Array(ctypes.c_int32, n_verts*(max(n_nb)+1), lock=False)
-        arr = np.frombuffer(shared_arr, dtype=np.int32).reshape(n_verts,-1)
-        for idx in range(n_verts):
-            arr[idx,0] = n_nb[idx] + 1
-            arr[idx,1:arr[idx,0]] = list(neighbors[idx])
-        neighbors = shared_arr
-    return neighbors
+        return topo.to_shared_array()
+    else:
+        return topo.to_sets()
+
+
+def interp_matrix(faces, indices, radius=3, n_verts=None):
+    '''
+    Sparse weights for averaging node data over the k-ring (k=radius) neighborhood
+    of every vertex, so that `W @ values` equals `interp_over_mesh(verts, faces, indices, values, radius)`.
+
+    The matrix is computed once per (mesh, indices, radius) and cached,
+    so interpolating many datasets costs a single sparse mat-vec (or mat-mat) each.
+
+    Parameters
+    ----------
+    faces : array, n_faces x 3
+    indices : array, n_nodes
+        Nodes where data are available.
+    radius : int
+        Number of edges. The vertex itself is included for radius > 1 (but not for radius == 1).
+
+    Returns
+    -------
+    W : scipy.sparse.csr_matrix, n_verts x n_nodes
+        Rows without any available node within the neighborhood are empty.
+    '''
+    faces = np.ascontiguousarray(faces)
+    if n_verts is None:
+        n_verts = int(faces.max()) + 1
+    indices = np.asarray(indices)
+    def compute_weights():
+        topo = mesh_topology(faces, n_verts=n_verts)
+        ring = topo.k_ring(max(radius, 1), include_self=(radius > 1))
+        W = ring[:,indices].astype(float).tocsr()
+        counts = np.diff(W.indptr)
+        W.data /= np.repeat(counts, counts)
+        return W
+    key = (int(n_verts), _array_key(faces), radius, _array_key(indices))
+    return _lru_get(_interp_cache, key, compute_weights)
 
 
 def interp_over_mesh(verts, faces, indices, values, radius=3, neighbors=None, n_verts=None):
     '''
+    Average node values over the k-ring (k=radius) neighborhood of every vertex.
+    `values[k]` is the value at node `indices[k]` (e.g., a partial dataset).
+    By default, this is computed via a cached sparse weight matrix (see `interp_matrix()`),
+    and `values` can also be 2D (n_nodes x n_columns).
+
     By reusing precomputed neighbors (multiprocessing.Array) and n_verts, 
     one can use inter-process memory sharing to efficiently interpolate multiple dsets in parallel.
     verts and faces are unused in this case.
     '''
-    if neighbors is None:
-        neighbors = immediate_neighbors(verts, faces)
     if n_verts is None:
         n_verts = verts.shape[0]
-    indices_set = set(indices)
+    if neighbors is None:
+        W = interp_matrix(faces, indices, radius=radius, n_verts=n_verts)
+        new_val = W @ values
+        new_val[np.diff(W.indptr)==0] = np.nan # Like np.mean([])
+        return new_val
+    position = {nb: k for k, nb in enumerate(indices)} # values are aligned with indices, as in the sparse path
     new_val = np.zeros(n_verts)
     if isinstance(neighbors, ctypes.Array): # For shared memory parallelism
         neighbors = np.frombuffer(neighbors, dtype=np.int32).reshape(n_verts,-1)
@@ -112,7 +302,7 @@ def interp_over_mesh(verts, faces, indices, values, radius=3, neighbors=None, n_
                     ext_nbhd.update(neighbors[nb,1:neighbors[nb,0]])
                 new_nbhd = ext_nbhd.difference(nbhd)
                 nbhd.update(ext_nbhd)
-            new_val[idx] = np.mean([values[nb] for nb in nbhd if nb in indices_set])
+            new_val[idx] = np.mean([values[position[nb]] for nb in nbhd if nb in position])
     else: # neighbors is a list of sets
         for idx in range(n_verts):
             nbhd = neighbors[idx].copy()
@@ -125,22 +315,23 @@ def interp_over_mesh(verts, faces, indices, values, radius=3, neighbors=None, n_
                 nbhd.update(ext_nbhd)
             # new_val[idx] = np.mean(values[np.isin(indices, list(nbhd))])
             # The above code is slow again...
-            new_val[idx] = np.mean([values[nb] for nb in nbhd if nb in indices_set])
+            new_val[idx] = np.mean([values[position[nb]] for nb in nbhd if nb in position])
     return new_val
 
 
-def interp_dset(fdset, fmesh, prefix):
+def interp_dset(fdset, fmesh, prefix, radius=3):
     '''
     `fmesh` can be either:
     - fname for a high density surface mesh
+      (the sparse weights are cached, so interpolating many dsets on the same mesh is cheap)
     - (neighbors, n_verts) for using shared memory parallelism
     '''
     indices, values = io.read_niml_bin_nodes(fdset)
     if isinstance(fmesh, six.string_types):
         verts, faces = io.read_surf_mesh(fmesh)
-        new_val = interp_over_mesh(verts, faces, indices, values)
+        new_val = interp_over_mesh(verts, faces, indices, values, radius=radius)
     else: # fmesh = (neighbors, n_verts), for shared memory parallelism
-        new_val = interp_over_mesh(None, None, indices, values, neighbors=fmesh[0], n_verts=fmesh[1])
+        new_val = interp_over_mesh(None, None, indices, values, radius=radius, neighbors=fmesh[0], n_verts=fmesh[1])
     io.write_niml_bin_nodes(utils.fname_with_ext(prefix, '.niml.dset'), np.arange(new_val.shape[0]), new_val)
 
 
@@ -159,13 +350,14 @@ def surrouding_faces(verts, faces, v):
 
 
 def compute_verts_norm(verts, faces, V):
-    norms = np.zeros([V.shape[0],3], dtype=verts.dtype)
-    for k, v in enumerate(V):
-        F = surrouding_faces(verts, faces, v)
-        n = compute_faces_norm(verts, faces, F)
-        n = np.sum(n, axis=0)
-        n /= np.linalg.norm(n)
-        norms[k,:] = n
+    '''
+    Unit normal at vertices V, i.e., the normalized sum of the (unit) normals of their surrounding faces.
+    '''
+    # Scatter face normals to vertices through the (cached) vertex-face incidence,
+    # instead of scanning all faces for each vertex (O(V*F))
+    incidence = mesh_topology(faces, n_verts=verts.shape[0]).incidence
+    norms = np.asarray(incidence[V] @ compute_faces_norm(verts, faces, faces), dtype=verts.dtype)
+    norms /= np.linalg.norm(norms, axis=1, keepdims=True)
     return norms
     
 
@@ -178,42 +370,128 @@ def compute_verts_area(verts, faces, dtype=None):
     B = verts[faces[:,1],:]
     C = verts[faces[:,2],:]
     face_areas = 0.5*np.linalg.norm(np.cross(B-A, C-A), axis=1)
-    vert_areas = np.zeros(verts.shape[0], dtype=dtype)
     # Attribtue the face area to each of its three vertices
-    # for k, f in enumerate(faces):
-    #     vert_areas[f] += face_areas[k]
-    # vert_areas /= 3.0
-    # The above code with advanced indexing is 2x slower...
-    for (a, b, c), x in zip(faces, face_areas/3.0):
-        vert_areas[a] += x
-        vert_areas[b] += x
-        vert_areas[c] += x
-    return vert_areas
+    # (np.bincount accumulates repeated indices, unlike `vert_areas[f] += x`)
+    vert_areas = np.bincount(faces.ravel(), weights=np.repeat(face_areas/3.0, 3), minlength=verts.shape[0])
+    return vert_areas.astype(dtype, copy=False)
 
 
 def smooth_verts_data(verts, faces, data, factor=0.1, n_iters=1, dtype=None):
+    '''
+    Each iteration mixes `factor` of the mean over neighbors into the data,
+    where a neighbor is counted once for each face it shares with the vertex.
+    '''
+    # shared[a,b] = number of faces shared by vertices a and b
+    incidence = mesh_topology(faces, n_verts=len(data)).incidence
+    shared = (incidence @ incidence.T).tocsr()
+    counts = 2 * shared.diagonal().astype(dtype) # Each face contributes two neighbors
+    shared.setdiag(0)
+    shared.eliminate_zeros()
     for _ in range(n_iters):
-        smooth_data = np.zeros(len(data), dtype=dtype)
-        counts = np.zeros(len(data), dtype=dtype)
-        for a, b, c in faces:
-            smooth_data[a] += data[b] + data[c]
-            smooth_data[b] += data[c] + data[a]
-            smooth_data[c] += data[a] + data[b]
-            counts[a] += 2
-            counts[b] += 2
-            counts[c] += 2
+        smooth_data = (shared @ data).astype(dtype, copy=False)
         smooth_data = factor * smooth_data/counts + (1-factor) * data
         data = smooth_data
     return smooth_data
 
 
-def compute_intermediate_mesh(inner, outer, alpha, method='equivolume', dtype=None):
+def cotangent_laplacian(verts, faces):
+    '''
+    Cotangent stiffness matrix K (symmetric, positive semi-definite, rows sum to zero),
+    so that `-K @ u` approximates the Laplace-Beltrami operator integrated over vertex areas.
+    '''
+    rows, cols, vals = [], [], []
+    for i, j, k in [(0,1,2), (1,2,0), (2,0,1)]:
+        # Angle at k, which is opposite to the edge (i, j)
+        u = verts[faces[:,i]] - verts[faces[:,k]]
+        v = verts[faces[:,j]] - verts[faces[:,k]]
+        cot = np.sum(u*v, axis=1) / np.maximum(np.linalg.norm(np.cross(u, v), axis=1), np.finfo(float).tiny)
+        rows.extend([faces[:,i], faces[:,j]])
+        cols.extend([faces[:,j], faces[:,i]])
+        vals.extend([-cot/2, -cot/2])
+    n_verts = verts.shape[0]
+    W = sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(n_verts, n_verts))
+    return (W - sparse.diags(np.asarray(W.sum(axis=1)).ravel())).tocsr()
+
+
+class HeatKernelSmoother(object):
+    '''
+    Smooth surface data with a heat kernel of a given FWHM (like `SurfSmooth -met HEAT_07 -fwhm`).
+
+    The heat equation du/dt = Laplacian(u) is integrated up to t = fwhm**2 / (16*ln2),
+    when an initial impulse has spread into a Gaussian of the requested FWHM (sigma**2 = 2t).
+    Each of the `n_steps` implicit Euler steps, (M + dt*K) u' = M u, adds exactly 2*dt to the
+    variance of the kernel, where M is the (barycentric) vertex area and K the cotangent stiffness.
+    The system is factorized once, so smoothing many columns (or datasets) only costs
+    sparse triangular solves.
+
+    Unlike `SurfSmooth -target_fwhm`, the FWHM here is that of the applied kernel,
+    not the final smoothness estimated from the data.
+    '''
+    def __init__(self, verts, faces, fwhm, n_steps=10, nodes=None):
+        '''
+        Parameters
+        ----------
+        fwhm : float
+            In the same unit as verts (i.e., mm).
+        nodes : array
+            If provided, smoothing is restricted to these nodes (faces not fully covered are ignored),
+            and data at other nodes are left untouched.
+        '''
+        from scipy.sparse import linalg
+        faces = np.asarray(faces)
+        if nodes is not None:
+            faces = faces[np.all(np.isin(faces, nodes), axis=1)]
+        self.fwhm = fwhm
+        self.n_steps = n_steps
+        self.n_verts = verts.shape[0]
+        dt = fwhm**2 / (16*np.log(2)) / n_steps
+        M = compute_verts_area(verts, faces)
+        self.domain = np.nonzero(M > 0)[0] # Vertices covered by (remaining) faces
+        K = cotangent_laplacian(verts, faces)[self.domain][:,self.domain]
+        self.M = M[self.domain]
+        self.solver = linalg.splu((sparse.diags(self.M) + dt*K).tocsc())
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} | fwhm={self.fwhm}, {len(self.domain)}/{self.n_verts} verts>"
+
+    def __call__(self, data):
+        '''
+        Parameters
+        ----------
+        data : array, n_verts or n_verts x n_columns
+
+        Returns
+        -------
+        smoothed : array, same shape as data
+        '''
+        smoothed = np.array(data, dtype=float)
+        x = smoothed[self.domain]
+        M = self.M.reshape((-1,) + (1,)*(x.ndim-1))
+        for _ in range(self.n_steps):
+            x = self.solver.solve(M * x)
+        smoothed[self.domain] = x
+        return smoothed
+
+
+def heat_kernel_smoother(verts, faces, fwhm, n_steps=10, nodes=None):
+    '''
+    Return a (cached) HeatKernelSmoother, which is precomputed once per mesh and parameters.
+    '''
+    key = (_array_key(verts), _array_key(faces), fwhm, n_steps, None if nodes is None else _array_key(nodes))
+    return _lru_get(_smoother_cache, key, lambda: HeatKernelSmoother(verts, faces, fwhm, n_steps=n_steps, nodes=nodes))
+
+
+def _lamina_weights(inner, outer, alpha, method='equivolume', dtype=None):
+    '''
+    Return rho (n_alphas x n_verts), i.e., the relative position of each intermediate vertex
+    along the inner-to-outer vector, together with inner and outer meshes.
+    '''
     alpha = np.array(alpha, dtype=dtype).reshape(-1, 1)
     vin, fin = io.read_surf_mesh(inner, dtype=dtype) if isinstance(inner, six.string_types) else inner
     vout, fout = io.read_surf_mesh(outer, dtype=dtype) if isinstance(outer, six.string_types) else outer
-    Ain = compute_verts_area(vin, fin, dtype=dtype)
-    Aout = compute_verts_area(vout, fout, dtype=dtype)
     if method in ['equivolume', 'equivolume_inside']:
+        Ain = compute_verts_area(vin, fin, dtype=dtype)
+        Aout = compute_verts_area(vout, fout, dtype=dtype)
         smooth_factor = 0.1
         smooth_iters = 2
         Ain = smooth_verts_data(vin, fin, Ain, factor=smooth_factor, n_iters=smooth_iters, dtype=dtype)
@@ -225,25 +503,41 @@ def compute_intermediate_mesh(inner, outer, alpha, method='equivolume', dtype=No
             inside = ((0 <= alpha) & (alpha <= 1)).ravel()
             rho[inside,:] = 1 / (Aout - Ain) * (-Ain + np.sqrt(alpha[inside,:] * Aout**2 + (1-alpha[inside,:]) * Ain**2))
     elif method == 'equidistance':
-        rho = alpha
+        rho = alpha + np.zeros(len(vin), dtype=dtype)
+    return rho, (vin, fin), (vout, fout)
+
+
+def compute_intermediate_mesh(inner, outer, alpha, method='equivolume', dtype=None):
+    rho, (vin, fin), (vout, fout) = _lamina_weights(inner, outer, alpha, method=method, dtype=dtype)
     verts = (1-rho[...,np.newaxis]) * vin + rho[...,np.newaxis] * vout
     faces = fin
     return verts.squeeze(), faces
 
 
-def compute_voxel_depth(xyz, inner, outer, S2E_mat, method='equivolume', n_jobs=4, dtype=None, lock=None):
+# Depth maps (*.npy) can be cached, keyed by the content of meshes and voxel coordinates.
+# The face-centroid k-d tree is not cached, because loading it is hardly cheaper than building it.
+def compute_voxel_depth(xyz, inner, outer, S2E_mat, method='equivolume', n_jobs=-1, dtype=None, lock=None, cache_dir=None):
     '''
     Parameters
     ----------
     method : str
         "equivolume"
         "equidistance"
+    n_jobs : int
+        Number of workers for the k-d tree query (default -1 for all cores).
+    cache_dir : str
+        Default is the "depth" folder under the shared cache root (see `utils.set_cache_dir()`),
+        which is disabled unless a root is given. Set it to False to disable the cache.
 
     Notes
     -----
     1. Unfortunately, dtype=np.float32 doesn't work for high density surface meshes
        (because the element area becomes zero in some locations, which is invalid). 
        Although it does work for ordinary meshes, it is unnecessary in that case.
+    2. Each voxel is matched (via a single k-d tree query for all voxels) to the closest
+       face centroid among intermediate meshes (from depth -0.2 to 1.2 in steps of 0.1),
+       and its depth is then interpolated from its (signed) distances to the planes of
+       the same face in the adjacent intermediate meshes.
     '''
     if isinstance(xyz, six.string_types):
         xyz = io.Mask(xyz, kind='full').xyz
@@ -255,57 +549,370 @@ def compute_voxel_depth(xyz, inner, outer, S2E_mat, method='equivolume', n_jobs=
         method = 'equivolume_inside'
     if lock is None:
         lock = multiprocessing.Lock()
+    if cache_dir is None:
+        cache_dir = utils.get_cache_dir('depth')
+    inner = io.read_surf_mesh(inner, dtype=dtype) if isinstance(inner, six.string_types) else inner
+    outer = io.read_surf_mesh(outer, dtype=dtype) if isinstance(outer, six.string_types) else outer
+    mesh_key = hashlib.md5(repr((_array_key(inner[0]), _array_key(inner[1]), _array_key(outer[0]), 
+        _array_key(S2E_mat), method, np.dtype(dtype).str)).encode('utf-8')).hexdigest()
+    depth_file = path.join(cache_dir, f"{mesh_key}.{_array_key(xyz)[-1]}.npy") if cache_dir else None
+    if depth_file is not None and path.exists(depth_file):
+        return np.load(depth_file)
     min_depth, max_depth = -0.2, 1.2
     n_depths = round((max_depth - min_depth)/0.1) + 1
     alphas = np.linspace(min_depth, max_depth, n_depths, dtype=dtype)
     print('>> Compute intermediate meshes...')
-    verts, faces = compute_intermediate_mesh(inner, outer, alphas, method=method, dtype=dtype) # 234s
+    verts, faces = compute_intermediate_mesh(inner, outer, alphas, method=method, dtype=dtype)
     n_faces = faces.shape[0]
     LPI2RAI = np.array([-1, -1, 1], dtype=dtype)
-    verts = np.dot(S2E_mat[:,:3], (verts*LPI2RAI).transpose(0,2,1)).transpose(1,2,0) + S2E_mat[:,3]
-    face_xyz = (verts[:,faces[:,0],:] + verts[:,faces[:,1],:] + verts[:,faces[:,2],:]).reshape(-1,3) / 3
+    verts = (verts*LPI2RAI) @ S2E_mat[:,:3].T + S2E_mat[:,3] # n_depths x n_verts x 3
     print('>> Construct k-d tree...')
-    # kdt = spatial.cKDTree(face_xyz.reshape(-1,3)) # 171s
-    kdt = spatial.cKDTree(face_xyz) # This is slightly more memory efficient
-    depths = utils.SharedMemoryArray.zeros(xyz.shape[0], dtype=dtype, lock=False) # np.zeros(xyz.shape[0])
+    face_xyz = (verts[:,faces[:,0],:] + verts[:,faces[:,1],:] + verts[:,faces[:,2],:]).reshape(-1,3) / 3
+    kdt = spatial.cKDTree(face_xyz)
     print('>> Compute cortical depth...')
-    def compute_depth(ids, depths, xyz, kdt, verts, faces, alphas, n_faces, n_depths, min_depth, max_depth):
-        for k in ids:
-            p = xyz[k]
-            # idx = np.argmin(np.linalg.norm(p - face_xyz, axis=-1)) // faces.shape[0]
-            idx = kdt.query(p)[1] # This is like 4000x faster!
-            fidx = idx % n_faces
-            didx = idx // n_faces
-            if didx == 0:
-                depths[k] = min_depth
-            elif didx == n_depths-1:
-                depths[k] = max_depth
-            else:
-                A, B, C = verts[didx-1:didx+2][:,faces[fidx,:],:].swapaxes(0,1)
-                N = np.cross(B - A, C - A)
-                N = N / np.linalg.norm(N, axis=-1, keepdims=True)
-                T = np.sum(A*N, axis=-1) - np.sum(p*N, axis=-1)
-                W = np.abs(T)
-                if T[0]*T[1] < 0:
-                    w = W[1] / (W[0] + W[1])
-                    depths[k] = w * alphas[didx-1] + (1-w) * alphas[didx]
-                else:
-                    w = W[1] / (W[2] + W[1])
-                    depths[k] = w * alphas[didx+1] + (1-w) * alphas[didx]
     with lock:
-        pc = utils.PooledCaller(pool_size=n_jobs)
-        pc(pc.run(compute_depth, ids, depths, xyz, kdt, verts, faces, alphas, n_faces, n_depths, min_depth, max_depth) 
-            for ids in pc.idss(len(depths)))
+        idx = kdt.query(xyz, workers=n_jobs)[1] # All voxels at once
+    fidx = idx % n_faces
+    didx = idx // n_faces
+    depths = np.where(didx == 0, min_depth, max_depth).astype(dtype)
+    inside = np.nonzero((didx > 0) & (didx < n_depths-1))[0]
+    for k in range(0, len(inside), 100000): # In blocks to bound the memory
+        ids = inside[k:k+100000]
+        layers = didx[ids,np.newaxis] + np.array([-1, 0, 1]) # n x 3 (adjacent intermediate meshes)
+        A, B, C = np.moveaxis(verts[layers[:,:,np.newaxis], faces[fidx[ids]][:,np.newaxis,:]], 2, 0) # Each is n x 3 x 3
+        N = np.cross(B - A, C - A)
+        N = N / np.linalg.norm(N, axis=-1, keepdims=True)
+        T = np.sum(A*N, axis=-1) - np.sum(xyz[ids,np.newaxis,:]*N, axis=-1) # Signed distances to the face planes
+        W = np.abs(T)
+        d = didx[ids]
+        lower = (T[:,0]*T[:,1] < 0) # Between the current and the inner (shallower) mesh
+        w = np.where(lower, W[:,1] / (W[:,0] + W[:,1]), W[:,1] / (W[:,2] + W[:,1]))
+        depths[ids] = np.where(lower, w * alphas[d-1] + (1-w) * alphas[d], w * alphas[d+1] + (1-w) * alphas[d])
+    if depth_file is not None:
+        def save(fname):
+            with open(fname, 'wb') as fo:
+                np.save(fo, depths)
+        utils.atomic_save(depth_file, save)
     return depths
 
 
-def create_lamina_mesh(fname, inner, outer, alpha, method='equivolume'):
-    if method == 'equivolume':
-        method = 'equivolume_inside'
-    verts, faces = compute_intermediate_mesh(inner, outer, alpha, method=method)
+def create_lamina_mesh(fname, inner, outer, alpha, method='equivolume', stack=None):
+    '''
+    If a LaminaStack (or its file name) is provided, the layer at `alpha` is read from it
+    instead of being recomputed from inner and outer.
+    '''
+    if stack is not None:
+        verts, faces = (LaminaStack(stack) if isinstance(stack, six.string_types) else stack).layer(alpha)
+    else:
+        if method == 'equivolume':
+            method = 'equivolume_inside'
+        verts, faces = compute_intermediate_mesh(inner, outer, alpha, method=method)
     io.write_surf_mesh(fname, verts, faces)
 
 
+class LaminaStack(object):
+    '''
+    Intermediate (laminar) meshes at multiple cortical depths, stored as a single 
+    memory-mapped stack of vertices (n_depths x n_verts x 3) in "{prefix}.verts.npy",
+    with the shared faces in "{prefix}.faces.npy" and depths in "{prefix}.json".
+
+    Any layer can then be read (e.g., for `VolSurfSampler` or `compute_voxel_depth`)
+    without recomputing vertex areas or parsing text meshes:
+        stack = LaminaStack.create('lh.lamina', 'lh.smoothwm.asc', 'lh.pial.asc', np.linspace(0, 1, 11))
+        verts, faces = stack.layer(0.5)
+        sampler = VolSurfSampler(stack[2], stack[8], MAT, shape)
+    '''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(f"{prefix}.json", 'r') as fi:
+            meta = json.load(fi)
+        self.alphas = np.array(meta['alphas'])
+        self.method = meta['method']
+        self.verts = np.load(f"{prefix}.verts.npy", mmap_mode='r')
+        self.faces = np.load(f"{prefix}.faces.npy", mmap_mode='r')
+
+    @classmethod
+    def create(cls, prefix, inner, outer, alphas, method='equivolume', dtype=np.float64):
+        '''
+        Compute all layers in one vectorized pass (vertex areas are computed only once),
+        and write them directly into the memory-mapped stack file.
+
+        Parameters
+        ----------
+        inner, outer : str or (verts, faces)
+        alphas : array
+            Cortical depths (0 for inner and 1 for outer).
+        method : str
+            "equivolume" (same as "equivolume_inside" here, as in `create_lamina_mesh()`),
+            "equivolume_inside" or "equidistance".
+        dtype : dtype
+            Of the stored vertices. The default (float64) gives the same coordinates as
+            `create_lamina_mesh()` without a stack, and float32 halves the file size.
+        '''
+        if method == 'equivolume':
+            method = 'equivolume_inside'
+        alphas = np.atleast_1d(alphas)
+        rho, (vin, fin), (vout, fout) = _lamina_weights(inner, outer, alphas, method=method)
+        # The json is read first by __init__, so it is removed before and written after the arrays
+        if path.exists(f"{prefix}.json"):
+            os.remove(f"{prefix}.json")
+        def save_verts(fname):
+            verts = np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=rho.shape+(3,))
+            for k in range(len(alphas)): # Bound the memory of intermediate results
+                verts[k] = (1-rho[k,:,np.newaxis]) * vin + rho[k,:,np.newaxis] * vout
+            verts.flush()
+            del verts
+        utils.atomic_save(f"{prefix}.verts.npy", save_verts)
+        def save_faces(fname):
+            with open(fname, 'wb') as fo:
+                np.save(fo, np.asarray(fin))
+        utils.atomic_save(f"{prefix}.faces.npy", save_faces)
+        def save_meta(fname):
+            with open(fname, 'w') as fo:
+                json.dump(dict(alphas=alphas.tolist(), method=method), fo)
+        utils.atomic_save(f"{prefix}.json", save_meta)
+        return cls(prefix)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} | {len(self.alphas)} depths, {self.verts.shape[1]} verts, prefix=\"{self.prefix}\">"
+
+    def __len__(self):
+        return len(self.alphas)
+
+    def __getitem__(self, k):
+        '''
+        Return (verts, faces) of the k-th layer.
+        '''
+        return self.verts[k], self.faces
+
+    def index(self, alpha):
+        matched = np.nonzero(np.isclose(self.alphas, alpha))[0]
+        if len(matched) == 0:
+            raise ValueError(f'** ERROR: Depth {alpha} is not in the stack {self.alphas}')
+        return matched[0]
+
+    def layer(self, alpha):
+        '''
+        Return (verts, faces) of the layer at depth `alpha`.
+        '''
+        return self[self.index(alpha)]
+
+    def write_layer(self, fname, alpha):
+        io.write_surf_mesh(fname, *self.layer(alpha))
+
+
+# Volume-surface sampling
+# The voxel hit by every sampling point can be cached as *.npy,
+# keyed by the content of the meshes and the grid.
+class VolSurfSampler(object):
+    '''
+    Sparse sampling between a volume grid and surface nodes along the segments from
+    an inner (e.g., smoothwm) to an outer (e.g., pial) surface, like 3dVol2Surf/3dSurf2Vol
+    with "-f_steps n_steps -f_index nodes -f_p1_fr depth_range[0] -f_pn_fr depth_range[1]-1".
+
+    The voxel hit by each point is computed once per (surfaces, grid) pair, so that
+    projecting a dataset becomes a single sparse mat-mat (streamed over time chunks).
+
+    Attributes
+    ----------
+    voxels : array, n_nodes x (n_steps+1)
+        Flat (Fortran-order, as in io.Mask) voxel index of each point along each segment
+        (the last column is the midpoint), or -1 if the point is outside the grid.
+    '''
+    def __init__(self, inner, outer, MAT, shape, n_steps=20, depth_range=[0,1], S2E_mat=None, cache_dir=None):
+        '''
+        Parameters
+        ----------
+        inner, outer : str or (verts, faces)
+            Surface meshes with corresponding nodes (in RAS coordinates, as stored by SUMA).
+        MAT : array, 3x4
+            Affine (RAI/DICOM convention) from ijk to xyz of the volume grid, see `afni.get_affine()`.
+        shape : tuple
+            Grid dimensions (only the first three are used).
+        S2E_mat : array, 3x4
+            Optional transform from surface xyz (RAI) to experiment xyz (RAI), see `afni.get_S2E_mat()`.
+        cache_dir : str
+            Default is the "sampler" folder under the shared cache root (see `utils.set_cache_dir()`),
+            which is disabled unless a root is given. Set it to False to disable the cache.
+        '''
+        vin = io.read_surf_mesh(inner)[0] if isinstance(inner, six.string_types) else inner[0]
+        vout = io.read_surf_mesh(outer)[0] if isinstance(outer, six.string_types) else outer[0]
+        assert(vin.shape == vout.shape)
+        self.MAT = np.asarray(MAT, dtype=float)[:3]
+        self.shape = tuple(int(n) for n in shape[:3])
+        self.n_nodes = vin.shape[0]
+        self.n_voxels = int(np.prod(self.shape))
+        self.n_steps = n_steps
+        self.depth_range = depth_range
+        self.S2E_mat = None if S2E_mat is None else np.asarray(S2E_mat, dtype=float)
+        self._matrices = {}
+        if cache_dir is None:
+            cache_dir = utils.get_cache_dir('sampler')
+        if cache_dir:
+            key = hashlib.md5(repr((_array_key(vin), _array_key(vout), _array_key(self.MAT), self.shape,
+                n_steps, list(depth_range), None if S2E_mat is None else _array_key(self.S2E_mat))).encode('utf-8')).hexdigest()
+            fname = path.join(cache_dir, f"{key}.npy")
+            if path.exists(fname):
+                self.voxels = np.load(fname, mmap_mode='r')
+            else:
+                self.voxels = self._compute_voxels(vin, vout)
+                def save(temp_file):
+                    with open(temp_file, 'wb') as fo:
+                        np.save(fo, self.voxels)
+                utils.atomic_save(fname, save)
+        else:
+            self.voxels = self._compute_voxels(vin, vout)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} | {self.n_nodes} nodes, {self.shape} grid, {self.n_steps} steps>"
+
+    def _compute_voxels(self, vin, vout, block_size=100000):
+        fracs = np.r_[np.linspace(self.depth_range[0], self.depth_range[1], self.n_steps), np.mean(self.depth_range)]
+        xyz2ijk = np.linalg.inv(self.MAT[:,:3])
+        voxels = np.zeros((self.n_nodes, len(fracs)), dtype=np.int32 if self.n_voxels < 2**31 else np.int64)
+        for k in range(0, self.n_nodes, block_size):
+            A, B = vin[k:k+block_size], vout[k:k+block_size]
+            xyz = A[:,np.newaxis,:] + fracs[:,np.newaxis] * (B - A)[:,np.newaxis,:]
+            xyz = xyz * [-1, -1, 1] # RAS -> RAI
+            if self.S2E_mat is not None:
+                xyz = xyz @ self.S2E_mat[:,:3].T + self.S2E_mat[:,3]
+            ijk = np.round((xyz - self.MAT[:,3]) @ xyz2ijk.T).astype(int)
+            inside = np.all((ijk >= 0) & (ijk < self.shape), axis=-1)
+            ijk[~inside] = 0
+            voxels[k:k+block_size] = np.where(inside, np.ravel_multi_index(tuple(np.moveaxis(ijk, -1, 0)), self.shape, order='F'), -1)
+        return voxels
+
+    def _points(self, func):
+        return self.voxels[:,-1:] if func == 'midpoint' else self.voxels[:,:-1]
+
+    def matrix(self, func='ave', vol_mask=None):
+        '''
+        Sparse sampling matrix (n_nodes x n_voxels), where each row averages the voxels
+        hit by the points along a segment (a voxel is counted once for each point).
+        Rows without any valid point are empty.
+
+        Parameters
+        ----------
+        func : str
+            'ave' (or 'mean') or 'midpoint'
+        vol_mask : array
+            Optional volume mask (like "-cmask"), and points outside the mask are ignored.
+        '''
+        func = 'ave' if func == 'mean' else func
+        key = (func, None if vol_mask is None else _array_key(np.asarray(vol_mask) != 0))
+        if key not in self._matrices:
+            points = np.asarray(self._points(func))
+            valid = (points >= 0)
+            if vol_mask is not None:
+                valid[valid] = (np.asarray(vol_mask).ravel(order='F') != 0)[points[valid]]
+            rows = np.nonzero(valid)[0]
+            counts = np.bincount(rows, minlength=self.n_nodes)
+            W = sparse.csr_matrix((1/counts[rows], (rows, points[valid])), shape=(self.n_nodes, self.n_voxels))
+            self._matrices[key] = W
+        return self._matrices[key]
+
+    def valid_nodes(self, func='ave', vol_mask=None):
+        '''
+        Nodes with at least one point inside the grid (and the mask).
+        '''
+        return np.diff(self.matrix(func, vol_mask=vol_mask).indptr) > 0
+
+    def vol2surf(self, data, func='ave', vol_mask=None, chunk_size=100, block_size=2**24):
+        '''
+        Parameters
+        ----------
+        data : str or array
+            File name (loaded by nibabel, and read in chunks of time points),
+            or array, x-by-y-by-z(-by-t) or n_voxels(-by-t).
+        func : str
+            'ave' (or 'mean'), 'midpoint' (via the sparse matrix),
+            or 'max', 'min', 'median' (via gathering the points).
+        block_size : int
+            Max number of points (times TRs) gathered at a time for 'max', 'min' and 'median',
+            so that the memory is bounded by block_size float64s, whatever the mesh size.
+
+        Returns
+        -------
+        values : array, n_nodes or n_nodes x n_TRs
+            Nodes without any valid point are zero.
+        '''
+        if isinstance(data, six.string_types):
+            import nibabel
+            data = nibabel.load(data).dataobj # Array proxy, sliced lazily
+        n_TRs = int(np.prod(data.shape[3:])) if len(data.shape) > 3 else (data.shape[1] if len(data.shape) == 2 else 1)
+        values = np.zeros((self.n_nodes, n_TRs))
+        if func not in ['ave', 'mean', 'midpoint']:
+            points = np.asarray(self._points(func))
+            invalid = (points < 0)
+            if vol_mask is not None:
+                invalid[~invalid] = (np.asarray(vol_mask).ravel(order='F') == 0)[points[~invalid]]
+            reducers = {'max': np.nanmax, 'min': np.nanmin, 'median': np.nanmedian}
+            if func not in reducers:
+                raise ValueError(f'** ERROR: Unsupported func "{func}"')
+            reducer = reducers[func]
+        for t in range(0, n_TRs, chunk_size):
+            if len(data.shape) > 3:
+                x = np.asarray(data[...,t:t+chunk_size]).reshape(self.n_voxels, -1, order='F')
+            elif t == 0:
+                x = np.asarray(data).reshape(self.n_voxels, -1, order='F')
+            if func in ['ave', 'mean', 'midpoint']:
+                values[:,t:t+x.shape[1]] = self.matrix(func, vol_mask=vol_mask) @ x
+            else:
+                n_block = max(1, block_size // (points.shape[1] * x.shape[1])) # Nodes per block
+                for k in range(0, self.n_nodes, n_block):
+                    y = x[points[k:k+n_block]].astype(float) # n_block x n_points x n_chunk
+                    y[invalid[k:k+n_block]] = np.nan
+                    with np.errstate(all='ignore'), warnings.catch_warnings():
+                        warnings.simplefilter('ignore', RuntimeWarning) # All-nan slice
+                        values[k:k+n_block,t:t+x.shape[1]] = np.nan_to_num(reducer(y, axis=1), nan=0)
+        return values.squeeze(axis=1) if n_TRs == 1 and len(data.shape) in [1, 3] else values
+
+    def surf2vol(self, values, func='ave'):
+        '''
+        Parameters
+        ----------
+        values : array, n_nodes or n_nodes x n_columns
+        func : str
+            'ave' (or 'mean'): average over all points (from all segments) within a voxel,
+            'count': number of points within a voxel,
+            'max', 'min', 'median': over all points within a voxel.
+
+        Returns
+        -------
+        vol : array, x-by-y-by-z(-by-n_columns)
+            Voxels without any point are zero.
+        '''
+        values = np.asarray(values, dtype=float)
+        x = values.reshape(self.n_nodes, -1)
+        points = np.asarray(self._points('ave'))
+        rows, cols = np.nonzero(points >= 0)
+        # Number of points of each node within each voxel (n_voxels x n_nodes)
+        counts = sparse.csr_matrix((np.ones(len(rows)), (points[rows,cols], rows)), shape=(self.n_voxels, self.n_nodes))
+        n_points = np.asarray(counts.sum(axis=1)).ravel()
+        if func in ['ave', 'mean']:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                vol = np.nan_to_num((counts @ x) / n_points[:,np.newaxis], nan=0)
+        elif func == 'count':
+            vol = np.repeat(n_points[:,np.newaxis], x.shape[1], axis=1)
+        elif func in ['max', 'min']:
+            vol = np.full((self.n_voxels, x.shape[1]), -np.inf if func == 'max' else np.inf)
+            (np.maximum if func == 'max' else np.minimum).at(vol, points[rows,cols], x[rows])
+            vol[n_points==0] = 0
+        elif func == 'median':
+            # Sort the points by voxel (and by value within each voxel for every column),
+            # so that the median of each voxel is read off the middle of its run
+            voxels = points[rows,cols]
+            hit, start, n = np.unique(voxels, return_index=True, return_counts=True)
+            lo, hi = start + (n-1)//2, start + n//2
+            vol = np.zeros((self.n_voxels, x.shape[1]))
+            for k in range(x.shape[1]):
+                y = x[rows,k][np.lexsort((x[rows,k], voxels))]
+                vol[hit,k] = (y[lo] + y[hi]) / 2
+        else:
+            raise ValueError(f'** ERROR: Unsupported func "{func}"')
+        return vol.reshape(self.shape + values.shape[1:], order='F')
+
+
 def transform_mesh(transform, in_file, out_file):
     '''
     Parameters
@@ -368,7 +975,7 @@ def _surface_calc(expr=None, out_file=None, **kwargs):
     Different input dsets are allowed to have different nodes coverage.
     Only values on shared nodes are returned or written.
     '''
-    used = parser.expr(expr).compile().co_names # Parse variables in `expr`
+    used = compile(expr, '<expr>', 'eval').co_names # Parse variables in `expr`
     variables = {}
     shared_nodes = None
     for var, fname in kwargs.items():
@@ -447,6 +1054,7 @@ class Surface(object):
         self.hemis = ['lh', 'rh']
         self.surf_ext = afni.get_surf_type(self.suma_dir)
         self.info = {hemi: io.read_surf_info(f"{self.suma_dir}/{hemi}.inflated{self.surf_ext}") for hemi in self.hemis}
+        self._samplers = {}
 
     def __repr__(self):
         n_verts = f'{self.info["lh"]["n_verts"]}/{self.info["rh"]["n_verts"]} verts'
@@ -456,6 +1064,23 @@ class Surface(object):
     def _get_surf2exp_transform(self, exp_anat):
         pass
 
+    def get_sampler(self, hemi, grid_parent, n_steps=20, depth_range=[0,1]):
+        '''
+        Return a (cached) VolSurfSampler between smoothwm and pial of `hemi` and the grid of `grid_parent`.
+        The alignment stored in surf_vol by @SUMA_AlignToExperiment (ALLINEATE_MATVEC_S2B_000000), if any, is applied.
+        '''
+        grid_file = afni._resolve_header_file(grid_parent)
+        if grid_file is None:
+            raise ValueError(f'** ERROR: engine="native" requires a plain dataset file (without selectors), got "{grid_parent}"')
+        MAT, shape = afni.get_affine(grid_file), afni.get_dims(grid_file)[:3]
+        key = (hemi, _array_key(MAT), tuple(shape), n_steps, tuple(depth_range))
+        if key not in self._samplers:
+            S2E_mat = afni._get_cached_attribute(self.surf_vol, 'ALLINEATE_MATVEC_S2B_000000')
+            self._samplers[key] = VolSurfSampler(f"{self.suma_dir}/{hemi}.smoothwm{self.surf_ext}",
+                f"{self.suma_dir}/{hemi}.pial{self.surf_ext}", MAT, shape, n_steps=n_steps, depth_range=depth_range,
+                S2E_mat=None if S2E_mat is None else S2E_mat.reshape(3,4))
+        return self._samplers[key]
+
     def _get_spherical_coordinates(self, hemi, symmetric=True):
         verts = io.read_surf_mesh(path.join(self.suma_dir, f"{hemi}.sphere.reg{self.surf_ext}"))[0]
         # verts[:,2] sometimes can be greater than 100 or less than -100
@@ -469,7 +1094,7 @@ class Surface(object):
     def to_1D_dset(self, prefix, node_values):
         np.savetxt(f"{prefix}.1D.dset", np.c_[np.arange(len(node_values)), node_values], fmt='%.6f')
 
-    def vol2surf(self, in_file, out_file, func='median', depth_range=[0,1], vol_mask=None, surf_mask=None, truncate=True):
+    def vol2surf(self, in_file, out_file, func='median', depth_range=[0,1], vol_mask=None, surf_mask=None, truncate=True, engine='afni'):
         '''
         Parameters
         ----------
@@ -486,6 +1111,10 @@ class Surface(object):
             If True, vertices whose value is zero will be omitted in the output surface dataset.
             `surface_calc()` will handle such (partial) surface dataset correctly.
             But if you need to use `3dcalc`, set truncate=False and output all vertices.
+        engine : str
+            'afni' : via 3dVol2Surf.
+            'native' : via a cached sparse sampling matrix (see `get_sampler()` and `VolSurfSampler`), 
+                which supports func = ave, midpoint, max, min, median, and niml output only.
 
         About "-f_index nodes"
         ----------------------
@@ -500,30 +1129,41 @@ class Surface(object):
         out_dir, prefix, ext = afni.split_out_file(out_file, split_path=True, trailing_slash=True)
         output_1D = '.1D' in ext
         pc = utils.PooledCaller()
-        for hemi in self.hemis:
-            fo_niml = f"{out_dir}{hemi}.{prefix}.niml.dset"
-            fo_1D = f"{out_dir}{hemi}.{prefix}.1D.dset"
-            out_1D_cmd = f"-out_1D {fo_1D}" if output_1D else ''
-            pc.run(f"3dVol2Surf \
-                -spec {self.specs[hemi]} \
-                -surf_A smoothwm \
-                -surf_B pial \
-                -sv {self.surf_vol} \
-                -grid_parent {in_file} \
-                {mask_cmd} {truncate_cmd} \
-                -map_func {func} \
-                {'-f_steps 20' if func != 'midpoint' else ''} -f_index nodes \
-                -f_p1_fr {depth_range[0]} -f_pn_fr {depth_range[1]-1} \
-                -out_niml {fo_niml} {out_1D_cmd} -overwrite", 
-                _error_pattern='error', _suppress_warning=True)
-        pc.wait()
+        if engine == 'native':
+            if output_1D:
+                raise ValueError('** ERROR: engine="native" only supports *.niml.dset output')
+            mask = None if vol_mask is None else io.read_vol(afni._resolve_header_file(vol_mask))
+            for hemi in self.hemis:
+                fo_niml = f"{out_dir}{hemi}.{prefix}.niml.dset"
+                sampler = self.get_sampler(hemi, in_file, n_steps=(1 if func == 'midpoint' else 20), depth_range=depth_range)
+                values = sampler.vol2surf(afni._resolve_header_file(in_file), func=func, vol_mask=mask)
+                nodes = np.nonzero(sampler.valid_nodes(func, vol_mask=mask))[0] if truncate else np.arange(sampler.n_nodes)
+                io.write_surf_data(fo_niml, nodes, values[nodes])
+        else:
+            for hemi in self.hemis:
+                fo_niml = f"{out_dir}{hemi}.{prefix}.niml.dset"
+                fo_1D = f"{out_dir}{hemi}.{prefix}.1D.dset"
+                out_1D_cmd = f"-out_1D {fo_1D}" if output_1D else ''
+                pc.run(f"3dVol2Surf \
+                    -spec {self.specs[hemi]} \
+                    -surf_A smoothwm \
+                    -surf_B pial \
+                    -sv {self.surf_vol} \
+                    -grid_parent {in_file} \
+                    {mask_cmd} {truncate_cmd} \
+                    -map_func {func} \
+                    {'-f_steps 20' if func != 'midpoint' else ''} -f_index nodes \
+                    -f_p1_fr {depth_range[0]} -f_pn_fr {depth_range[1]-1} \
+                    -out_niml {fo_niml} {out_1D_cmd} -overwrite", 
+                    _error_pattern='error', _suppress_warning=True)
+            pc.wait()
         if surf_mask is not None:
             v = io.read_surf_data(fo_niml)[1]
             expr = {1: 'a*b', 2: 'a*b.reshape(-1,1)'}[v.ndim]
             surface_calc(expr, f"{out_dir}{prefix}.niml.dset", a=f"{out_dir}{prefix}.niml.dset", b=surf_mask)
         return pc._log
 
-    def surf2vol(self, base_file, in_files, out_file, func='median', combine='mean', depth_range=[0,1], mask_file=None):
+    def surf2vol(self, base_file, in_files, out_file, func='median', combine='mean', depth_range=[0,1], mask_file=None, engine='afni'):
         '''
         Parameters
         ----------
@@ -537,6 +1177,10 @@ class Surface(object):
             l+r, max(l,r), consistent, mean, lh, rh, etc.
         mask_file : str
             Volume mask file.
+        engine : str
+            'afni' : via 3dSurf2Vol and 3dcalc.
+            'native' : via a cached sparse sampling matrix (see `get_sampler()` and `VolSurfSampler`),
+                which supports func = ave, count, max, min, median, and combine = consistent, mean, lh, rh.
 
         About "-f_index nodes"
         ----------------------
@@ -546,6 +1190,9 @@ class Surface(object):
             not just the number of node pair segments (-f_index voxels).
         '''
         in_files = afni.infer_surf_dset_variants(in_files, hemis=self.hemis)
+        if engine == 'native':
+            return self._native_surf2vol(base_file, in_files, out_file, func=func, combine=combine, 
+                depth_range=depth_range, mask_file=mask_file)
         mask_cmd = f"-cmask {mask_file}" if mask_file is not None else ''
         temp_dir = utils.temp_folder()
         pc = utils.PooledCaller()
@@ -584,6 +1231,39 @@ class Surface(object):
         shutil.rmtree(temp_dir)
         return pc._log
 
+    def _native_surf2vol(self, base_file, in_files, out_file, func='ave', combine='mean', depth_range=[0,1], mask_file=None):
+        vols = {}
+        for hemi, dset in in_files.items():
+            sampler = self.get_sampler(hemi, base_file, depth_range=depth_range)
+            nodes, values = io.read_surf_data(dset)
+            x = np.zeros((sampler.n_nodes,) + values.shape[1:])
+            x[nodes] = values
+            vols[hemi] = sampler.surf2vol(x, func=func)
+        if len(vols) > 1:
+            l, r = vols['lh'], vols['rh']
+            if combine == 'consistent':
+                vol = np.where(l == 0, r, np.where((r == 0) | (l == r), l, 0))
+            elif combine == 'mean':
+                vol = np.where((l != 0) & (r != 0), (l+r)/2, l+r)
+            elif combine == 'lh':
+                vol = np.where(l != 0, l, r)
+            elif combine == 'rh':
+                vol = np.where(r != 0, r, l)
+            else:
+                raise ValueError(f'** ERROR: Unsupported combine "{combine}" for engine="native"')
+        else:
+            vol = list(vols.values())[0]
+        if mask_file is not None:
+            mask = io.read_vol(afni._resolve_header_file(mask_file))
+            vol = vol * (mask != 0).reshape(mask.shape[:3] + (1,)*(vol.ndim-3))
+        import nibabel
+        base_img = nibabel.load(afni._resolve_header_file(base_file)) # Only the header is read
+        if re.search(r'\.nii(\.gz)?$', out_file):
+            io.write_nii(out_file, vol.astype(np.float32), base_img=base_img)
+        else:
+            io.write_afni(out_file, vol.astype(np.float32), base_img=base_img)
+        return [] # No external jobs, but keep the same return type as engine='afni'
+
     def mask_ribbon(self, in_file, out_file, depth_file=None):
         temp_file = utils.temp_prefix(suffix='.niml.dset')
         pc = utils.PooledCaller()
@@ -608,7 +1288,13 @@ class Surface(object):
         method : str
             - None: factor=0.1, n_iters=1, dtype=None
             - 'SurfSmooth': fwhm is required
+            - 'heat': fwhm is required (n_steps is optional), see `HeatKernelSmoother`.
+              Smoothing is done in-process, and the operator is precomputed once per hemi and reused.
+              Multiple datasets can be smoothed in one call by providing a list of in_files
+              (each a str or dict as above) and a list of out_file of the same length.
         '''
+        if method is not None and method.lower() == 'heat':
+            return self._heat_smooth_surf_data(in_files, out_file, surf_mask=surf_mask, **kwargs)
         in_files = afni.infer_surf_dset_variants(in_files, hemis=self.hemis)
         out_dir, prefix, ext = afni.split_out_file(out_file, split_path=True, trailing_slash=True)
         if surf_mask is not None:
@@ -641,5 +1327,47 @@ class Surface(object):
         pc.wait()
 
 
+    def _heat_smooth_surf_data(self, in_files, out_file, surf_mask=None, fwhm=None, n_steps=10):
+        if fwhm is None:
+            raise ValueError('** ERROR: "fwhm" is required for method="heat"')
+        if isinstance(out_file, six.string_types):
+            in_files, out_file = [in_files], [out_file]
+        assert(len(in_files) == len(out_file))
+        in_files = [afni.infer_surf_dset_variants(f, hemis=self.hemis) for f in in_files]
+        outputs = []
+        for f in out_file:
+            out_dir, prefix, ext = afni.split_out_file(f, split_path=True, trailing_slash=True)
+            outputs.append({hemi: f"{out_dir}{hemi}.{prefix}.niml.dset" for hemi in self.hemis})
+        if surf_mask is not None:
+            surf_mask = afni.infer_surf_dset_variants(surf_mask, hemis=self.hemis)
+        for hemi in self.hemis:
+            dsets = [(f[hemi], o[hemi]) for f, o in zip(in_files, outputs) if hemi in f]
+            if not dsets:
+                continue
+            verts, faces = io.read_surf_mesh(f"{self.suma_dir}/{hemi}.{self.surfs[0]}{self.surf_ext}")
+            data = [io.read_surf_data(dset) for dset, output in dsets]
+            # Datasets covering the same nodes are smoothed together as columns
+            groups = collections.OrderedDict()
+            for k, (nodes, values) in enumerate(data):
+                groups.setdefault(_array_key(nodes), []).append(k)
+            for ks in groups.values():
+                nodes = data[ks[0]][0]
+                if surf_mask is not None:
+                    nm, vm = io.read_surf_data(surf_mask[hemi])
+                    domain = np.intersect1d(nodes, nm[vm!=0]) # Nodes shared by dset and mask
+                else:
+                    domain = nodes
+                smoother = heat_kernel_smoother(verts, faces, fwhm, n_steps=n_steps,
+                    nodes=None if len(domain) == verts.shape[0] else domain)
+                # Scatter (possibly partial) node data into full mesh columns
+                values = [data[k][1].reshape(len(nodes), -1) for k in ks]
+                n_cols = np.cumsum([0] + [v.shape[1] for v in values])
+                x = np.zeros((verts.shape[0], n_cols[-1]))
+                x[nodes] = np.hstack(values)
+                x = smoother(x)[nodes]
+                for m, k in enumerate(ks):
+                    io.write_surf_data(dsets[k][1], nodes, x[:,n_cols[m]:n_cols[m+1]].reshape(data[k][1].shape))
+
+
 if __name__ == '__main__':
     pass
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
-import unittest
+import unittest, tempfile, shutil, os
+from os import path
 import numpy as np
 from mripy import afni, math
 
@@ -35,6 +36,69 @@ class test_afni(unittest.TestCase):
         self.assertEqual(afni.substitute_hemi('roi.rhymic'), 'roi.rhymic') # Non-standalone instance
         self.assertEqual(afni.substitute_hemi('both_V1.lh.niml.roi'), '{0}_V1.{0}.niml.roi') # No consistancy check for multiple instances
 
+    def test_read_header(self):
+        head = '''
+type = integer-attribute
+name = DATASET_RANK
+count = 8
+ 3 2 0 0 0 0 0 0
+
+type = integer-attribute
+name = DATASET_DIMENSIONS
+count = 5
+ 64 48 30 0 0
+
+type = integer-attribute
+name = ORIENT_SPECIFIC
+count = 3
+ 1 2 4
+
+type = float-attribute
+name = ORIGIN
+count = 3
+ 94.5 70.5 -43.5
+
+type = float-attribute
+name = DELTA
+count = 3
+ -3 -3 3
+
+type = string-attribute
+name = BRICK_LABS
+count = 10
+'rest~task~
+
+type = integer-attribute
+name = TAXIS_NUMS
+count = 3
+ 2 30 77001
+
+type = float-attribute
+name = TAXIS_FLOATS
+count = 5
+ 0 2000 0 -43.5 3
+'''
+        folder = tempfile.mkdtemp()
+        fname = path.join(folder, 'dset+orig.HEAD')
+        try:
+            with open(fname, 'w') as fo:
+                fo.write(head)
+            self.assertEqual(afni.get_ORIENT(path.join(folder, 'dset+orig')), 'LPI')
+            np.testing.assert_array_equal(afni.get_dims(fname), [64, 48, 30, 2])
+            np.testing.assert_array_equal(afni.get_head_dims(fname), [64, 48, 30, 2])
+            np.testing.assert_allclose(afni.get_affine(fname), [[-3, 0, 0, 94.5], [0, -3, 0, 70.5], [0, 0, 3, -43.5]])
+            np.testing.assert_allclose(afni.get_head_extents(fname), [-94.5, 94.5, -70.5, 70.5, -43.5, 43.5])
+            self.assertEqual(list(afni.get_brick_labels(fname)), ['rest', 'task'])
+            self.assertEqual(afni.get_attribute(fname, 'BRICK_LABS'), 'rest~task')
+            self.assertEqual(afni.get_TR(fname), 2)
+            # Modified header is re-read
+            with open(fname, 'w') as fo:
+                fo.write(head.replace('-3 -3 3', '-3 -3 3.5'))
+            os.utime(fname, ns=(0, 0))
+            np.testing.assert_allclose(afni.get_DELTA(fname), [-3, -3, 3.5])
+        finally:
+            shutil.rmtree(folder)
+
     def test_get_affine(self):
         mat = afni.get_affine(f"testdata/ASR.nii.gz")
         assert(np.allclose(math.apply_affine(mat, np.reshape([0,0,0], [-1,1])), np.reshape([-88,-145,101], [-1,1]), atol=1))
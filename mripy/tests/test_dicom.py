@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, absolute_import, unicode_literals
+import unittest, tempfile, shutil, struct, zlib, glob, json, os
+from os import path
+import numpy as np
+from mripy import dicom
+
+
+def encode_element(tag, VR, value, explicit=True, endian='<'):
+    '''Encode a data element with Explicit (or Implicit) VR Little (or Big) Endian.'''
+    if len(value) % 2:
+        value += b'\x00' if VR in ['OB', 'UN', 'UI'] else b' '
+    group, element = [int(x, 16) for x in tag.split(',')]
+    if not explicit:
+        return struct.pack(endian+'HHI', group, element, len(value)) + value
+    elif VR in ['OB', 'OW', 'OF', 'SQ', 'UT', 'UN']:
+        return struct.pack(endian+'HH2sHI', group, element, VR.encode(), 0, len(value)) + value
+    else:
+        return struct.pack(endian+'HH2sH', group, element, VR.encode(), len(value)) + value
+
+
+transfer_syntaxes = {(True, '<'): b'1.2.840.10008.1.2.1', (False, '<'): b'1.2.840.10008.1.2', 
+    (True, '>'): b'1.2.840.10008.1.2.2'}
+
+def write_dicom(fname, study=1, series=1, instance=1, acquisition=None, time='120000.000000', pixels=None, 
+    explicit=True, endian='<', extra_elements=()):
+    '''Write a minimal synthetic dicom file (Explicit VR Little Endian by default).'''
+    if acquisition is None:
+        acquisition = instance
+    if pixels is None:
+        pixels = np.zeros([4, 4], dtype=np.uint16)
+    elements = [
+        ('0008,0022', 'DA', b'20180626'),
+        ('0008,0032', 'TM', time.encode()),
+        ('0018,0080', 'DS', b'2000'),
+        ('0018,1030', 'LO', b'synthetic'),
+        ('0019,100A', 'US', struct.pack(endian+'H', 30)),
+        ('0019,1029', 'FD', struct.pack(endian+'d', 2.5)),
+        ('0020,0010', 'SH', str(study).encode()),
+        ('0020,0011', 'IS', str(series).encode()),
+        ('0020,0012', 'IS', str(acquisition).encode()),
+        ('0020,0013', 'IS', str(instance).encode()),
+        ('0028,0010', 'US', struct.pack(endian+'H', pixels.shape[0])),
+        ('0028,0011', 'US', struct.pack(endian+'H', pixels.shape[1])),
+        ('7FE0,0010', 'OW', pixels.astype(endian+'u2').tobytes()),
+    ]
+    elements = sorted(dict((e[0], e) for e in elements + list(extra_elements)).values()) # Extra elements take precedence
+    with open(fname, 'wb') as fo:
+        fo.write(b'\x00'*128 + b'DICM')
+        fo.write(encode_element('0002,0010', 'UI', transfer_syntaxes[(explicit, endian)]))
+        for tag, VR, value in elements:
+            fo.write(encode_element(tag, VR, value, explicit=explicit, endian=endian))
+
+
+def write_dicom_folder(folder, n_series=2, n_files=5):
+    for s in range(1, n_series+1):
+        for k in range(1, n_files+1):
+            write_dicom(path.join(folder, f"test.MR.{s:04d}.{k:04d}.IMA"), series=s, instance=k,
+                time=f"{12+k//3600:02d}{k//60%60:02d}{k%60:02d}.000000")
+
+
+def geometry_elements(position, n_slices=None, slice_times=None):
+    '''Elements describing an axial image (a mosaic if n_slices is given) with 2x3 mm pixels and 4 mm slices.'''
+    elements = [('0018,0050', 'DS', b'4'), ('0018,0088', 'DS', b'4'), 
+        ('0020,0032', 'DS', '\\'.join(map(str, position)).encode()), ('0020,0037', 'DS', b'1\\0\\0\\0\\1\\0'), 
+        ('0028,0030', 'DS', b'2\\3'), ('0028,0100', 'US', struct.pack('<H', 16)), ('0028,0101', 'US', struct.pack('<H', 12)), 
+        ('0028,0103', 'US', struct.pack('<H', 0))]
+    if n_slices is not None:
+        elements += [('0008,0008', 'CS', b'ORIGINAL\\PRIMARY\\M\\MOSAIC'), ('0019,100A', 'US', struct.pack('<H', n_slices)), 
+            ('0019,1029', 'FD', struct.pack(f'<{n_slices}d', *slice_times)), ('0020,4000', 'LT', b'unaliased MB3')]
+    return elements
+
+
+class test_dicom(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        write_dicom_folder(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_parse_dicom_header(self):
+        header = dicom.parse_dicom_header(path.join(self.folder, 'test.MR.0002.0003.IMA'))
+        self.assertEqual(header['StudyID'], 1)
+        self.assertEqual(header['SeriesNumber'], 2)
+        self.assertEqual(header['InstanceNumber'], 3)
+        self.assertEqual(header['ProtocolName'], 'synthetic')
+
+    def test_parse_SQ_data_element(self):
+        fname = path.join(self.folder, 'test.MR.0001.0001.IMA')
+        expected = dicom.parse_dicom_header(fname)
+        # Insert an undefined length SQ containing a nested undefined length SQ
+        item = encode_element('0008,0100', 'SH', b'ABC')
+        undefined = lambda tag, VR: encode_element(tag, VR, b'')[:-4] + b'\xff\xff\xff\xff'
+        item_start = struct.pack('<HHI', 0xFFFE, 0xE000, 0xFFFFFFFF)
+        item_end = struct.pack('<HHI', 0xFFFE, 0xE00D, 0)
+        sq_end = struct.pack('<HHI', 0xFFFE, 0xE0DD, 0)
+        nested = undefined('0040,0260', 'SQ') + item_start + item + item_end + sq_end
+        sq = undefined('0008,1140', 'SQ') + item_start + item + nested + item_end + \
+            struct.pack('<HHI', 0xFFFE, 0xE000, len(item)) + item + sq_end
+        with open(fname, 'rb') as fi:
+            raw = fi.read()
+        pos = raw.index(encode_element('0018,0080', 'DS', b'2000'))
+        with open(fname, 'wb') as fo:
+            fo.write(raw[:pos] + sq + raw[pos:])
+        header = dicom.parse_dicom_header(fname)
+        self.assertEqual(header, expected)
+        # Stop early once all tags of interest are seen
+        header = dicom.parse_dicom_header(fname, search_for_tags={'0008,0032'})
+        self.assertEqual(list(header.keys()), ['TransferSyntaxUID', 'AcquisitionDate', 'AcquisitionTime', 'GRAPPA', 'timestamp', 'filename'])
+
+    def test_transfer_syntaxes(self):
+        fname = path.join(self.folder, 'test.MR.0001.0001.IMA')
+        expected = dicom.parse_dicom_header(fname)
+        del expected['TransferSyntaxUID']
+        self.assertEqual([expected['n_slices'], expected['MosaicRefAcqTimes']], [30, 2.5])
+        for explicit, endian in [(False, '<'), (True, '>')]:
+            write_dicom(fname, time='120001.000000', explicit=explicit, endian=endian)
+            header = dicom.parse_dicom_header(fname)
+            self.assertEqual(header.pop('TransferSyntaxUID'), transfer_syntaxes[(explicit, endian)].decode())
+            self.assertEqual(header, expected)
+        # Deflated Explicit VR Little Endian
+        write_dicom(fname, time='120001.000000')
+        with open(fname, 'rb') as fi:
+            raw = fi.read()
+        meta = encode_element('0002,0010', 'UI', transfer_syntaxes[(True, '<')])
+        pos = raw.index(meta) + len(meta)
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        with open(fname, 'wb') as fo:
+            fo.write(raw[:132] + encode_element('0002,0010', 'UI', b'1.2.840.10008.1.2.1.99'))
+            fo.write(compressor.compress(raw[pos:]) + compressor.flush())
+        header = dicom.parse_dicom_header(fname)
+        self.assertEqual(header.pop('TransferSyntaxUID'), '1.2.840.10008.1.2.1.99')
+        self.assertEqual(header, expected)
+        # Implicit VR without the preamble and File Meta Information
+        write_dicom(fname, time='120001.000000', explicit=False)
+        with open(fname, 'rb') as fi:
+            raw = fi.read()
+        meta = encode_element('0002,0010', 'UI', transfer_syntaxes[(False, '<')])
+        with open(fname, 'wb') as fo:
+            fo.write(raw[raw.index(meta)+len(meta):])
+        self.assertEqual(dicom.parse_dicom_header(fname), expected)
+
+    def test_convert_dicom_series(self):
+        import nibabel
+        data = np.random.RandomState(0).randint(0, 4096, size=(2, 3, 4, 5)).astype(np.uint16) # t, z, rows, columns
+        expected = np.diag([-3., -2., 4., 1.]) # LPS -> RAS
+        expected[:3,3] = [-10, -20, 30]
+        # One slice per file (written in a shuffled slice order)
+        k = 0
+        for t in range(2):
+            for z in [2, 0, 1]:
+                k += 1
+                write_dicom(path.join(self.folder, f"slice.MR.0003.{k:04d}.IMA"), series=3, instance=k, acquisition=t+1, 
+                    time=f"1200{t*2:02d}.{z}00000", pixels=data[t,z], extra_elements=geometry_elements([10, 20, 30+4*z]))
+        files = sorted(glob.glob(path.join(self.folder, 'slice.*.IMA')))
+        for out_file in ['slice.nii', 'slice.nii.gz']:
+            info = dicom.convert_dicom_series(files, path.join(self.folder, out_file))
+            img = nibabel.load(path.join(self.folder, out_file))
+            self.assertEqual(img.get_data_dtype(), np.int16)
+            np.testing.assert_array_equal(np.asarray(img.dataobj), data.transpose(3, 2, 1, 0))
+            np.testing.assert_allclose(img.affine, expected)
+            self.assertEqual(img.header.get_zooms(), (3, 2, 4, 2))
+        np.testing.assert_allclose(info['slice_times'], [0, 0.1, 0.2])
+        # Mosaic (3 slices in 2x2 tiles)
+        for t in range(2):
+            mosaic = np.zeros([8, 10], dtype=np.uint16)
+            for z in range(3):
+                mosaic[z//2*4:(z//2+1)*4,z%2*5:(z%2+1)*5] = data[t,z]
+            # Position of the top left corner of the whole mosaic
+            write_dicom(path.join(self.folder, f"mosaic.MR.0004.{t+1:04d}.IMA"), series=4, instance=t+1, pixels=mosaic, 
+                extra_elements=geometry_elements([10-7.5, 20-4, 30], n_slices=3, slice_times=[0, 1000, 500]))
+        files = sorted(glob.glob(path.join(self.folder, 'mosaic.*.IMA')))
+        info = dicom.convert_dicom_series(files, path.join(self.folder, 'mosaic.nii'))
+        img = nibabel.load(path.join(self.folder, 'mosaic.nii'))
+        np.testing.assert_array_equal(np.asarray(img.dataobj), data.transpose(3, 2, 1, 0))
+        np.testing.assert_allclose(img.affine, expected)
+        with open(path.join(self.folder, 'mosaic.json')) as fi:
+            sidecar = json.load(fi)
+        self.assertEqual(sidecar['SliceTiming'], [0, 1, 0.5])
+        self.assertEqual(sidecar['MultibandAccelerationFactor'], 3)
+
+    def test_sort_dicom_series(self):
+        studies = dicom.sort_dicom_series(self.folder)
+        self.assertEqual(list(studies[0].keys()), ['0001', '0002'])
+        self.assertEqual(studies[0]['0002'][0], 'test.MR.0002.0001.IMA')
+
+    def test_DicomIndex(self):
+        index = dicom.DicomIndex.for_folder(self.folder)
+        studies = dicom.sort_dicom_series(self.folder, index=index)
+        self.assertEqual(len(index), 10)
+        self.assertEqual(studies, dicom.sort_dicom_series(self.folder))
+        # Cached headers are returned without parsing
+        files = sorted(path.join(self.folder, f) for f in studies[0]['0001'])
+        parsed = []
+        def parser(f, **kwargs):
+            parsed.append(f)
+            return dicom.parse_dicom_header(f, **kwargs)
+        index.parse(files, search_for_tags={'0020,0011'}, parser=parser) # Indexed separately for another parser
+        self.assertEqual(len(parsed), 5)
+        self.assertEqual(len(index), 15)
+        index.parse(files, search_for_tags={'0020,0011'}, parser=parser)
+        self.assertEqual(len(parsed), 5)
+        # Requiring more tags or changing the file triggers re-parsing
+        info = dicom.parse_series_info(files, parser=parser, index=index)
+        self.assertEqual(len(parsed), 10)
+        self.assertEqual(info['n_volumes'], 5)
+        write_dicom(files[0], series=1, instance=1, time='115959.000000')
+        os.utime(files[0], ns=(0, 0))
+        info = dicom.parse_series_info(files, parser=parser, index=index)
+        self.assertEqual(len(parsed), 11)
+        self.assertEqual(info['first'], info['timestamp'])
+        # Custom parsers without `search_for_tags` are called as parser(f)
+        info = dicom.parse_series_info(files, parser=lambda f: dicom.parse_dicom_header(f))
+        self.assertEqual(info['n_volumes'], 5)
+        # Queries are answered without opening any dicom file
+        self.assertEqual(len(index.query(SeriesNumber=2)), 5)
+        index.close()
+        # An index opened from its filename (or True) is closed when done
+        self.assertEqual(dicom.sort_dicom_series(self.folder, index=True), studies)
+        with dicom.open_index(True, self.folder) as opened:
+            self.assertEqual(len(opened), 15)
+        self.assertRaises(dicom.sqlite3.ProgrammingError, len, opened)
+
+
+if __name__ == '__main__':
+    unittest.main()
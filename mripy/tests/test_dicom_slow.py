@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, absolute_import, unicode_literals
+import unittest, tempfile, shutil, glob, time, multiprocessing
+from os import path
+from mripy import dicom
+try:
+    from .test_dicom import write_dicom_folder # If mripy is importable: python -m mripy.tests.test_dicom_slow
+except ImportError: # Attempted relative import in non-package
+    from test_dicom import write_dicom_folder # If not importable: cd mripy/tests; python -m test_dicom_slow
+
+
+class test_dicom(unittest.TestCase):
+    def test_parse_dicom_headers_scaling(self):
+        '''
+        Benchmark parallel header scanning on a synthetic folder of dicom files
+        '''
+        folder = tempfile.mkdtemp()
+        try:
+            write_dicom_folder(folder, n_series=20, n_files=500)
+            files = sorted(glob.glob(path.join(folder, '*.IMA')))
+            tags = {'0020,0010', '0020,0011', '0020,0013'}
+            n_cores = multiprocessing.cpu_count()
+            expected, serial_rate = None, None
+            for n_jobs in [1, 2, 4, 8]:
+                start_time = time.time()
+                headers = dicom.parse_dicom_headers(files, search_for_tags=tags, n_jobs=n_jobs)
+                duration = time.time() - start_time
+                rate = len(files)/duration
+                print(f'>> n_jobs={n_jobs}: {len(files)} files parsed in {duration:.3f} sec ({rate:.0f} files/sec)')
+                # Results are merged deterministically
+                if expected is None:
+                    expected, serial_rate = headers, rate
+                self.assertEqual([h['filename'] for h in headers], [h['filename'] for h in expected])
+                self.assertEqual([h['InstanceNumber'] for h in headers], [h['InstanceNumber'] for h in expected])
+                # Throughput scales with the number of available cores (with generous margin for process startup)
+                if 1 < n_jobs <= n_cores:
+                    self.assertGreater(rate, serial_rate * n_jobs * 0.5)
+            if n_cores < 2:
+                print('>> Parallel throughput is not checked with a single core')
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, absolute_import, unicode_literals
+import unittest, subprocess, sys, re, os
+from os import path
+
+
+package_root = path.dirname(path.dirname(path.dirname(path.abspath(__file__))))
+IMPORT_BUDGET = 0.5 # sec
+
+def import_time(module, repeat=3):
+    '''
+    Cumulative import time (in a fresh interpreter) as reported by `python -X importtime`
+    '''
+    times = []
+    for k in range(repeat):
+        res = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], cwd=package_root,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stderr.decode('utf-8')
+        match = re.search(r'import time:\s+\d+\s+\|\s+(\d+)\s+\|\s+' + re.escape(module) + r'\s*$', res, re.MULTILINE)
+        times.append(int(match.group(1))/1e6)
+    return min(times)
+
+
+class test_import(unittest.TestCase):
+    def test_import_time(self):
+        '''
+        Benchmark the startup cost of short-lived batch jobs
+        '''
+        for module in ['mripy.io', 'mripy.dicom', 'mripy.afni']:
+            duration = import_time(module)
+            print(f'>> import {module}: {duration*1000:.0f} ms')
+        self.assertLess(import_time('mripy.io'), IMPORT_BUDGET)
+
+    def test_lazy_imports(self):
+        '''
+        Heavy dependencies (and afni) are not touched by `import mripy.io`
+        '''
+        env = dict(os.environ, PATH='') # No afni on PATH
+        res = subprocess.run([sys.executable, '-c', "import sys, mripy.io, mripy.afni; "
+            "print(' '.join(m for m in ['matplotlib', 'seaborn', 'sklearn', 'pandas', 'tables', 'deepdish'] if m in sys.modules)); "
+            "print(mripy.afni.has_afni)"], cwd=package_root, env=env, stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+        self.assertEqual(res.split('\n')[:2], ['', 'False'])
+
+
+if __name__ == '__main__':
+    unittest.main()
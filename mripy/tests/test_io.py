@@ -7,14 +7,285 @@ try:
     from .context import data_dir # If mripy is importable: python -m mripy.tests.test_io
 except ValueError: # Attempted relative import in non-package
     from context import data_dir # If not importable: cd mripy/tests; python -m test_io
-from mripy import io
+from mripy import io, utils
 
 from os import path
-import os, glob, subprocess
+import os, glob, subprocess, tempfile, shutil, base64
 import numpy as np
+try:
+    from .test_dicom import write_dicom
+except ImportError:
+    from test_dicom import write_dicom
 
 
 class test_io(unittest.TestCase):
+    def test_parse_dicom_header_native(self):
+        folder = tempfile.mkdtemp()
+        extra_elements = [('0018,0020', 'CS', b'EP'), ('0018,0021', 'CS', b'SK\\SS'), ('0018,0023', 'CS', b'2D'), 
+            ('0018,0050', 'DS', b'1.2'), ('0018,0081', 'DS', b'25'), ('0018,0084', 'DS', b'297.2'), 
+            ('0018,0086', 'IS', b'1'), ('0018,0087', 'DS', b'7'), ('0018,0095', 'DS', b'1562'), 
+            ('0018,1314', 'DS', b'70'), ('0018,1316', 'DS', b'0.5'), ('0028,0030', 'DS', b'1.2\\1.2'), 
+            ('0051,1011', 'SH', b'p3')]
+        try:
+            for k in range(1, 4):
+                write_dicom(path.join(folder, f"test.MR.0001.{k:04d}.IMA"), instance=k, 
+                    time=f"1200{k:02d}.500000", extra_elements=extra_elements)
+            fname = path.join(folder, 'test.MR.0001.0002.IMA')
+            header = io.parse_dicom_header(fname, engine='native')
+            self.assertEqual(list(header.keys()), ['AcquisitionDate', 'AcquisitionTime', 'timestamp', 'sequence_type', 
+                'resolution', 'RepetitionTime', 'TE', 'Larmor', 'EchoNumber', 'B0', 'BW', 'ProtocolName', 'FlipAngle', 
+                'SAR', 'n_slices', 'StudyID', 'SeriesNumber', 'AcquisitionNumber', 'InstanceNumber', 'iPAT', 'gamma'])
+            self.assertEqual(header['AcquisitionTime'], '120002.500000')
+            self.assertEqual(header['timestamp'], io.hms2dt('120002.500000', date='20180626', timestamp=True))
+            self.assertEqual(header['sequence_type'], '2D SK\\SS EP')
+            self.assertEqual(header['resolution'], [1.2, 1.2, 1.2])
+            self.assertEqual(header['iPAT'], 'p3')
+            # Batch mode
+            headers = io.parse_dicom_headers(sorted(glob.glob(path.join(folder, '*.IMA'))), engine='native')
+            self.assertEqual(headers[1], header)
+            self.assertEqual(list(io.sort_dicom_series(folder, engine='native')[0].keys()), ['0001'])
+            info = io.parse_series_info(fname, timestamp=True, engine='native')
+            self.assertEqual(info['n_volumes'], 3)
+            assert_allclose(info['TR'], 1)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_read_niml_bin_nodes(self):
+        folder = tempfile.mkdtemp()
+        try:
+            fname = path.join(folder, 'data.niml.dset')
+            idx = np.arange(0, 120, 2) + 60 # b'<' == 60 in the binary stream
+            val = np.random.rand(60,7).astype('float32')
+            io.write_niml_bin_nodes(fname, idx, val)
+            nodes, values = io.read_niml_bin_nodes(fname)
+            assert_allclose(nodes, idx)
+            assert_allclose(values, val)
+            assert_allclose(values[:,2:4], val[:,2:4])
+            # Big endian (binary.msbfirst)
+            with open(fname, 'wb') as fo:
+                fo.write(b'<AFNI_dataset dset_type="Node_Bucket" ni_form="ni_group">\n')
+                fo.write(b'<INDEX_LIST ni_form="binary.msbfirst" ni_type="int" ni_dimen="60">' + idx.astype('>i4').tobytes() + b'</INDEX_LIST>\n')
+                fo.write(b'<SPARSE_DATA ni_form="binary.msbfirst" ni_type="7*float" ni_dimen="60">' + val.astype('>f4').tobytes() + b'</SPARSE_DATA>\n')
+                fo.write(b'</AFNI_dataset>\n')
+            nodes, values = io.read_niml_bin_nodes(fname)
+            assert_allclose(nodes, idx)
+            assert_allclose(values, val)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_read_niml_dset(self):
+        folder = tempfile.mkdtemp()
+        try:
+            fname = path.join(folder, 'data.niml.dset')
+            idx = np.arange(0, 120, 2)
+            val = np.random.rand(60,3).astype('float32')
+            encoders = {
+                'binary.lsbfirst': lambda x, t: x.astype('<'+t).tobytes(),
+                'binary.msbfirst': lambda x, t: x.astype('>'+t).tobytes(),
+                'base64.msbfirst': lambda x, t: base64.encodebytes(x.astype('>'+t).tobytes()),
+                'text': lambda x, t: ('\n' + '\n'.join(' '.join(map(str, np.atleast_1d(row))) for row in x) + '\n').encode('utf-8'),
+            }
+            for ni_form, encode in encoders.items():
+                with open(fname, 'wb') as fo:
+                    fo.write(b'<AFNI_dataset dset_type="Node_Bucket" ni_form="ni_group">\n')
+                    fo.write(b'<AFNI_atr ni_type="String" ni_dimen="1" atr_name="COLMS_TYPE">"Generic_Float;Generic_Float;Generic_Float"</AFNI_atr>\n')
+                    fo.write(f'<INDEX_LIST ni_form="{ni_form}" ni_type="int" ni_dimen="60">'.encode('utf-8') + encode(idx, 'i4') + b'</INDEX_LIST>\n')
+                    fo.write(f'<SPARSE_DATA ni_form="{ni_form}" ni_type="3*float" ni_dimen="60">'.encode('utf-8') + encode(val, 'f4') + b'</SPARSE_DATA>\n')
+                    fo.write(b'</AFNI_dataset>\n')
+                nodes, values = io.read_niml_dset(fname)
+                assert_allclose(nodes, idx)
+                assert_allclose(values, val, rtol=1e-6)
+                assert_allclose(io.read_surf_data(fname)[1], val, rtol=1e-6)
+                et, data = io.niml.parse_niml(fname)
+                assert_allclose(data[et.getroot().find('SPARSE_DATA').text], val, rtol=1e-6)
+            root = io.read_niml_dset(fname, return_type='tree')
+            self.assertEqual(root.find('AFNI_atr').text, '"Generic_Float;Generic_Float;Generic_Float"')
+            assert_allclose(np.float_(root.find('SPARSE_DATA').text.split()).reshape(-1,3), val, rtol=1e-6)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_NimlDsetWriter(self):
+        folder = tempfile.mkdtemp()
+        try:
+            fname = path.join(folder, 'data.niml.dset')
+            idx = np.arange(0, 200, 2)
+            val = np.random.rand(100,30).astype('float32')
+            with io.NimlDsetWriter(fname, idx, block_size=100) as writer:
+                for k in range(0, 30, 7):
+                    writer.write(val[:,k:k+7])
+            nodes, values = io.read_niml_bin_nodes(fname)
+            assert_allclose(nodes, idx)
+            assert_allclose(values, val)
+            self.assertEqual(os.listdir(folder), ['data.niml.dset']) # Temp file is removed
+            # Identical to writing all at once (except for self_idcode)
+            io.write_niml_bin_nodes(path.join(folder, 'data2.niml.dset'), idx, val)
+            with open(fname, 'rb') as f1, open(path.join(folder, 'data2.niml.dset'), 'rb') as f2:
+                self.assertEqual(len(f1.read()), len(f2.read()))
+            # A float block after int blocks promotes the whole dataset to float
+            ints = np.random.randint(-1000, 1000, size=(100,3))
+            with io.NimlDsetWriter(fname, idx, block_size=100) as writer:
+                writer.write(ints)
+                writer.write(val[:,:2])
+                writer.write(ints[:,0])
+            nodes, values = io.read_niml_bin_nodes(fname)
+            self.assertEqual(values.dtype.kind, 'f')
+            assert_allclose(values, np.c_[ints, val[:,:2], ints[:,0]])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_mesh_cache(self):
+        folder = tempfile.mkdtemp()
+        cache_root = utils.get_cache_dir()
+        utils.set_cache_dir(path.join(folder, 'cache'))
+        try:
+            fname = path.join(folder, 'lh.smoothwm.asc')
+            verts, faces = np.random.rand(100,3)*100, np.random.randint(0, 100, size=(200,3))
+            io.write_asc(fname, verts, faces)
+            v1, f1 = io.read_asc(fname)
+            v2, f2 = io.read_asc(fname) # From cache
+            self.assertIsInstance(v2, np.memmap)
+            assert_allclose(v2, v1)
+            assert_allclose(f2, faces)
+            v2[0] = 0 # Copy-on-write
+            assert_allclose(io.read_asc(fname)[0], v1)
+            # Modified source invalidates the cache
+            io.write_asc(fname, verts[:50], faces[:20])
+            self.assertEqual(io.read_asc(fname)[0].shape, (50,3))
+            io.clear_mesh_cache()
+            self.assertFalse(path.exists(path.join(folder, 'cache', 'mesh')))
+        finally:
+            utils.set_cache_dir(cache_root)
+            shutil.rmtree(folder)
+
+    def test_write_asc(self):
+        folder = tempfile.mkdtemp()
+        try:
+            verts, faces = np.random.rand(100,3)*100, np.random.randint(0, 100, size=(200,3))
+            fname = path.join(folder, 'lh.smoothwm.asc')
+            io.write_asc(fname, verts, faces, block_size=30)
+            with open(fname, 'r') as fi:
+                lines = fi.readlines()
+            self.assertEqual(lines[1], '100 200\n')
+            self.assertEqual(lines[2], '{0:.6f} {1:.6f} {2:.6f} 0\n'.format(*verts[0]))
+            self.assertEqual(lines[-1], '{0} {1} {2} 0\n'.format(*faces[-1]))
+            v, f = io._read_asc(fname)
+            assert_allclose(v, verts, atol=1e-6)
+            assert_allclose(f, faces)
+            # FreeSurfer binary surface
+            fname = path.join(folder, 'lh.smoothwm')
+            io.write_surf_mesh(fname, verts, faces)
+            v, f = io.read_surf_mesh(fname)
+            assert_allclose(v, verts, rtol=1e-6)
+            assert_allclose(f, faces)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_Mask_algebra(self):
+        IJK, MAT = np.r_[10,10,10], np.c_[np.eye(3), np.zeros(3)]
+        indices = [np.sort(np.random.choice(1000, 300, replace=False)) for k in range(5)]
+        masks = [io.Mask.from_dict(dict(master=None, index=idx, value=np.full(len(idx), 2**k), IJK=IJK, MAT=MAT))
+            for k, idx in enumerate(indices)]
+        a, b = masks[:2]
+        union = a + b
+        assert_allclose(union.index, np.union1d(a.index, b.index))
+        assert_allclose(union.value, np.in1d(union.index, a.index)*1 + np.in1d(union.index, b.index)*2)
+        assert_allclose((a*b).index, np.intersect1d(a.index, b.index))
+        assert_allclose((a-b).index, np.setdiff1d(a.index, b.index))
+        self.assertEqual(len((a-b).value), len((a-b).index))
+        self.assertTrue((a*b) in a)
+        self.assertFalse(a in (a*b))
+        assert_allclose(a.infer_selector(a*b), np.in1d(a.index, b.index))
+        # Bulk operations
+        union = io.Mask.combine(masks)
+        assert_allclose(union.index, np.unique(np.concatenate(indices)))
+        assert_allclose(union.value, sum(np.in1d(union.index, idx)*2**k for k, idx in enumerate(indices)))
+        intersect = io.Mask.combine(masks, combine='intersect')
+        assert_allclose(intersect.index, masks[0].index[np.all([np.in1d(masks[0].index, idx) for idx in indices], axis=0)])
+        assert_allclose(intersect.value, 2**len(masks)-1)
+        concat = io.Mask.concat([b-a, a])
+        assert_allclose(concat.index, np.r_[(b-a).index, a.index])
+        self.assertTrue((a*b) in concat)
+        self.assertRaises(AssertionError, io.Mask.concat, [a, b])
+
+    def test_Mask_geometry(self):
+        IJK, MAT = np.r_[20,18,15], np.c_[np.array([[1.9,0.3,0],[-0.2,2,0.1],[0,0.1,-2.5]]), [1,2,3]] # Oblique
+        index = np.sort(np.random.choice(np.prod(IJK), 3000, replace=False))
+        mask = io.Mask.from_dict(dict(master=None, index=index, value=np.arange(len(index)), IJK=IJK, MAT=MAT))
+        mask2 = io.Mask.concat([mask.pick(slice(1500,None)), mask.pick(slice(0,1500))]) # Unsorted index
+        for m in [mask, mask2]:
+            xyz = m.xyz
+            for c in xyz[:10]:
+                ball, sel = m.ball(c, [3,4,5], return_selector=True)
+                sel0 = np.sum(((xyz-c)/[3,4,5])**2, axis=1) < 1
+                assert_allclose(sel, sel0)
+                assert_allclose(ball.index, m.index[sel0])
+                assert_allclose(ball.value, m.value[sel0])
+                cylinder = m.cylinder([c[0], np.nan, c[2]], 4)
+                assert_allclose(cylinder.index, m.index[np.sum(((xyz-c)[:,[0,2]]/4)**2, axis=1) < 1])
+                slab = m.slab(x1=c[0]-5, x2=c[0]+5, y1=-100, y2=100, z1=-100, z2=c[2])
+                assert_allclose(slab.index, m.index[(c[0]-5<xyz[:,0]) & (xyz[:,0]<c[0]+5) & (xyz[:,2]<c[2])])
+            for ball, c in zip(m.balls(xyz[:10], 4), xyz[:10]):
+                assert_allclose(ball.index, m.ball(c, 4).index)
+            for (ball, sel), c in zip(m.balls(xyz[:10], [3,4,5], return_selector=True), xyz[:10]):
+                assert_allclose(sel, np.sum(((xyz-c)/[3,4,5])**2, axis=1) < 1)
+                assert_allclose(ball.value, m.value[sel])
+        # Sparse mask in a large grid (the box is scanned against the mask instead)
+        IJK = np.r_[200,200,150]
+        index = np.sort(np.random.choice(np.prod(IJK), 1000, replace=False))
+        mask = io.Mask.from_dict(dict(master=None, index=index, value=np.arange(len(index)), IJK=IJK, MAT=MAT))
+        xyz = mask.xyz
+        slab = mask.slab(x1=0, x2=100, y1=-1000, y2=1000, z1=-1000, z2=1000)
+        assert_allclose(slab.index, mask.index[(0<xyz[:,0]) & (xyz[:,0]<100)])
+
+    def test_Mask_dump_chunked(self):
+        folder = tempfile.mkdtemp()
+        try:
+            mask_file = path.join(folder, 'mask.nii')
+            vol = np.random.rand(6,5,4) > 0.5
+            io.write_nii(mask_file, vol.astype(np.int16))
+            mask = io.Mask.from_expr('m>0', m=mask_file)
+            data = np.random.randint(-1000, 1000, size=(6,5,4,7)).astype(np.int16)
+            expected = np.reshape(data, (-1,7), order='F')[mask.index]
+            img = io.nibabel.Nifti1Image(data, np.eye(4))
+            img.header.set_slope_inter(0.5, 10)
+            for ext in ['.nii', '.nii.gz']:
+                data_file = path.join(folder, 'data'+ext)
+                io.nibabel.save(img, data_file)
+                x = mask.dump(data_file, chunk_size=3)
+                self.assertEqual(x.shape, (len(mask.index),7))
+                assert_allclose(x, expected*0.5+10)
+                x = mask.dump([data_file, data_file], dtype=np.float32, chunk_size=10)
+                self.assertEqual(x.dtype, np.float32)
+                assert_allclose(x, np.c_[expected, expected]*0.5+10)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_Mask_undump_native(self):
+        folder = tempfile.mkdtemp()
+        try:
+            IJK, MAT = np.r_[6,5,4], np.c_[np.diag([-2.,-2, 3]), [10, 20, -5]]
+            index = np.sort(np.random.choice(np.prod(IJK), 50, replace=False))
+            mask = io.Mask.from_dict(dict(master=None, index=index, value=None, IJK=IJK, MAT=MAT))
+            x = np.random.randn(50,7) * 100
+            for prefix, dtype, data_file in [('data.nii', np.float32, 'data.nii'), ('data.nii.gz', np.int16, 'data.nii.gz'),
+                ('data', np.int16, 'data+orig.HEAD'), ('data+tlrc', np.float32, 'data+tlrc.HEAD')]:
+                mask.undump(path.join(folder, prefix), x, method='native', dtype=dtype, chunk_size=3)
+                data_file = path.join(folder, data_file)
+                assert_allclose(mask.dump(data_file, chunk_size=2), x, atol=np.abs(x).max()/2**15 if dtype == np.int16 else 1e-3)
+                assert_allclose(io.afni.get_affine(data_file), MAT)
+                self.assertEqual(io.nibabel.load(data_file).get_data_dtype(), dtype)
+            self.assertEqual(io.afni.read_head(data_file)['BRICK_TYPES'].tolist(), [3]*7)
+            # Non-negative integers fit into uint8 without scaling
+            b = np.random.randint(0, 256, size=(50,7))
+            for prefix, data_file in [('byte.nii', 'byte.nii'), ('byte', 'byte+orig.HEAD')]:
+                mask.undump(path.join(folder, prefix), b, method='native', dtype=np.uint8)
+                data_file = path.join(folder, data_file)
+                assert_allclose(mask.dump(data_file), b)
+                self.assertEqual(io.nibabel.load(data_file).get_data_dtype(), np.uint8)
+            self.assertRaises(ValueError, mask.undump, path.join(folder, 'byte.nii'), x, method='native', dtype=np.uint8)
+        finally:
+            shutil.rmtree(folder)
+
     def test_Mask(self):
         mask_file = path.join(data_dir, 'brain_mask', 'brain_mask+orig')
         data_file = path.join(data_dir, 'brain_mask', 'gre*.volreg+orig.HEAD')
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, absolute_import, unicode_literals
+import os, unittest, tempfile, shutil, warnings
+import numpy as np
+from numpy.testing import assert_allclose
+from mripy import surface
+
+
+def icosphere(n_subdiv=0, radius=100):
+    '''
+    Icosahedron (12 verts, 20 faces) subdivided `n_subdiv` times and projected onto a sphere.
+    '''
+    t = (1 + np.sqrt(5)) / 2
+    verts = np.array([[-1,t,0], [1,t,0], [-1,-t,0], [1,-t,0], [0,-1,t], [0,1,t],
+        [0,-1,-t], [0,1,-t], [t,0,-1], [t,0,1], [-t,0,-1], [-t,0,1]], dtype=float)
+    faces = np.array([[0,11,5], [0,5,1], [0,1,7], [0,7,10], [0,10,11], [1,5,9], [5,11,4],
+        [11,10,2], [10,7,6], [7,1,8], [3,9,4], [3,4,2], [3,2,6], [3,6,8], [3,8,9],
+        [4,9,5], [2,4,11], [6,2,10], [8,6,7], [9,8,1]])
+    if n_subdiv > 0:
+        verts, faces = surface.quadruple_mesh(verts, faces, power=n_subdiv)
+    verts *= radius / np.linalg.norm(verts, axis=1, keepdims=True)
+    return verts, faces
+
+
+class test_surface(unittest.TestCase):
+    def test_quadruple_mesh(self):
+        verts, faces = icosphere(0)
+        new_verts, new_faces, parents = surface.quadruple_mesh(verts, faces, power=2, return_parents=True)
+        self.assertEqual(new_verts.shape, (162, 3))
+        self.assertEqual(new_faces.shape, (320, 3))
+        assert_allclose(new_verts[:12], verts)
+        assert_allclose(new_verts, (new_verts[parents[:,0]] + new_verts[parents[:,1]])/2)
+        self.assertTrue(np.all(parents.max(axis=1)[12:] < np.arange(12, 162)))
+        self.assertEqual(len(np.unique(np.sort(parents[12:], axis=1), axis=0)), 150) # Each edge is divided once
+        # Orientation is preserved (outward normals)
+        n = np.cross(new_verts[new_faces[:,1]] - new_verts[new_faces[:,0]], new_verts[new_faces[:,2]] - new_verts[new_faces[:,0]])
+        self.assertTrue(np.all(np.sum(n * new_verts[new_faces[:,0]], axis=1) > 0))
+        # Only faces touching the mask are divided (in place)
+        new_verts, new_faces = surface.quadruple_mesh(verts, faces, mask=[0])
+        self.assertEqual(new_verts.shape, (12+10, 3))
+        self.assertEqual(new_faces.shape, (20+5*3, 3))
+        np.testing.assert_array_equal(new_faces[-1], faces[-1])
+        np.testing.assert_array_equal(new_faces[:4], [[0,14,13], [14,11,12], [13,12,5], [12,13,14]])
+        # Integer verts give float midpoints
+        new_verts = surface.quadruple_mesh(np.array([[0,0,0], [1,0,0], [0,1,0]]), np.array([[0,1,2]]))[0]
+        self.assertEqual(new_verts.dtype.kind, 'f')
+        assert_allclose(new_verts[3:], [[0.5,0.5,0], [0,0.5,0], [0.5,0,0]])
+
+    def test_mesh_topology(self):
+        verts, faces = icosphere(2)
+        topo = surface.mesh_topology(faces)
+        self.assertIs(surface.mesh_topology(faces.copy()), topo) # Cached by content
+        self.assertEqual(topo.adjacency.shape, (len(verts), len(verts)))
+        self.assertEqual(topo.incidence.shape, (len(verts), len(faces)))
+        # Euler characteristic of a sphere
+        self.assertEqual(len(verts) - topo.adjacency.nnz//2 + len(faces), 2)
+        self.assertTrue(np.all(np.sort(topo.degrees)[[0,-1]] == [5, 6]))
+        assert_allclose(topo.incidence.sum(axis=1).A1, topo.degrees) # Closed mesh
+        # Agree with the brute force definition
+        nbs = surface.immediate_neighbors(verts, faces)
+        for k in [0, 11, 12, len(verts)-1]:
+            expected = set(faces[np.any(faces==k, axis=1)].ravel()) - {k}
+            self.assertEqual(nbs[k], expected)
+            self.assertEqual(set(topo.neighbors(k)), expected)
+        arr = np.frombuffer(surface.immediate_neighbors(verts, faces, return_array=True), dtype=np.int32).reshape(len(verts),-1)
+        self.assertTrue(all(set(arr[k,1:arr[k,0]]) == nbs[k] for k in range(len(verts))))
+        # k-ring as sparse products
+        ring = topo.k_ring(2)
+        expected = set.union({0}, nbs[0], *[nbs[n] for n in nbs[0]])
+        self.assertEqual(set(ring[0].indices), expected)
+        self.assertEqual(set(topo.k_ring(1, include_self=False)[0].indices), nbs[0])
+
+    def test_interp_over_mesh(self):
+        verts, faces = icosphere(2)
+        n_verts = len(verts)
+        values = np.random.rand(n_verts)
+        nbs = surface.immediate_neighbors(verts, faces)
+        for radius in [1, 3]:
+            expected = surface.interp_over_mesh(verts, faces, np.arange(n_verts), values, radius=radius, neighbors=nbs)
+            assert_allclose(surface.interp_over_mesh(verts, faces, np.arange(n_verts), values, radius=radius), expected)
+        # Partial coverage, multiple columns
+        indices = np.arange(0, n_verts, 5)
+        values = np.random.rand(len(indices), 2)
+        new_val = surface.interp_over_mesh(verts, faces, indices, values, radius=1)
+        self.assertEqual(new_val.shape, (n_verts, 2))
+        for k in range(n_verts):
+            sel = np.isin(indices, list(nbs[k]))
+            if sel.any():
+                assert_allclose(new_val[k], values[sel].mean(axis=0))
+            else:
+                self.assertTrue(np.all(np.isnan(new_val[k])))
+        self.assertIs(surface.interp_matrix(faces, indices, radius=1), surface.interp_matrix(faces, indices, radius=1))
+        # Non-contiguous (and unsorted) indices give the same result with or without neighbors
+        indices = np.random.permutation(n_verts)[:n_verts//3]
+        values = np.random.rand(len(indices))
+        arr = surface.immediate_neighbors(verts, faces, return_array=True)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) # Mean of empty slice
+            for radius in [1, 2]:
+                expected = surface.interp_over_mesh(verts, faces, indices, values, radius=radius)
+                assert_allclose(surface.interp_over_mesh(verts, faces, indices, values, radius=radius, neighbors=nbs), expected)
+                assert_allclose(surface.interp_over_mesh(None, None, indices, values, radius=radius, neighbors=arr, n_verts=n_verts), expected)
+
+    def test_verts_data(self):
+        verts, faces = icosphere(2)
+        V = np.arange(0, len(verts), 7)
+        expected = [np.sum(surface.compute_faces_norm(verts, faces, surface.surrouding_faces(verts, faces, v)), axis=0) for v in V]
+        expected /= np.linalg.norm(expected, axis=1, keepdims=True)
+        norms = surface.compute_verts_norm(verts, faces, V)
+        assert_allclose(norms, expected)
+        assert_allclose(np.sum(norms * verts[V], axis=1), 100, rtol=0.01) # Outward radial normals
+        areas = surface.compute_verts_area(verts, faces)
+        self.assertAlmostEqual(areas.sum(), 4*np.pi*100**2, delta=0.05*4*np.pi*100**2)
+        smoothed = surface.smooth_verts_data(verts, faces, areas, factor=0.1, n_iters=2)
+        expected = areas
+        nbs = surface.immediate_neighbors(verts, faces)
+        for _ in range(2): # On a closed mesh, each neighbor shares two faces with the vertex
+            expected = 0.1 * np.array([np.mean(expected[list(nbs[k])]) for k in range(len(verts))]) + 0.9 * expected
+        assert_allclose(smoothed, expected)
+
+    def test_heat_kernel_smoother(self):
+        verts, faces = icosphere(5)
+        areas = surface.compute_verts_area(verts, faces)
+        smoother = surface.heat_kernel_smoother(verts, faces, fwhm=12)
+        self.assertIs(surface.heat_kernel_smoother(verts, faces, fwhm=12), smoother)
+        impulses = np.zeros((len(verts), 2))
+        impulses[[0,5000],[0,1]] = 1
+        smoothed = smoother(impulses)
+        for k, c in enumerate([0, 5000]):
+            w = smoothed[:,k] * areas
+            self.assertAlmostEqual(w.sum(), areas[c]) # Conservation
+            d = 100 * np.arccos(np.clip(verts @ verts[c] / 100**2, -1, 1)) # Geodesic distance
+            fwhm = np.sqrt(8*np.log(2) * np.sum(w*d**2)/w.sum()/2)
+            self.assertAlmostEqual(fwhm, 12, delta=0.03*12)
+        # Smoothing restricted to a patch
+        nodes = np.nonzero(verts[:,2] > 0)[0]
+        data = np.random.rand(len(verts))
+        smoothed = surface.heat_kernel_smoother(verts, faces, fwhm=12, nodes=nodes)(data)
+        outside = np.setdiff1d(np.arange(len(verts)), nodes)
+        assert_allclose(smoothed[outside], data[outside])
+        self.assertLess(smoothed[nodes].std(), data[nodes].std()/2)
+
+    def test_VolSurfSampler(self):
+        verts, faces = icosphere(4, radius=40)
+        outer = verts * 1.1
+        MAT = np.c_[np.diag([2., 2., 2.]), [-60, -60, -60]] # RAI
+        shape = (61, 61, 61)
+        xyz = np.indices(shape).reshape(3,-1,order='F').T @ MAT[:,:3].T + MAT[:,3]
+        vol = np.stack([xyz[:,0], -xyz[:,2]], axis=-1).reshape(shape+(2,), order='F') # RAI x, -z
+        expected = np.c_[-(verts+outer)[:,0], -(verts+outer)[:,2]] / 2 # RAS -> RAI
+        cache_dir = tempfile.mkdtemp()
+        try:
+            sampler = surface.VolSurfSampler((verts, faces), (outer, faces), MAT, shape, cache_dir=cache_dir)
+            cached = surface.VolSurfSampler((verts, faces), (outer, faces), MAT, shape, cache_dir=cache_dir)
+            self.assertIsInstance(cached.voxels, np.memmap)
+            np.testing.assert_array_equal(cached.voxels, sampler.voxels)
+            for func in ['ave', 'midpoint', 'median']:
+                values = sampler.vol2surf(vol, func=func, chunk_size=1)
+                self.assertLessEqual(np.abs(values - expected).max(), np.sqrt(3)) # Within a voxel
+            for func in ['max', 'median']: # Gathering in node blocks gives the same result
+                assert_allclose(sampler.vol2surf(vol, func=func, block_size=1000), sampler.vol2surf(vol, func=func, block_size=2**30))
+            assert_allclose(sampler.vol2surf(vol[...,0]), sampler.matrix() @ vol[...,0].ravel(order='F'))
+            count = sampler.surf2vol(np.ones(len(verts)), func='count')
+            self.assertEqual(count.sum(), 20*len(verts))
+            back = sampler.surf2vol(expected, func='ave')
+            hit = (count > 0)
+            self.assertLessEqual(np.abs(back[hit] - vol[hit]).max(), 4) # Segments are about 4 mm long
+            self.assertTrue(np.all(back[~hit] == 0))
+            median = sampler.surf2vol(expected, func='median').reshape(-1, 2, order='F')
+            points = np.asarray(sampler.voxels[:,:-1])
+            for v in np.nonzero(count.ravel(order='F'))[0][:20]:
+                assert_allclose(median[v], np.median(expected[np.nonzero(points == v)[0]], axis=0))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_compute_voxel_depth(self):
+        verts, faces = icosphere(4, radius=40)
+        outer = verts * 1.1 # 4 mm thick
+        dirs = np.random.randn(2000, 3)
+        dirs /= np.linalg.norm(dirs, axis=1, keepdims=True)
+        r = np.random.uniform(37, 47, size=len(dirs))
+        xyz = dirs * r[:,np.newaxis] * [-1, -1, 1] # RAS -> RAI
+        S2E_mat = np.c_[np.eye(3), np.zeros(3)]
+        cache_dir = tempfile.mkdtemp()
+        try:
+            depths = surface.compute_voxel_depth(xyz, (verts, faces), (outer, faces), S2E_mat, method='equidistance', cache_dir=cache_dir)
+            inside = (r > 40.5) & (r < 43.5)
+            assert_allclose(depths[inside], (r[inside]-40)/4, atol=0.05)
+            self.assertTrue(np.all(depths[r < 38] == -0.2) and np.all(depths[r > 46] == 1.2))
+            cached = surface.compute_voxel_depth(xyz, (verts, faces), (outer, faces), S2E_mat, method='equidistance', cache_dir=cache_dir)
+            np.testing.assert_array_equal(cached, depths)
+            # Another set of voxels gets its own cached depth map
+            subset = surface.compute_voxel_depth(xyz[:10], (verts, faces), (outer, faces), S2E_mat, method='equidistance', cache_dir=cache_dir)
+            np.testing.assert_array_equal(subset, depths[:10])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_LaminaStack(self):
+        verts, faces = icosphere(3, radius=40)
+        outer = verts * 1.1
+        alphas = np.linspace(0, 1, 6)
+        folder = tempfile.mkdtemp()
+        try:
+            prefix = f"{folder}/lh.lamina"
+            stack = surface.LaminaStack.create(prefix, (verts, faces), (outer, faces), alphas)
+            stack = surface.LaminaStack(prefix)
+            self.assertEqual(sorted(os.listdir(folder)), ['lh.lamina.faces.npy', 'lh.lamina.json', 'lh.lamina.verts.npy'])
+            self.assertEqual(stack.verts.dtype, np.float64)
+            self.assertEqual(len(stack), len(alphas))
+            self.assertIsInstance(stack.verts, np.memmap)
+            expected = surface.compute_intermediate_mesh((verts, faces), (outer, faces), alphas, method='equivolume_inside')[0]
+            assert_allclose(stack.verts, expected)
+            v, f = stack.layer(0.4)
+            assert_allclose(v, expected[2])
+            np.testing.assert_array_equal(f, faces)
+            # Equivolume: outer layers are thinner where the outer surface has larger area
+            r = np.linalg.norm(stack.verts, axis=-1).mean(axis=-1)
+            self.assertTrue(np.all(np.diff(np.diff(r)) < 0))
+            surface.create_lamina_mesh(f"{folder}/lh.mid.asc", None, None, 0.6, stack=prefix)
+            assert_allclose(surface.io._read_asc(f"{folder}/lh.mid.asc")[0], expected[3], atol=1e-5)
+            self.assertRaises(ValueError, stack.layer, 0.5)
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, absolute_import, unicode_literals
+import unittest, time
+import numpy as np
+from mripy import surface
+from mripy.tests.test_surface import icosphere
+
+
+def quadruple_mesh_loop(verts, faces, power=1, mask=None):
+    '''
+    Reference (previous) implementation of `surface.quadruple_mesh` with dicts and lists of edges.
+    '''
+    if mask is not None:
+        mask = set(mask)
+    for _ in range(power):
+        nv = [v for v in verts]
+        nv_parent = {}
+        nf = []
+        def get_new_vert(n1, n2):
+            n_idx = nv_parent.setdefault(tuple(sorted([n1, n2])), len(nv))
+            if n_idx == len(nv):
+                nv.append((verts[n1]+verts[n2])/2)
+            return n_idx
+        for f in faces:
+            if mask is not None and set(f).isdisjoint(mask):
+                nf.append(f)
+            else:
+                nv0 = get_new_vert(f[1], f[2])
+                nv1 = get_new_vert(f[2], f[0])
+                nv2 = get_new_vert(f[0], f[1])
+                nf.extend([(f[0], nv2, nv1), (nv2, f[1], nv0), (nv1, nv0, f[2]), (nv0, nv1, nv2)])
+        verts = nv
+        faces = nf
+    return np.array(verts), np.array(faces)
+
+
+class test_surface(unittest.TestCase):
+    def test_verts_data_scaling(self):
+        '''
+        Benchmark vertex normals, areas and smoothing on icospheres of 10k-655k verts
+        '''
+        funcs = {
+            'compute_verts_norm': lambda verts, faces: surface.compute_verts_norm(verts, faces, np.arange(len(verts))),
+            'compute_verts_area': lambda verts, faces: surface.compute_verts_area(verts, faces),
+            'smooth_verts_data': lambda verts, faces: surface.smooth_verts_data(verts, faces, verts[:,0], n_iters=2),
+        }
+        cost = {name: [] for name in funcs}
+        for n_subdiv in [5, 6, 7, 8]:
+            verts, faces = icosphere(n_subdiv)
+            for name, func in funcs.items():
+                surface.clear_topology_cache() # Include the construction of the sparse topology
+                t = time.time()
+                func(verts, faces)
+                duration = time.time() - t
+                cost[name].append(duration/len(verts))
+                print(f'>> {name}: {len(verts)} verts in {duration:.3f} sec ({duration/len(verts)*1e9:.0f} ns/vert)')
+        for name in funcs: # Roughly linear (allowing for cache effects)
+            self.assertLess(cost[name][-1], 3*cost[name][1])
+
+    def test_quadruple_mesh(self):
+        '''
+        Benchmark vectorized mesh subdivision against the loop implementation
+        '''
+        for n_subdiv in [4, 6, 7]:
+            verts, faces = icosphere(n_subdiv)
+            for mask in [None, np.arange(0, len(verts), 3)]:
+                t = time.time()
+                expected = quadruple_mesh_loop(verts, faces, mask=mask)
+                t_loop = time.time() - t
+                t = time.time()
+                new_verts, new_faces = surface.quadruple_mesh(verts, faces, mask=mask)
+                t_vec = time.time() - t
+                print(f'>> {len(verts)} -> {len(new_verts)} verts{"" if mask is None else " (masked)"}: '
+                    f'{t_loop:.3f} sec (loop) vs {t_vec:.3f} sec (vectorized), {t_loop/t_vec:.0f}x')
+                np.testing.assert_array_equal(new_verts, expected[0])
+                np.testing.assert_array_equal(new_faces, expected[1])
+                self.assertLess(t_vec, t_loop)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,11 +7,13 @@ from collections import OrderedDict
 import itertools
 import numpy as np
 from scipy import stats, signal, interpolate
-import matplotlib.pyplot as plt
-import seaborn as sns
-import pandas as pd
 from . import six, afni, io, utils, dicom, math
 
+# Imported on demand (slow to import)
+plt = utils.lazy_import('matplotlib.pyplot')
+sns = utils.lazy_import('seaborn')
+pd = utils.lazy_import('pandas')
+
 
 def convolve_HRF(starts, lens, TR=2, scan_time=None, HRF=None):
     if np.isscalar(lens):
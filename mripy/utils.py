@@ -3,15 +3,14 @@
 from __future__ import print_function, division, absolute_import, unicode_literals
 import sys, os, re, glob, shlex, string
 import subprocess, multiprocessing, ctypes, time, uuid
-import json
-import tables, warnings
+import json, importlib, importlib.util, shutil
+import warnings
 from datetime import datetime
 from itertools import chain
 from collections import OrderedDict
 from contextlib import contextmanager
 from os import path
 import numpy as np
-from deepdish import io as dio
 from . import six, afni
 
 
@@ -23,6 +22,44 @@ from .paraproc import PooledCaller, SharedMemoryArray
 package_dir = path.abspath(path.dirname(__file__))
 
 
+class lazy_import(object):
+    '''
+    A module placeholder that imports the actual module on first attribute access.
+
+    Heavy dependencies (e.g., matplotlib, seaborn, sklearn) are only needed by a few 
+    functions, so deferring their import keeps `import mripy.xxx` (and thus short-lived 
+    batch jobs and PooledCaller workers) fast.
+
+    >>> plt = lazy_import('matplotlib.pyplot')
+    >>> plt.plot(x, y) # matplotlib.pyplot is actually imported here
+    '''
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'{' (imported)' if self._module is not None else ''}>"
+
+
+def has_module(name):
+    '''Check whether a module is installed without actually importing it.'''
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
 def has_ants():
     pass
 
@@ -270,6 +307,48 @@ def temp_folder(parent=None):
     return folder
 
 
+# On-disk caches of derived data (e.g., parsed meshes, sampling voxels, depth maps) are opt-in.
+# They all live in subfolders of one root, which is taken from the MRIPY_CACHE_DIR environment
+# variable or set by `set_cache_dir()`, and can be removed altogether by `clear_cache()`.
+_cache_root = os.environ.get('MRIPY_CACHE_DIR') or None
+
+def set_cache_dir(root):
+    '''Enable the on-disk caches under `root` (or disable them if root is None).'''
+    global _cache_root
+    _cache_root = root
+
+
+def get_cache_dir(name=None):
+    '''Folder of the named cache (e.g., "mesh"), or None if caching is disabled.'''
+    if not _cache_root:
+        return None
+    return _cache_root if name is None else path.join(_cache_root, name)
+
+
+def clear_cache(name=None):
+    '''Remove the named cache, or all caches if name is None.'''
+    folder = get_cache_dir(name)
+    if folder and path.exists(folder):
+        shutil.rmtree(folder)
+
+
+def atomic_save(fname, save):
+    '''
+    Call save(temp_file) and then rename temp_file as fname, so that concurrent
+    readers (e.g., PooledCaller workers) never see a half-written file.
+    '''
+    folder = path.dirname(fname)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    temp_file = f"{fname}.{temp_prefix(prefix='', suffix='')}"
+    try:
+        save(temp_file)
+        os.replace(temp_file, fname) # Atomic, in case of concurrent jobs
+    finally:
+        if path.exists(temp_file):
+            os.remove(temp_file)
+
+
 class ParallelCaller(object):
     def __init__(self):
         self.ps = []
@@ -441,6 +520,10 @@ def parallel_3D(cmd, in_file, prefix, n_jobs=1, schema=None, fname_mapper=None,
         os.remove(f)
 
 
+# deepdish (and pytables) are only needed for saving/loading
+tables = lazy_import('tables')
+dio = lazy_import('deepdish.io')
+
 class Savable(object):
     def save(self, fname):
         with warnings.catch_warnings():
@@ -3,9 +3,11 @@
 from __future__ import print_function, division, absolute_import, unicode_literals
 import glob
 import numpy as np
-from matplotlib import pyplot as plt, transforms
-# from matplotlib import transforms
-from . import six, io
+from . import six, io, utils
+
+# Imported on demand (slow to import)
+plt = utils.lazy_import('matplotlib.pyplot')
+transforms = utils.lazy_import('matplotlib.transforms')
 
 
 def get_color_list(cmap):
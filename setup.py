@@ -30,5 +30,5 @@ setuptools.setup(
        'Topic :: Software Development :: Libraries',
        'Topic :: Utilities',
    ),
-   python_requires='>=3.6',
+   python_requires='>=3.7', # Module level __getattr__ (PEP 562), e.g., for afni.has_afni
 )